@@ -2,10 +2,15 @@ import os
 from multiprocessing.pool import ThreadPool
 
 import pandas as pd
-import requests
 
+from base.http_session import createSession
 from db.ref_utils import parseBibAuthors, isPDFURL
 
+DOWNLOAD_THREADS = 8
+
+# shared by all download threads, so the pool needs one connection per thread
+download_session = createSession(pool_size=DOWNLOAD_THREADS, timeout=(10, 60))
+
 
 def fetch_url(entry):
     result = {'id': entry['id'],
@@ -15,7 +20,7 @@ def fetch_url(entry):
     if not os.path.exists(entry['filename']):
         print("Get %s - %s" % (entry['id'][:30], entry['url']))
         try:
-            r = requests.get(entry['url'], stream=True)
+            r = download_session.get(entry['url'], stream=True)
             result['return_code'] = r.status_code
             if r.status_code == 200:
                 with open(entry['filename'], 'wb') as f:
@@ -101,7 +106,7 @@ def bulkDownload(papers, root_dir, report_path, do_not_download_just_list=False)
     if do_not_download_just_list:
         return
 
-    results = ThreadPool(8).imap_unordered(fetch_url, download_tasks)
+    results = ThreadPool(DOWNLOAD_THREADS).imap_unordered(fetch_url, download_tasks)
 
     df = pd.DataFrame(results)
     df.to_csv(report_path)
@@ -0,0 +1,54 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+SERVER_ERROR_STATUS_CODES = [500, 502, 504]
+
+
+class PooledSession(requests.Session):
+    """
+    A requests.Session that applies a default timeout to every request unless one is given
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def createSession(pool_size=10, max_retries=3, backoff_factor=0.5, timeout=DEFAULT_TIMEOUT,
+                  retry_status_codes=RETRY_STATUS_CODES):
+    """
+    Creates a keep-alive session with a connection pool, default timeouts and automatic retries
+    with exponential backoff for 429 and 5xx responses (honouring Retry-After) by default
+
+    :param pool_size: max number of connections kept open per host
+    :param max_retries: max number of retries per request
+    :param backoff_factor: base for the exponential backoff between retries, in seconds
+    :param timeout: default (connect, read) timeout in seconds
+    :param retry_status_codes: response status codes to retry
+    :return: PooledSession
+    """
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=retry_status_codes,
+                  # the Semantic Scholar search endpoint is a read-only POST
+                  allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+                  # urllib3 retries on Retry-After even for statuses that aren't in status_forcelist
+                  respect_retry_after_header=bool({429, 503} & set(retry_status_codes)),
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = PooledSession(timeout=timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,60 @@
+from argparse import ArgumentParser
+import os
+import tempfile
+from time import time
+
+from db.endnote_html import iterRefsFromHTML, ENTRY_SEPARATOR
+
+ENTRY_TEMPLATE = ('<b>Reference Type: </b> Journal Article<p>\n'
+                  '<b>Record Number:</b> {0}<p>\n'
+                  '<b>Author:</b> Smith, John and Doe, Jane<p>\n'
+                  '<b>Year:</b> 2019<p>\n'
+                  '<b>Title:</b> A study of things number {0}<p>\n'
+                  '<b>Journal:</b> Journal of Studies<p>\n'
+                  '<b>volume:</b> 12<p>\n'
+                  '<b>Author Address:</b> University of Somewhere<p>\n'
+                  '<b>DOI:</b> 10.1000/test.{0}<p>\n'
+                  '<b>URL:</b> <A HREF="https://example.com/paper/{0}">https://example.com/paper/{0}</A><p>\n'
+                  '<A HREF="https://example.com/paper/{0}.pdf">https://example.com/paper/{0}.pdf</A><p>\n')
+
+
+def writeSyntheticExport(filename, num_refs):
+    with open(filename, 'w') as f:
+        f.write('<html>\n<head><title>EndNote export</title></head>\n<body>\n')
+        for index in range(num_refs):
+            f.write(ENTRY_TEMPLATE.format(index))
+            f.write(ENTRY_SEPARATOR + '\n')
+        f.write('</body>\n</html>\n')
+
+
+def main(conf):
+    if conf.input:
+        filename = conf.input
+    else:
+        with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False) as f:
+            filename = f.name
+        writeSyntheticExport(filename, conf.num_refs)
+
+    try:
+        start = time()
+        count = sum(1 for _ in iterRefsFromHTML(filename))
+        duration = time() - start
+    finally:
+        if not conf.input:
+            os.remove(filename)
+
+    print('Parsed %d references in %.2f seconds (%.0f refs/s)' % (count, duration, count / max(duration, 1e-6)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Times the EndNote HTML importer on a synthetic export, or on a real one')
+
+    parser.add_argument('-n', '--num-refs', type=int, default=50000,
+                        help='Number of references in the synthetic export')
+    parser.add_argument('-i', '--input', type=str,
+                        help='EndNote HTML file to time instead of a synthetic one')
+
+    conf = parser.parse_args()
+
+    main(conf)
@@ -2,8 +2,6 @@ import bibtexparser
 import re
 import random
 
-import requests
-
 from db.ref_utils import parseBibAuthors, normalizeTitle
 
 
@@ -18,7 +16,7 @@ def fixBibData(bib, index):
     if "ENTRYTYPE" not in bib:
         bib["ENTRYTYPE"] = "ARTICLE"
     if "ID" not in bib:
-        authors = parseBibAuthors(bib["author"])
+        authors = parseBibAuthors(bib.get("author"))
         if not authors:
             bib['ID'] = 'id' + str(random.randint(1000, 9000))
         else:
@@ -37,6 +35,18 @@ def readBibtexFile(filename):
     return bibtexparser.load(open(filename, 'r')).entries
 
 
+def writeBibtexString(bibs: list):
+    """
+    Returns the BibTeX text for a list of bib dicts
+
+    :param bibs: list of bib dicts, each with ID and ENTRYTYPE
+    :return: BibTeX string
+    """
+    db = bibtexparser.bibdatabase.BibDatabase()
+    db.entries = bibs
+    return bibtexparser.dumps(db)
+
+
 def writeBibtex(results: list, filename: str):
     """
     Exports the list of results to a BibTeX file.
@@ -53,16 +63,6 @@ def writeBibtex(results: list, filename: str):
         bibtexparser.dump(db, bibtex_file)
 
 
-def getBibtextFromDOI(doi: str):
-    assert doi
-    headers = {'Accept': 'text/bibliography; style=bibtex'}
-    url = 'http://doi.org/' + doi
-    r = requests.get(url, headers=headers)
-    text = r.content.decode('utf-8')
-    bib = readBibtexString(text)
-    return bib
-
-
 def generateUniqueID(paper):
     """
     Returns a simple string id that is the mashup of the title and authors
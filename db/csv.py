@@ -1,6 +1,16 @@
 import pandas as pd
 
 
-def readCSVFile(filename):
-    df = pd.read_csv(filename)
-    return df.to_dict(orient='records')
+def readCSVFile(filename, chunksize=10000):
+    """
+    Lazily yields one dict per row of a CSV file, reading it in chunks of `chunksize` rows.
+    Every column is read as text, so that pandas doesn't turn years or PMIDs into floats or DOIs
+    into numbers, and empty cells are returned as ''
+
+    :param filename: CSV file to read
+    :param chunksize: number of rows to hold in memory at any one time
+    """
+    for chunk in pd.read_csv(filename, dtype=str, chunksize=chunksize):
+        chunk = chunk.fillna('')
+        for record in chunk.to_dict(orient='records'):
+            yield record
@@ -1,5 +1,8 @@
 import sqlite3
 import os, re, json
+import socket
+import threading
+from time import time
 import pandas as pd
 import bibtexparser
 
@@ -23,6 +26,57 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 CACHE_FILE = os.path.join(current_dir, "papers.sqlite")
 
 
+# identifiers kept in the id_crosswalk table
+ID_TYPES = ['doi', 'pmid', 'pmcid', 'arxivid', 'ssid', 'scholarid', 'openalex']
+
+arxiv_version_regex = re.compile(r'v\d+$')
+
+# statuses of the jobs in the enrichment_jobs table
+JOB_PENDING = 'pending'
+JOB_IN_FLIGHT = 'in_flight'
+JOB_OK = 'ok'
+JOB_NOT_FOUND = 'not_found'
+JOB_ERROR = 'error'
+JOB_SKIPPED = 'skipped'
+
+JOB_FINISHED_STATUSES = [JOB_OK, JOB_NOT_FOUND, JOB_SKIPPED]
+
+# a job that has failed this many times is given up on
+JOB_MAX_ATTEMPTS = 5
+# seconds before a failed job can be tried again, doubled after each attempt
+JOB_RETRY_DELAY = 60
+# seconds a claimed job belongs to its worker before someone else can claim it
+JOB_LEASE = 600
+
+# who claims jobs from this process
+JOB_WORKER = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def normalizeIdentifier(id_type, value):
+    """
+    Normalizes an identifier so that the same id written in different ways compares equal
+
+    :param id_type: one of ID_TYPES
+    :param value: the id
+    :return: normalized id, or None if there is no id
+    """
+    if value is None:
+        return None
+
+    value = str(value).strip()
+    if not value:
+        return None
+
+    if id_type == 'doi':
+        return re.sub(r'^(https?://(dx\.)?doi\.org/|doi:)', '', value, flags=re.IGNORECASE).lower()
+    elif id_type == 'arxivid':
+        return arxiv_version_regex.sub('', value).lower()
+    elif id_type == 'pmcid':
+        value = value.upper()
+        return value if value.startswith('PMC') else 'PMC' + value
+    return value
+
+
 class Paper:
     """
     A Paper consists of 2 dicts: .bib and .extra_data
@@ -76,6 +130,38 @@ class Paper:
     def pmid(self, pmid):
         self.extra_data["pmid"] = pmid
 
+    @property
+    def pmcid(self):
+        return self.extra_data.get("pmcid")
+
+    @pmcid.setter
+    def pmcid(self, pmcid):
+        self.extra_data["pmcid"] = pmcid
+
+    @property
+    def ssid(self):
+        return self.extra_data.get("ss_id")
+
+    @ssid.setter
+    def ssid(self, ssid):
+        self.extra_data["ss_id"] = ssid
+
+    @property
+    def identifiers(self):
+        """
+        All the identifiers we know for this paper, normalized so that the same id found in
+        different places compares equal
+
+        :return: dict {id type: id value}
+        """
+        ids = {}
+        for id_type in ID_TYPES:
+            value = getattr(self, id_type) if id_type != 'openalex' else self.extra_data.get('openalex_id')
+            value = normalizeIdentifier(id_type, value)
+            if value:
+                ids[id_type] = value
+        return ids
+
     @property
     def scholarid(self):
         return self.extra_data.get("scholarid")
@@ -114,7 +200,8 @@ class Paper:
 
     @property
     def entrytype(self):
-        return self.bib.get("ENTRYTYPE").lower()
+        # entries from CSV or RIS files don't have one until fixBibData() gives them one
+        return (self.bib.get("ENTRYTYPE") or "").lower()
 
     @property
     def venue(self):
@@ -191,8 +278,11 @@ class Paper:
 
 class PaperStore:
     def __init__(self):
-        self.conn = sqlite3.connect(CACHE_FILE)
+        self.db_file = CACHE_FILE
+        self.conn = sqlite3.connect(self.db_file)
         self.conn.row_factory = sqlite3.Row
+        # read-only connections for other threads
+        self.local = threading.local()
         self.initaliseDB()
 
     def initaliseDB(self):
@@ -221,8 +311,154 @@ class PaperStore:
         self.conn.execute(
             """CREATE INDEX IF NOT EXISTS idx_papers_title ON papers(title, norm_title)""")
 
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS idx_papers_norm_title ON papers(norm_title)""")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "id_crosswalk" (
+                         "id_type" text,
+                         "id_value" text,
+                         "paper_id" text,
+                         PRIMARY KEY (id_type, id_value)
+                           )
+         """)
+
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS idx_id_crosswalk_paper ON id_crosswalk(paper_id)""")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "enrichment_jobs" (
+                         "job_key" text,
+                         "stage" text,
+                         "source" text,
+                         "status" text,
+                         "attempts" integer default 0,
+                         "next_eligible" real default 0,
+                         "claimed_by" text,
+                         "lease_until" real,
+                         "last_error" text,
+                         "updated" real,
+                         PRIMARY KEY (job_key, stage)
+                           )
+         """)
+
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS idx_enrichment_jobs_status ON enrichment_jobs(status)""")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "source_stats" (
+                         "stage" text,
+                         "features" text,
+                         "calls" integer default 0,
+                         "hits" integer default 0,
+                         "seconds" real default 0,
+                         PRIMARY KEY (stage, features)
+                           )
+         """)
+
         self.conn.commit()
 
+        # databases from before the crosswalk existed
+        if not self.conn.execute("SELECT 1 FROM id_crosswalk LIMIT 1").fetchone():
+            self.rebuildCrosswalk()
+
+    def rebuildCrosswalk(self):
+        """
+        Fills the id_crosswalk table from all the papers in the db
+        """
+        c = self.conn.execute("SELECT * FROM papers")
+        while True:
+            records = c.fetchmany(1000)
+            if not records:
+                break
+            self.updateCrosswalk([Paper.fromRecord(r) for r in records], commit=False, ids=[r['id'] for r in records])
+        self.conn.commit()
+
+    def updateCrosswalk(self, papers: list, commit=True, ids=None):
+        """
+        Records every identifier of every paper in the id_crosswalk table, pointing to the paper
+
+        :param papers: list of Paper
+        :param commit: commit when done
+        :param ids: paper ids to use instead of computing them
+        """
+        rows = []
+        for index, paper in enumerate(papers):
+            paper_id = ids[index] if ids else paper.id
+            for id_type, id_value in paper.identifiers.items():
+                rows.append((id_type, id_value, paper_id))
+
+        self.conn.executemany("""REPLACE INTO id_crosswalk (id_type, id_value, paper_id) values (?,?,?)""", rows)
+        if commit:
+            self.conn.commit()
+
+    def resolveIdentifier(self, id_string, id_type="doi"):
+        """
+        Returns the id of the stored paper that has an identifier
+
+        :param id_string: the actual id
+        :param id_type: one of ID_TYPES
+        :return: paper id, or None
+        """
+        row = self.conn.execute("SELECT paper_id FROM id_crosswalk WHERE id_type=? AND id_value=?",
+                                (id_type, normalizeIdentifier(id_type, id_string))).fetchone()
+        return row['paper_id'] if row else None
+
+    def getIdentifiers(self, paper_id):
+        """
+        Returns all the identifiers known for a stored paper
+
+        :return: dict {id type: id value}
+        """
+        rows = self.conn.execute("SELECT id_type, id_value FROM id_crosswalk WHERE paper_id=?", (paper_id,))
+        return {row['id_type']: row['id_value'] for row in rows}
+
+    def findPaperByIdentifiers(self, paper):
+        """
+        Looks for a stored paper that shares any identifier with `paper`, in one query
+
+        :param paper: Paper or SearchResult
+        :return: Paper if found, or None
+        """
+        ids = paper.identifiers
+        if not ids:
+            return None
+
+        where = " OR ".join(["(c.id_type=? AND c.id_value=?)"] * len(ids))
+        params = [value for item in ids.items() for value in item]
+
+        paper_record = self.conn.execute(
+            "SELECT p.* FROM id_crosswalk c JOIN papers p ON p.id=c.paper_id WHERE " + where + " LIMIT 1",
+            params).fetchone()
+        if not paper_record:
+            return None
+
+        return Paper.fromRecord(paper_record)
+
+    def fillIdentifiers(self, paper):
+        """
+        Adds any identifiers the crosswalk knows for a paper that the paper itself is missing
+
+        :param paper: Paper
+        :return: list of the id types that were added
+        """
+        paper_id = None
+        for id_type, id_value in paper.identifiers.items():
+            paper_id = self.resolveIdentifier(id_value, id_type)
+            if paper_id:
+                break
+
+        if not paper_id:
+            return []
+
+        added = []
+        for id_type, id_value in self.getIdentifiers(paper_id).items():
+            if id_type == 'openalex':
+                if not paper.extra_data.get('openalex_id'):
+                    paper.extra_data['openalex_id'] = id_value
+                    added.append(id_type)
+            elif not getattr(paper, id_type):
+                setattr(paper, id_type, id_value)
+                added.append(id_type)
+        return added
+
     # def runSelectStatement(self, sql, parameters):
     #     """
     #
@@ -238,12 +474,13 @@ class PaperStore:
         Looks for a paper given an id.
 
         :param id_string: the actual id
-        :param id_type: the type of id (doi, arxivid, pmid, scholarid)
+        :param id_type: the type of id (doi, pmid, pmcid, arxivid, ssid, scholarid, openalex)
         :return: paper if found, or None
         """
         c = self.conn.cursor()
 
-        c.execute("SELECT * FROM papers WHERE %s=?" % id_type, (id_string,))
+        c.execute("SELECT p.* FROM id_crosswalk c JOIN papers p ON p.id=c.paper_id WHERE c.id_type=? AND c.id_value=?",
+                  (id_type, normalizeIdentifier(id_type, id_string)))
         paper_record = c.fetchone()
         if not paper_record:
             return None
@@ -271,6 +508,31 @@ class PaperStore:
             res.append(Paper.fromRecord(paper_record))
         return res
 
+    def getReadConnection(self):
+        """
+        Returns a connection to the db for the current thread, for reading from threads other than
+        the one the PaperStore was created in
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def findMatchCandidates(self, title):
+        """
+        Thread-safe lookup of the papers whose normalized title is the same as `title`'s
+
+        :return: list of Paper
+        """
+        norm_title = normalizeTitle(title or '')
+        if not norm_title:
+            return []
+
+        records = self.getReadConnection().execute("SELECT * FROM papers WHERE norm_title=?", (norm_title,))
+        return [Paper.fromRecord(r) for r in records]
+
     def findPaperByApproximateTitle(self, paper, ok_title_distance=0.35, ok_author_distance=0.1):
         """
         Very simple ngram-based similarity matching
@@ -335,21 +597,202 @@ class PaperStore:
 
         df = pd.DataFrame(to_add)
         df.to_sql("papers", self.conn, if_exists="append", index=False)
+        self.updateCrosswalk(papers)
 
-    def updatePapers(self, papers: list):
+    def updatePapers(self, papers: list, commit=True):
         for paper in papers:
-            values = paper.asDict()
             try:
+                values = paper.asDict()
                 self.conn.execute(
                     """REPLACE INTO papers (id, doi, pmid, scholarid, arxivid, authors, year, title, norm_title, venue, bib, extra_data) values (?,?,?,?,?,?,?,?,?,?,?,?)""",
                     (values['id'], values['doi'], values['pmid'], values['scholarid'],
                      values['arxivid'], values['authors'], values['year'],
                      values['title'], values['norm_title'], values['venue'],
                      values['bib'], values['extra_data']))
+                self.updateCrosswalk([paper], commit=False, ids=[values['id']])
             except Exception as e:
                 print(e.__class__.__name__, e)
+        if commit:
+            self.conn.commit()
+
+    def deletePapers(self, ids: list, commit=True):
+        """
+        Deletes papers, and the id_crosswalk entries that point to them in the same transaction
+
+        :param ids: list of paper ids
+        :param commit: commit when done
+        """
+        self.conn.executemany("DELETE FROM papers WHERE id=?", [(paper_id,) for paper_id in ids])
+        self.conn.executemany("DELETE FROM id_crosswalk WHERE paper_id=?", [(paper_id,) for paper_id in ids])
+        if commit:
+            self.conn.commit()
+
+    def addJobs(self, job_keys: list, stages: list):
+        """
+        Creates a pending job for every stage of every paper, leaving any job that already exists
+        as it is
+
+        :param job_keys: list of job keys, one per paper
+        :param stages: list of (stage name, source)
+        """
+        now = time()
+        self.conn.executemany(
+            """INSERT OR IGNORE INTO enrichment_jobs (job_key, stage, source, status, attempts, next_eligible, updated) 
+            values (?,?,?,?,0,0,?)""",
+            [(job_key, stage, source, JOB_PENDING, now) for job_key in job_keys for stage, source in stages])
+        self.conn.commit()
+
+    def getJob(self, job_key, stage):
+        """
+        :return: the job as a dict, or None
+        """
+        row = self.conn.execute("SELECT * FROM enrichment_jobs WHERE job_key=? AND stage=?",
+                                (job_key, stage)).fetchone()
+        return dict(row) if row else None
+
+    def claimJob(self, job_key, stage, source=None, lease=JOB_LEASE, max_attempts=JOB_MAX_ATTEMPTS):
+        """
+        Atomically claims a job for this process, if it is pending, due for a retry or its
+        previous worker's lease has run out
+
+        :return: tuple (claimed, job dict)
+        """
+        now = time()
+        with self.conn:
+            self.conn.execute(
+                """INSERT OR IGNORE INTO enrichment_jobs (job_key, stage, source, status, attempts, next_eligible, updated) 
+                values (?,?,?,?,0,0,?)""", (job_key, stage, source, JOB_PENDING, now))
+            claimed = self.conn.execute(
+                """UPDATE enrichment_jobs SET status=?, attempts=attempts+1, claimed_by=?, lease_until=?, updated=?
+                WHERE job_key=? AND stage=? AND attempts<? AND (
+                    (status IN (?,?) AND next_eligible<=?) OR (status=? AND lease_until<?))""",
+                (JOB_IN_FLIGHT, JOB_WORKER, now + lease, now, job_key, stage, max_attempts,
+                 JOB_PENDING, JOB_ERROR, now, JOB_IN_FLIGHT, now)).rowcount > 0
+
+        return claimed, self.getJob(job_key, stage)
+
+    def finishJob(self, job_key, stage, status, error=None, retry_delay=JOB_RETRY_DELAY, commit=True):
+        """
+        Records how a job went. Failed jobs become eligible again after `retry_delay` seconds,
+        doubled for every attempt so far.
+
+        :param status: one of JOB_OK, JOB_NOT_FOUND, JOB_ERROR, JOB_SKIPPED
+        :param error: description of the error, if any
+        """
+        now = time()
+        if status == JOB_ERROR:
+            self.conn.execute(
+                """UPDATE enrichment_jobs SET status=?, last_error=?, next_eligible=?+?*(1<<(max(attempts,1)-1)),
+                claimed_by=NULL, lease_until=NULL, updated=? WHERE job_key=? AND stage=?""",
+                (status, error, now, retry_delay, now, job_key, stage))
+        elif status == JOB_SKIPPED:
+            # a stage that isn't needed any more doesn't change what was recorded when it was
+            self.conn.execute(
+                """UPDATE enrichment_jobs SET status=?, updated=? WHERE job_key=? AND stage=? AND status IN (?,?)""",
+                (status, now, job_key, stage, JOB_PENDING, JOB_ERROR))
+        else:
+            self.conn.execute(
+                """UPDATE enrichment_jobs SET status=?, last_error=?, claimed_by=NULL, lease_until=NULL, updated=?
+                WHERE job_key=? AND stage=?""", (status, error, now, job_key, stage))
+        if commit:
             self.conn.commit()
 
+    def releaseDeadClaims(self):
+        """
+        Puts back jobs that were claimed by processes on this machine that are no longer running,
+        e.g. because they crashed or were killed, without waiting for their leases to run out
+
+        :return: number of jobs released
+        """
+        hostname = JOB_WORKER.rsplit(':', 1)[0]
+        rows = self.conn.execute("SELECT DISTINCT claimed_by FROM enrichment_jobs WHERE status=? AND claimed_by LIKE ?",
+                                 (JOB_IN_FLIGHT, hostname + ':%')).fetchall()
+        dead = []
+        for row in rows:
+            pid = int(row['claimed_by'].rsplit(':', 1)[1])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                dead.append(row['claimed_by'])
+            except OSError:
+                # it exists, we just can't signal it
+                pass
+
+        released = 0
+        for worker in dead:
+            released += self.conn.execute(
+                "UPDATE enrichment_jobs SET status=?, claimed_by=NULL, lease_until=NULL WHERE status=? AND claimed_by=?",
+                (JOB_PENDING, JOB_IN_FLIGHT, worker)).rowcount
+        self.conn.commit()
+        return released
+
+    def releaseClaims(self, worker=JOB_WORKER):
+        """
+        Puts back the jobs a worker has claimed but not finished, e.g. when a run is interrupted.
+        The attempts they were claimed for don't count.
+
+        :return: number of jobs released
+        """
+        released = self.conn.execute(
+            """UPDATE enrichment_jobs SET status=?, attempts=max(attempts-1,0), claimed_by=NULL, lease_until=NULL
+            WHERE status=? AND claimed_by=?""", (JOB_PENDING, JOB_IN_FLIGHT, worker)).rowcount
+        self.conn.commit()
+        return released
+
+    def releaseJob(self, job_key, stage, error=None, commit=True):
+        """
+        Puts back one claimed job without counting the attempt, e.g. when its source was
+        unavailable, so it is tried again in a later run
+
+        :param error: why it's being put back
+        """
+        self.conn.execute(
+            """UPDATE enrichment_jobs SET status=?, attempts=max(attempts-1,0), claimed_by=NULL, lease_until=NULL,
+            last_error=coalesce(?, last_error), updated=? WHERE job_key=? AND stage=? AND status=?""",
+            (JOB_PENDING, error, time(), job_key, stage, JOB_IN_FLIGHT))
+        if commit:
+            self.conn.commit()
+
+    def getUnfinishedJobKeys(self, max_attempts=JOB_MAX_ATTEMPTS):
+        """
+        :return: set of the job keys of papers that still have jobs to do
+        """
+        rows = self.conn.execute(
+            "SELECT DISTINCT job_key FROM enrichment_jobs WHERE status IN (?,?) OR (status=? AND attempts<?)",
+            (JOB_PENDING, JOB_IN_FLIGHT, JOB_ERROR, max_attempts))
+        return set(row['job_key'] for row in rows)
+
+    def getJobCounts(self):
+        """
+        :return: dict {(source, status): number of jobs}
+        """
+        rows = self.conn.execute("SELECT source, status, count(*) AS n FROM enrichment_jobs GROUP BY source, status")
+        return {(row['source'], row['status']): row['n'] for row in rows}
+
+    def recordSourceOutcome(self, stage, features, hit, seconds, commit=True):
+        """
+        Adds the outcome of one call to the running totals of an enrichment stage for papers
+        with the same features
+
+        :param stage: name of the stage
+        :param features: feature key of the paper, see search.source_planner.featureKey()
+        :param hit: True if the stage found something
+        :param seconds: how long it took
+        """
+        self.conn.execute(
+            """INSERT INTO source_stats (stage, features, calls, hits, seconds) VALUES (?,?,1,?,?)
+            ON CONFLICT(stage, features) DO UPDATE SET calls=calls+1, hits=hits+excluded.hits,
+            seconds=seconds+excluded.seconds""", (stage, features, int(bool(hit)), seconds))
+        if commit:
+            self.conn.commit()
+
+    def getSourceStats(self):
+        """
+        :return: list of (stage, features, calls, hits, seconds)
+        """
+        rows = self.conn.execute("SELECT stage, features, calls, hits, seconds FROM source_stats")
+        return [tuple(row) for row in rows]
+
     def createVirtualTable(self):
         self.conn.execute(
             """CREATE VIRTUAL TABLE IF NOT EXISTS papers_search USING fts5(id, norm_title, title);""")
@@ -376,15 +819,11 @@ class PaperStore:
             paper = Paper(result.bib, result.extra_data)
 
             paper_found = False
-            for id_type in ["doi", "pmid", "arxivid", "scholarid"]:
-                id_string = getattr(paper, id_type)
-                if id_string:
-                    paper_record = self.getPaper(id_string, id_type=id_type)
-                    if paper_record:
-                        result.paper = paper_record
-                        found.append(result)
-                        paper_found = True
-                        break
+            paper_record = self.findPaperByIdentifiers(paper)
+            if paper_record:
+                result.paper = paper_record
+                found.append(result)
+                paper_found = True
 
             if not paper_found and paper.title:
                 paper_records = self.findPapersByTitle(paper.title)
@@ -11,45 +11,99 @@ mapping = [
     ('volume', 'VL'),
 ]
 
+field_mapping = dict(mapping)
+
 type_mapping = {
     'Journal Article': 'article',
     'Thesis': 'thesis',
     'Book': 'book',
 }
 
+ENTRY_SEPARATOR = '<p>\n<p>\n<p>'
+
+# a single pattern that picks up every "<b>Field:</b> value<p>" pair and every link in one scan of an entry
+# (the value is captured in a lookahead so that links inside a field's value are still picked up)
+entry_regex = re.compile(r'<b>(?P<field>[^<:]+): ?<\/b> (?=(?P<value>.+?)<p>)|<A HREF="(?P<href>.+?)">')
+
+
+def parseEntry(entry):
+    """
+    Extracts all mapped fields and links from the text of a single EndNote HTML entry
+
+    :param entry: HTML text between two entry separators
+    :return: bib dict
+    """
+    new_bib = {}
+
+    for match in entry_regex.finditer(entry):
+        href = match.group('href')
+        if href:
+            if isPDFURL(href):
+                new_bib['eprint'] = href
+            else:
+                new_bib['url'] = href
+            continue
+
+        field = match.group('field')
+        if field == 'Reference Type':
+            new_bib['ENTRYTYPE'] = type_mapping.get(match.group('value'), 'article')
+        elif field in field_mapping:
+            new_bib[field_mapping[field]] = match.group('value')
+
+    return new_bib
+
+
+def iterRefsFromHTML(filename, chunk_size=1 << 20):
+    """
+    Lazily yields one bib dict per reference in an EndNote HTML export, reading the file in chunks.
+    Whatever comes before the <body> tag is skipped. Files that don't start out as HTML, or that
+    have no <body> tag, are read from the start.
+
+    :param filename: EndNote HTML file
+    :param chunk_size: number of characters to read at a time
+    """
+    buffer = ''
+    in_body = None
+    # how far into the buffer we know there's no '<body>', so it isn't searched again
+    searched = 0
 
-def loadRefsFromHTML(filename):
     with open(filename) as f:
-        html = f.read()
-
-    html = html[html.find('<body>') + 6:]
-    # html = re.sub('.+<body>', '', html, flags=re.DOTALL)
-    entries = re.split('(<p>\n<p>\n<p>)', html)
-    res = []
-
-    for entry in entries:
-        lines = entry.split('\n')
-        new_bib = {}
-
-        for line in lines:
-            match = re.search('<b>Reference Type: <\/b> (.+?)<p>', line)
-            if match:
-                if match.group(1) in type_mapping:
-                    new_bib['ENTRYTYPE'] = type_mapping[match.group(1)]
-                else:
-                    new_bib['ENTRYTYPE'] = 'article'
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
 
-            for bib_map in mapping:
-                match = re.search('<b>' + bib_map[0] + ':<\/b> (.+?)<p>', line)
-                if match:
-                    new_bib[bib_map[1]] = match.group(1)
+            if in_body is None:
+                # no <html> up front means there is no head to skip
+                in_body = '<html' not in chunk.lower()
 
-        for match in re.finditer('<A HREF="(.+?)">', entry):
-            if isPDFURL(match.group(1)):
-                new_bib['eprint'] = match.group(1)
+            if not in_body:
+                body_start = buffer.find('<body>', searched)
+                if body_start >= 0:
+                    buffer = buffer[body_start + 6:]
+                    in_body = True
+                elif chunk:
+                    # keep the whole buffer, in case there's no <body> tag at all
+                    searched = max(0, len(buffer) - 5)
+                    continue
+                else:
+                    # no <body> tag by the end of the file: all of it is the body
+                    in_body = True
+
+            entries = buffer.split(ENTRY_SEPARATOR)
+            if chunk:
+                # the last piece may be an incomplete entry, so wait for the next chunk
+                buffer = entries.pop()
             else:
-                new_bib['url'] = match.group(1)
+                buffer = ''
+
+            for entry in entries:
+                new_bib = parseEntry(entry)
+                if new_bib:
+                    yield new_bib
 
-        res.append(new_bib)
+            if not chunk:
+                return
 
-    return res
+
+def loadRefsFromHTML(filename):
+    return list(iterRefsFromHTML(filename))
@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+from time import time
+
+from db.data import CACHE_FILE
+
+# keys per SELECT in getMany(), well under sqlite's limit on query parameters
+GET_MANY_CHUNK_SIZE = 500
+
+
+class LookupCache:
+    """
+    A small sqlite-backed key -> text cache with expiry, used to remember the results of remote
+    lookups (e.g. DOI -> BibTeX) between runs.
+
+    A value of None is stored as a negative entry ("we looked, there is nothing there"), which
+    expires after `negative_ttl` seconds instead of `ttl`.
+    """
+
+    def __init__(self, table, ttl=180 * 24 * 3600, negative_ttl=7 * 24 * 3600, db_file=CACHE_FILE):
+        assert table.isidentifier()
+        self.table = table
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db_file = db_file
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn:
+            return
+
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "%s" (
+                         "key" text primary key,
+                         "value" text,
+                         "fetched" real
+                           )""" % self.table)
+        self.conn.commit()
+
+    @staticmethod
+    def normalizeKey(key):
+        return str(key).strip().lower()
+
+    def get(self, key):
+        """
+        Looks up a key
+
+        :param key: key to look up
+        :return: tuple (found, value). value is None for a cached negative result
+        """
+        found, _ = self.getMany([key])
+        if key in found:
+            return True, found[key]
+        return False, None
+
+    def getMany(self, keys):
+        """
+        Looks up many keys at once, a chunk of keys per query
+
+        :param keys: list of keys
+        :return: tuple (found, missing): dict {key: value} of valid entries, list of keys not found or expired
+        """
+        rows = {}
+        normalized = list(dict.fromkeys(self.normalizeKey(key) for key in keys))
+        with self.lock:
+            self.connect()
+            for start in range(0, len(normalized), GET_MANY_CHUNK_SIZE):
+                chunk = normalized[start:start + GET_MANY_CHUNK_SIZE]
+                query = 'SELECT key, value, fetched FROM "%s" WHERE key IN (%s)' % (self.table,
+                                                                                 ','.join('?' * len(chunk)))
+                for row_key, value, fetched in self.conn.execute(query, chunk):
+                    rows[row_key] = (value, fetched)
+
+        now = time()
+        found = {}
+        missing = []
+        for key in keys:
+            row = rows.get(self.normalizeKey(key))
+            if row:
+                value, fetched = row
+                ttl = self.ttl if value is not None else self.negative_ttl
+                if now - fetched <= ttl:
+                    found[key] = value
+                    continue
+            missing.append(key)
+        return found, missing
+
+    def set(self, key, value):
+        self.setMany([(key, value)])
+
+    def setMany(self, items):
+        """
+        Stores many (key, value) pairs in one transaction
+
+        :param items: list of (key, value) tuples. Use None as value for negative results
+        """
+        now = time()
+        with self.lock:
+            self.connect()
+            self.conn.executemany('REPLACE INTO "%s" (key, value, fetched) VALUES (?,?,?)' % self.table,
+                                  [(self.normalizeKey(key), value, now) for key, value in items])
+            self.conn.commit()
@@ -0,0 +1,169 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from itertools import groupby
+
+from db.data import CACHE_FILE
+from db.ref_utils import normalizeTitle
+
+REFERENCE_MIRROR_FILE = os.path.join(os.path.dirname(CACHE_FILE), "mirror.sqlite")
+
+
+def titleHash(title):
+    """
+    Short hash of a normalized title, used to index records by title
+    """
+    if not title:
+        return None
+    return hashlib.sha1(normalizeTitle(title).encode('utf-8')).hexdigest()[:16]
+
+
+class ReferenceMirror:
+    """
+    Local mirror of bibliographic records imported from public data dumps (Crossref, OpenAlex,
+    PubMed baseline...), indexed by DOI, PMID and title hash so that records can be found without
+    going to the network.
+
+    Records are stored in the same bib/extra_data shape the scrapers produce, one row per
+    (source, record id), so importing a newer dump over an older one replaces what changed.
+    """
+
+    def __init__(self, db_file=REFERENCE_MIRROR_FILE):
+        self.db_file = db_file
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn:
+            return
+
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "reference_works" (
+                         "source" text,
+                         "record_id" text,
+                         "doi" text,
+                         "pmid" text,
+                         "title_hash" text,
+                         "bib" text,
+                         "extra_data" text,
+                         PRIMARY KEY (source, record_id)
+                           )""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS idx_reference_works_doi ON reference_works(doi)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS idx_reference_works_pmid ON reference_works(pmid)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS idx_reference_works_title ON reference_works(title_hash)""")
+        self.conn.commit()
+
+    def prepareForBulkLoad(self):
+        with self.lock:
+            self.connect()
+            # the mirror can always be rebuilt from the dumps
+            self.conn.execute('PRAGMA synchronous=OFF')
+            self.conn.execute('PRAGMA journal_mode=MEMORY')
+
+    def addRecords(self, source, records):
+        """
+        Stores records, replacing any previous version of them
+
+        :param source: name of the dump they come from, e.g. "crossref"
+        :param records: list of (record id, SearchResult or Paper)
+        :return: number of records stored
+        """
+        rows = []
+        for record_id, result in records:
+            doi = result.bib.get('doi')
+            pmid = result.extra_data.get('pmid')
+            rows.append((source, str(record_id),
+                         doi.lower() if doi else None,
+                         str(pmid) if pmid else None,
+                         titleHash(result.bib.get('title')),
+                         json.dumps(result.bib),
+                         json.dumps(result.extra_data)))
+
+        with self.lock:
+            self.connect()
+            self.conn.executemany('REPLACE INTO reference_works (source, record_id, doi, pmid, title_hash, bib, '
+                                  'extra_data) VALUES (?,?,?,?,?,?,?)', rows)
+            self.conn.commit()
+        return len(rows)
+
+    def deleteRecords(self, source, record_ids):
+        with self.lock:
+            self.connect()
+            self.conn.executemany('DELETE FROM reference_works WHERE source=? AND record_id=?',
+                                  [(source, str(record_id)) for record_id in record_ids])
+            self.conn.commit()
+
+    def ingest(self, source, records, batch_size=5000):
+        """
+        Stores a stream of records `batch_size` at a time, so memory use doesn't depend on the
+        size of the dump
+
+        :param source: name of the dump they come from
+        :param records: iterable of (record id, SearchResult or Paper). A record of None deletes
+            that id, for dumps that come with deletions (e.g. PubMed update files)
+        :param batch_size: records per transaction
+        :return: number of records stored
+        """
+        self.prepareForBulkLoad()
+
+        count = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += self.storeBatch(source, batch)
+                batch = []
+                print('Ingested', count, 'records from', source)
+
+        if batch:
+            count += self.storeBatch(source, batch)
+        return count
+
+    def storeBatch(self, source, batch):
+        count = 0
+        # keep adds and deletes in the order they came in
+        for deleting, group in groupby(batch, key=lambda record: record[1] is None):
+            group = list(group)
+            if deleting:
+                self.deleteRecords(source, [record_id for record_id, _ in group])
+            else:
+                count += self.addRecords(source, group)
+        return count
+
+    def select(self, where, params):
+        # imported here because the search package imports this module
+        from search.base_search import SearchResult
+
+        with self.lock:
+            self.connect()
+            rows = self.conn.execute('SELECT source, bib, extra_data FROM reference_works WHERE ' + where,
+                                     params).fetchall()
+
+        return [SearchResult(index, json.loads(bib), source, json.loads(extra_data))
+                for index, (source, bib, extra_data) in enumerate(rows)]
+
+    def getByDOI(self, doi, source=None):
+        """
+        :return: list of SearchResult, one for each source that has the DOI
+        """
+        if source:
+            return self.select('doi=? AND source=?', (doi.strip().lower(), source))
+        return self.select('doi=?', (doi.strip().lower(),))
+
+    def getByPMID(self, pmid, source=None):
+        if source:
+            return self.select('pmid=? AND source=?', (str(pmid), source))
+        return self.select('pmid=?', (str(pmid),))
+
+    def findByTitle(self, title, source=None):
+        """
+        Returns the records whose normalized title is the same as `title`'s
+        """
+        title_hash = titleHash(title)
+        if not title_hash:
+            return []
+        if source:
+            return self.select('title_hash=? AND source=?', (title_hash, source))
+        return self.select('title_hash=?', (title_hash,))
@@ -0,0 +1,122 @@
+import os
+import gzip
+import json
+import sqlite3
+import threading
+
+from db.data import CACHE_FILE
+
+UNPAYWALL_SNAPSHOT_FILE = os.path.join(os.path.dirname(CACHE_FILE), "unpaywall.sqlite")
+
+# all we keep of each OA location
+OA_LOCATION_FIELDS = ['url', 'url_for_pdf', 'url_for_landing_page']
+
+
+def openDumpFile(filename):
+    """
+    Opens a dump file for reading text, decompressing it on the fly if it's gzipped
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+class UnpaywallSnapshot:
+    """
+    A DOI-keyed sqlite index of an Unpaywall data feed snapshot, so that open access locations
+    can be looked up locally instead of through the API.
+
+    Only the best OA location of each record is kept, and only its URLs. DOIs that are in the
+    snapshot but have no OA location are stored too, so we know not to ask the API about them.
+    """
+
+    def __init__(self, db_file=UNPAYWALL_SNAPSHOT_FILE):
+        self.db_file = db_file
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn:
+            return
+
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "oa_locations" (
+                         "doi" text primary key,
+                         "best_oa_location" text
+                           ) WITHOUT ROWID""")
+        self.conn.commit()
+
+    def ingest(self, filename, batch_size=10000):
+        """
+        Streams an Unpaywall JSONL(.gz) snapshot into the index. Records are read and written
+        `batch_size` at a time, so memory use doesn't depend on the size of the snapshot.
+        Ingesting a newer snapshot over an older one updates the records in both.
+
+        :param filename: path to the snapshot
+        :param batch_size: records per transaction
+        :return: number of records ingested
+        """
+        with self.lock:
+            self.connect()
+            # bulk loading, the file can always be rebuilt from the snapshot
+            self.conn.execute('PRAGMA synchronous=OFF')
+            self.conn.execute('PRAGMA journal_mode=MEMORY')
+
+        count = 0
+        batch = []
+        with openDumpFile(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    print('Skipping bad line in', filename, e)
+                    continue
+
+                if not record.get('doi'):
+                    continue
+
+                batch.append((record['doi'].lower(), self.compactLocation(record.get('best_oa_location'))))
+                if len(batch) >= batch_size:
+                    count += self.storeBatch(batch)
+                    batch = []
+                    print('Ingested', count, 'records')
+
+        if batch:
+            count += self.storeBatch(batch)
+
+        return count
+
+    @staticmethod
+    def compactLocation(location):
+        if not location:
+            return None
+
+        compact = {field: location[field] for field in OA_LOCATION_FIELDS if location.get(field)}
+        return json.dumps(compact, separators=(',', ':')) if compact else None
+
+    def storeBatch(self, batch):
+        with self.lock:
+            self.conn.executemany('REPLACE INTO oa_locations (doi, best_oa_location) VALUES (?,?)', batch)
+            self.conn.commit()
+        return len(batch)
+
+    def lookup(self, doi):
+        """
+        Looks up the best OA location for a DOI
+
+        :param doi: DOI
+        :return: tuple (found, location). location is a dict with the URLs of the best OA location,
+            or None if the snapshot has the DOI but no OA location for it
+        """
+        with self.lock:
+            self.connect()
+            row = self.conn.execute('SELECT best_oa_location FROM oa_locations WHERE doi=?',
+                                    (doi.strip().lower(),)).fetchone()
+        if not row:
+            return False, None
+
+        return True, json.loads(row[0]) if row[0] else None
@@ -1,21 +1,87 @@
 from base.general_utils import loadEntriesAndSetUp, writeOutputBib
 
 from search import enrichAndUpdateMetadata
+from search.metadata_harvest import shareRateLimitsAcrossProcesses, setOfflineMode, useLocalData, useLocalStore, \
+    getCoalescingStats, getLocalMatchStats, startMetricsStream, dumpMetrics
+from search.distributed import EnrichmentCoordinator, EnrichmentWorker
+from search.source_planner import EnrichmentPlanner, SourceStats
 from argparse import ArgumentParser
 from db.bibtex import writeBibtex
+import secrets
+
+
+def reportEnrichment(successful, unsuccessful):
+    print('Enriched %d papers, %d failed' % (len(successful), len(unsuccessful)))
 
 
 def main(conf):
+    useLocalData(not conf.no_response_cache, conf.unpaywall_snapshot, conf.mirror)
+
+    if conf.offline:
+        setOfflineMode(True)
+
+    if conf.rate_limit_file:
+        shareRateLimitsAcrossProcesses(conf.rate_limit_file)
+
+    if conf.worker:
+        EnrichmentWorker(conf.worker, conf.email, batch_size=conf.batch_size, workers_per_source=conf.workers,
+                         token=conf.token).run()
+        return
+
     paperstore, papers_to_add, papers_existing, all_papers = loadEntriesAndSetUp(conf.input, conf.cache, conf.max)
 
+    if paperstore and not conf.no_local_match:
+        useLocalStore(paperstore)
+
+    if conf.coordinate:
+        host, port = conf.coordinate.rsplit(':', 1)
+        to_enrich = papers_to_add + papers_existing if conf.force else papers_to_add
+        token = conf.token or secrets.token_urlsafe(16)
+        if not conf.token:
+            print('Workers need to be started with --token', token)
+        coordinator = EnrichmentCoordinator(to_enrich, paperstore, batch_size=conf.batch_size,
+                                            lease_seconds=conf.lease_seconds, token=token)
+        successful, unsuccessful = coordinator.serve(host, int(port))
+        writeOutputBib(papers_to_add + papers_existing, conf.output)
+        reportEnrichment(successful, unsuccessful)
+        return
+
+    planner = None
+    if conf.plan_sources and paperstore:
+        planner = EnrichmentPlanner(SourceStats.fromPaperStore(paperstore))
+
+    successful = []
+    unsuccessful = []
     if conf.cache:
-        successful, unsuccessful = enrichAndUpdateMetadata(papers_to_add, paperstore, conf.email)
+        # papers a previous run didn't get to finish are already in the cache, but not done
+        unfinished = paperstore.getUnfinishedJobKeys()
+        to_resume = [paper for paper in papers_existing if paper.extra_data.get('job_key') in unfinished]
+        if to_resume and not conf.force:
+            print('Resuming', len(to_resume), 'papers from a previous run')
+        else:
+            to_resume = []
+
+        successful, unsuccessful = enrichAndUpdateMetadata(papers_to_add + to_resume, paperstore, conf.email,
+                                                           workers_per_source=conf.workers, planner=planner)
 
     if conf.force and conf.cache:
-        enrichAndUpdateMetadata(papers_existing, paperstore, conf.email)
+        forced_successful, forced_unsuccessful = enrichAndUpdateMetadata(papers_existing, paperstore, conf.email,
+                                                                         workers_per_source=conf.workers,
+                                                                         planner=planner)
+        successful += forced_successful
+        unsuccessful += forced_unsuccessful
 
     all_papers = papers_to_add + papers_existing
     writeOutputBib(all_papers, conf.output)
+    reportEnrichment(successful, unsuccessful)
+
+    for source, stats in getCoalescingStats().items():
+        if stats['saved']:
+            print('%s: %d requests saved by reusing identical ones (%d made)' % (source, stats['saved'], stats['misses']))
+
+    for source, skipped in getLocalMatchStats().items():
+        if skipped:
+            print('%s: %d searches saved by matching papers locally' % (source, skipped))
 
 
 if __name__ == '__main__':
@@ -34,7 +100,45 @@ if __name__ == '__main__':
                         help='Use local cache for results')
     parser.add_argument('-f', '--force', type=bool, default=False,
                         help='Force updating metadata for cached results')
+    parser.add_argument('-rl', '--rate-limit-file', type=str,
+                        help='SQLite file in which to share rate limits with other processes running at the same time')
+    parser.add_argument('-us', '--unpaywall-snapshot', type=str,
+                        help='SQLite index of an Unpaywall snapshot built with import_unpaywall_snapshot.py. Used by default if it was built at the default path')
+    parser.add_argument('-mi', '--mirror', type=str,
+                        help='SQLite file of a local metadata mirror built with import_metadata_dump.py. Used by default if it was built at the default path')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Worker threads per source, so several papers can be looked up at once. 0 looks them up one at a time')
+    parser.add_argument('-nl', '--no-local-match', action='store_true',
+                        help='Always search the remote sources, even for papers that match one already in the cache')
+    parser.add_argument('-co', '--coordinate', type=str,
+                        help='Hand the papers out to workers on other machines, listening on HOST:PORT (e.g. 0.0.0.0:8765)')
+    parser.add_argument('-tk', '--token', type=str,
+                        help='Secret shared by the coordinator and its workers. The coordinator makes one up and prints it if not given')
+    parser.add_argument('-wk', '--worker', type=str,
+                        help='Work for the coordinator at this URL (e.g. http://host:8765) instead of reading an input file')
+    parser.add_argument('-bs', '--batch-size', type=int, default=20,
+                        help='Papers per batch handed out to a worker')
+    parser.add_argument('-ls', '--lease-seconds', type=int, default=300,
+                        help='Seconds a worker has to finish or renew a batch before it is given to another worker')
+    parser.add_argument('-pl', '--plan-sources', action='store_true',
+                        help='Order and skip the sources for each paper by how well they have done for similar papers before')
+    parser.add_argument('-off', '--offline', action='store_true',
+                        help='Only use responses already in the local HTTP response cache, never go to the network')
+    parser.add_argument('-nrc', '--no-response-cache', action='store_true',
+                        help='Don\'t keep HTTP responses in the local response cache')
+    parser.add_argument('-mo', '--metrics-output', type=str, default='metrics.json',
+                        help='JSON file the request metrics of every source are written to at the end')
+    parser.add_argument('-mst', '--metrics-stream', type=str,
+                        help='JSON lines file to append the request metrics to while running')
+    parser.add_argument('-msi', '--metrics-interval', type=float, default=30,
+                        help='Seconds between the metrics appended to --metrics-stream')
 
     conf = parser.parse_args()
 
-    main(conf)
+    stream = startMetricsStream(conf.metrics_stream, conf.metrics_interval) if conf.metrics_stream else None
+    try:
+        main(conf)
+    finally:
+        if stream:
+            stream.stop()
+        dumpMetrics(conf.metrics_output)
@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
 
 from db.data import PaperStore, Paper
-from db.endnote_html import loadRefsFromHTML
+from db.endnote_html import iterRefsFromHTML
 from search import getSearchResultsFromBib
 from db.ref_utils import addUrlIfNewWithType
 
@@ -12,7 +12,7 @@ def main(conf):
     else:
         paperstore = None
 
-    bib_entries = loadRefsFromHTML(conf.input)
+    bib_entries = iterRefsFromHTML(conf.input)
 
     results = getSearchResultsFromBib(bib_entries)
 
@@ -0,0 +1,32 @@
+from argparse import ArgumentParser
+
+from db.reference_mirror import ReferenceMirror, REFERENCE_MIRROR_FILE
+from search.dump_import import importDump, DUMP_READERS
+
+
+def main(conf):
+    mirror = ReferenceMirror(conf.db_file)
+
+    total = 0
+    for filename in conf.input:
+        count = importDump(mirror, filename, conf.source)
+        print('Imported', count, 'records from', filename)
+        total += count
+
+    print('Total records imported', total)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Imports Crossref or OpenAlex metadata dumps (JSON/JSONL, optionally gzipped) into a local mirror that is consulted before the remote APIs')
+
+    parser.add_argument('-i', '--input', type=str, nargs='+',
+                        help='Dump file(s) to import')
+    parser.add_argument('-s', '--source', type=str, choices=sorted(DUMP_READERS.keys()),
+                        help='Where the dump comes from')
+    parser.add_argument('-d', '--db-file', type=str, default=REFERENCE_MIRROR_FILE,
+                        help='SQLite file of the local mirror')
+
+    conf = parser.parse_args()
+
+    main(conf)
@@ -0,0 +1,58 @@
+import os
+import gzip
+from glob import glob
+from argparse import ArgumentParser
+
+from db.reference_mirror import ReferenceMirror, REFERENCE_MIRROR_FILE
+from search.xml_parsing import iterPubMedUpdates
+
+
+def listBaselineFiles(paths):
+    """
+    Expands directories into the PubMed XML files in them. Files are sorted by name, which for
+    the NLM file naming puts the baseline before the updates and the updates in order
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(glob(os.path.join(path, '*.xml.gz')) + glob(os.path.join(path, '*.xml')))
+        else:
+            filenames.append(path)
+    return sorted(filenames, key=os.path.basename)
+
+
+def importPubMedFile(mirror, filename):
+    """
+    Streams one PubMed baseline or update file into the mirror, applying its deletions
+
+    :return: number of articles imported
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        return mirror.ingest('pubmed', iterPubMedUpdates(f))
+
+
+def main(conf):
+    mirror = ReferenceMirror(conf.db_file)
+
+    total = 0
+    for filename in listBaselineFiles(conf.input):
+        count = importPubMedFile(mirror, filename)
+        print('Imported', count, 'articles from', filename)
+        total += count
+
+    print('Total articles imported', total)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Imports PubMed annual baseline and daily update files into a local mirror that PubMed lookups check before E-utilities')
+
+    parser.add_argument('-i', '--input', type=str, nargs='+',
+                        help='PubMed XML file(s) (optionally gzipped), or directories containing them')
+    parser.add_argument('-d', '--db-file', type=str, default=REFERENCE_MIRROR_FILE,
+                        help='SQLite file of the local mirror')
+
+    conf = parser.parse_args()
+
+    main(conf)
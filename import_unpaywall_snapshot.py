@@ -0,0 +1,29 @@
+from argparse import ArgumentParser
+
+from db.unpaywall_snapshot import UnpaywallSnapshot, UNPAYWALL_SNAPSHOT_FILE
+
+
+def main(conf):
+    snapshot = UnpaywallSnapshot(conf.db_file)
+
+    total = 0
+    for filename in conf.input:
+        count = snapshot.ingest(filename)
+        print('Ingested', count, 'records from', filename)
+        total += count
+
+    print('Total records ingested', total)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Indexes an Unpaywall data feed snapshot (JSONL, optionally gzipped) so open access links can be looked up locally')
+
+    parser.add_argument('-i', '--input', type=str, nargs='+',
+                        help='Unpaywall snapshot file(s)')
+    parser.add_argument('-d', '--db-file', type=str, default=UNPAYWALL_SNAPSHOT_FILE,
+                        help='SQLite file to write the index to')
+
+    conf = parser.parse_args()
+
+    main(conf)
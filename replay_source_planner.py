@@ -0,0 +1,64 @@
+from argparse import ArgumentParser
+
+from base.general_utils import loadEntriesAndSetUp
+from search.metadata_harvest import ENRICHMENT_STAGES, useLocalData, startMetricsStream, dumpMetrics
+from search.source_planner import recordCorpus, loadCorpus, evaluatePlanner
+
+
+def printTotals(label, totals):
+    print('%s: %d papers, %d calls, %.1f seconds, %d complete records, %s calls per complete record' % (
+        label, totals['papers'], totals['calls'], totals['seconds'], totals['completed'],
+        '%.2f' % totals['calls_per_completed'] if totals['calls_per_completed'] else 'n/a'))
+
+
+def main(conf):
+    if conf.input:
+        # so recording the same papers again doesn't make every request again
+        useLocalData()
+        paperstore, papers_to_add, papers_existing, all_papers = loadEntriesAndSetUp(conf.input, False, conf.max)
+        count = recordCorpus(all_papers, ENRICHMENT_STAGES, conf.email, conf.corpus)
+        print('Recorded', count, 'papers to', conf.corpus)
+
+    records = loadCorpus(conf.corpus)
+    if len(records) < 2:
+        print('Not enough papers in the corpus to evaluate the planner')
+        return
+
+    usual, planned = evaluatePlanner(records, ENRICHMENT_STAGES, min_samples=conf.min_samples,
+                                     skip_below=conf.skip_below)
+    printTotals('Usual order', usual)
+    printTotals('Planned    ', planned)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Records what every metadata source finds for a sample of papers, and replays it to compare the usual order of the sources with the one the source planner chooses')
+
+    parser.add_argument('-c', '--corpus', type=str, default='source_corpus.jsonl',
+                        help='JSONL file the corpus is recorded to and replayed from')
+    parser.add_argument('-i', '--input', type=str,
+                        help='Input bib file name to record papers from. Without it the corpus is only replayed')
+    parser.add_argument('-m', '--max', type=int, default=100,
+                        help='Maximum number of papers to record')
+    parser.add_argument('-em', '--email', type=str,
+                        help='Email to serve as identity to API endpoints')
+    parser.add_argument('-ms', '--min-samples', type=int, default=20,
+                        help='Calls needed before the numbers for a group of papers are trusted')
+    parser.add_argument('-sb', '--skip-below', type=float, default=0.02,
+                        help='Sources with a lower hit rate than this for a group of papers are skipped')
+    parser.add_argument('-mo', '--metrics-output', type=str, default='metrics.json',
+                        help='JSON file the request metrics of every source are written to at the end')
+    parser.add_argument('-mst', '--metrics-stream', type=str,
+                        help='JSON lines file to append the request metrics to while running')
+    parser.add_argument('-msi', '--metrics-interval', type=float, default=30,
+                        help='Seconds between the metrics appended to --metrics-stream')
+
+    conf = parser.parse_args()
+
+    stream = startMetricsStream(conf.metrics_stream, conf.metrics_interval) if conf.metrics_stream else None
+    try:
+        main(conf)
+    finally:
+        if stream:
+            stream.stop()
+        dumpMetrics(conf.metrics_output)
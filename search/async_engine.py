@@ -0,0 +1,136 @@
+import asyncio
+import json
+import weakref
+from contextlib import asynccontextmanager
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from base.http_session import DEFAULT_TIMEOUT, RETRY_STATUS_CODES
+
+
+class AsyncResponse:
+    """
+    The bits of a requests.Response that the scrapers use, filled in from an aiohttp response
+    """
+
+    def __init__(self, url, status_code, headers, content, retries=0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # how many times the request was retried to get this response
+        self.retries = retries
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncEngine:
+    """
+    Owns one aiohttp session per event loop and performs requests with retries and backoff,
+    mirroring what createSession() sets up for the sync requests path.
+
+    A loop's session only lives as long as some opened() block on that loop, so that every
+    asyncio.run() doesn't leave a session behind. fetch() opens one itself, so calls made outside
+    of a block get a session each.
+
+    This is the engine of the scrapers' async API (asearch(), agetMetadata(), ...), which is for
+    code using this package as a library: the scripts and the enrichment scheduler run on the
+    sync requests path.
+    """
+
+    def __init__(self, pool_size=10, max_retries=3, backoff_factor=0.5, timeout=DEFAULT_TIMEOUT,
+                 retry_status_codes=RETRY_STATUS_CODES):
+        self.pool_size = pool_size
+        self.retry_status_codes = retry_status_codes
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        # event loop -> [session or None, number of opened() blocks using it]
+        self.sessions = weakref.WeakKeyDictionary()
+
+    @asynccontextmanager
+    async def opened(self):
+        """
+        Keeps the running loop's session open until the block ends, closing it when the last
+        block using it on that loop is done
+        """
+        loop = asyncio.get_running_loop()
+        entry = self.sessions.get(loop)
+        if entry is None:
+            entry = self.sessions[loop] = [None, 0]
+        entry[1] += 1
+        try:
+            yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                if self.sessions.get(loop) is entry:
+                    del self.sessions[loop]
+                if entry[0] is not None and not entry[0].closed:
+                    await entry[0].close()
+
+    def getSession(self):
+        """
+        Returns the running loop's session, which has to be inside an opened() block
+        """
+        if aiohttp is None:
+            raise ImportError('The async scraping engine needs aiohttp: pip install aiohttp')
+
+        entry = self.sessions[asyncio.get_running_loop()]
+        if entry[0] is None or entry[0].closed:
+            connect_timeout, read_timeout = self.timeout
+            entry[0] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+        return entry[0]
+
+    async def fetch(self, url, headers=None, data=None, post=False):
+        """
+        Makes a request, retrying with exponential backoff on `retry_status_codes` responses
+
+        :return: AsyncResponse
+        """
+        async with self.opened():
+            return await self.fetchWithSession(url, headers, data, post)
+
+    async def fetchWithSession(self, url, headers=None, data=None, post=False):
+        session = self.getSession()
+        retries = 0
+
+        while True:
+            if post:
+                context = session.post(url, json=data, headers=headers)
+            else:
+                context = session.get(url, headers=headers)
+
+            async with context as r:
+                content = await r.read()
+                response = AsyncResponse(str(r.url), r.status, r.headers, content, retries)
+
+            if response.status_code not in self.retry_status_codes or retries >= self.max_retries:
+                return response
+
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                wait = self.backoff_factor * (2 ** retries)
+
+            retries += 1
+            await asyncio.sleep(wait)
+
+    async def close(self):
+        """
+        Closes the running loop's session now, even if opened() blocks are still using it
+        """
+        entry = self.sessions.get(asyncio.get_running_loop())
+        if entry is not None and entry[0] is not None and not entry[0].closed:
+            await entry[0].close()
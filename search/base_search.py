@@ -1,4 +1,5 @@
 import re
+from itertools import islice
 from db.data import Paper
 
 MAX_RESULTS = 100
@@ -30,8 +31,14 @@ class SearchResult(Paper):
 
 
 def getSearchResultsFromBib(bib_entries, max_results=100000000):
-    results = []
-    for index, bib in enumerate(bib_entries[:max_results]):
+    """
+    Lazily turns bib entries into SearchResults, so that a large input file is never held in
+    memory twice
+
+    :param bib_entries: iterable of bib dicts, e.g. the generator readCSVFile() returns
+    :param max_results: stop after this many entries
+    """
+    for index, bib in enumerate(islice(bib_entries, max_results)):
         res = SearchResult(index, bib, 'bibfile', {})
         if bib.get('note'):
             match = re.search('(\d+)\scites:\s.+?scholar\?cites\=(\d+)', bib['note'])
@@ -39,6 +46,4 @@ def getSearchResultsFromBib(bib_entries, max_results=100000000):
                 res.source = 'scholar'
                 res.extra_data['scholarid'] = match.group(2)
                 res.extra_data['citedby'] = match.group(1)
-        results.append(res)
-
-    return results
+        yield res
@@ -0,0 +1,113 @@
+import threading
+from time import time
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+class SourceUnavailable(Exception):
+    """
+    Raised instead of making a request to a source whose circuit breaker is open. Like
+    OfflineCacheMiss it isn't a failed lookup: the paper should be tried on that source again
+    later, so nothing is marked as done.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a source that is down, so that every paper doesn't pay for the
+    failed attempts.
+
+    After `failure_threshold` failures in a row (exceptions like timeouts and connection errors,
+    or 5xx responses after the session's own retries) the breaker opens and check() raises
+    SourceUnavailable straight away. Once `cool_down` seconds have passed it half-opens: a single
+    request is let through to probe the source. If it works the breaker closes again, if not it
+    stays open for twice as long as the last time, up to `max_cool_down`.
+
+    Safe to share between threads and asyncio tasks.
+    """
+
+    def __init__(self, name, failure_threshold=5, cool_down=30., max_cool_down=600.):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cool_down = cool_down
+        self.max_cool_down = max_cool_down
+        self.lock = threading.Lock()
+
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.cool_down = cool_down
+        self.opened_at = 0.
+        self.probe_in_flight = False
+
+        self.num_opened = 0
+        self.num_rejected = 0
+
+    def isAvailable(self):
+        """
+        Returns True if a request to the source could go through now, without taking the probe
+        """
+        with self.lock:
+            if self.state == BREAKER_OPEN:
+                return time() - self.opened_at >= self.cool_down
+            if self.state == BREAKER_HALF_OPEN:
+                return not self.probe_in_flight
+            return True
+
+    def check(self):
+        """
+        Called before every request
+
+        :raises SourceUnavailable: if the breaker is open, or half-open with the probe out
+        """
+        with self.lock:
+            if self.state == BREAKER_OPEN and time() - self.opened_at >= self.cool_down:
+                self.state = BREAKER_HALF_OPEN
+                self.probe_in_flight = False
+
+            if self.state == BREAKER_CLOSED:
+                return
+
+            if self.state == BREAKER_HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+
+            self.num_rejected += 1
+            wait = max(0., self.cool_down - (time() - self.opened_at))
+            raise SourceUnavailable('%s is unavailable, trying again in %d seconds' % (self.name, wait))
+
+    def recordSuccess(self):
+        with self.lock:
+            if self.state != BREAKER_CLOSED:
+                print('%s is back, closing its circuit breaker' % self.name)
+            self.state = BREAKER_CLOSED
+            self.consecutive_failures = 0
+            self.cool_down = self.base_cool_down
+            self.probe_in_flight = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == BREAKER_HALF_OPEN:
+                self.cool_down = min(self.max_cool_down, self.cool_down * 2)
+                self.open()
+            elif self.state == BREAKER_CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self.open()
+
+    def open(self):
+        print('%s failed %d times in a row, skipping it for %d seconds' % (
+            self.name, self.consecutive_failures, self.cool_down))
+        self.state = BREAKER_OPEN
+        self.opened_at = time()
+        self.probe_in_flight = False
+        self.num_opened += 1
+
+    def getState(self):
+        with self.lock:
+            return {'state': self.state,
+                    'consecutive_failures': self.consecutive_failures,
+                    'cool_down': self.cool_down,
+                    'opened': self.num_opened,
+                    'rejected': self.num_rejected}
@@ -0,0 +1,151 @@
+import copy
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class RequestCoalescer:
+    """
+    Makes identical lookups to a source share one call. A lookup that is already in flight is
+    waited for instead of being made again (from threads with run(), from asyncio tasks with
+    arun()). Results that are small and worth keeping, like the normalized results of a title
+    search, can also be remembered: the most recent `max_recent` of them are kept in memory, so
+    a repeat later in the same run is answered straight away. HTTP responses shouldn't be, the
+    ResponseCache already replays them from disk.
+
+    Keeps count of how many calls it saved: `hits` were answered from the recent results and
+    `shared` joined a call that was in flight. `misses` had to make the call.
+    """
+
+    def __init__(self, name, max_recent=500):
+        self.name = name
+        self.max_recent = max_recent
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()
+        self.in_flight = {}
+        self.async_in_flight = {}
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    def getRecent(self, key):
+        """
+        :return: tuple (found, value)
+        """
+        with self.lock:
+            if key not in self.recent:
+                return False, None
+            self.recent.move_to_end(key)
+            self.hits += 1
+            return True, self.recent[key]
+
+    def putRecent(self, key, value):
+        with self.lock:
+            self.recent[key] = value
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+
+    def getResult(self, key):
+        """
+        Returns a copy of a result stored with putResult(), for results the caller may modify
+
+        :return: tuple (found, value)
+        """
+        found, value = self.getRecent(key)
+        return found, copy.deepcopy(value) if found else None
+
+    def putResult(self, key, value):
+        self.putRecent(key, copy.deepcopy(value))
+
+    def run(self, key, fetch, remember=None):
+        """
+        Returns the result of `fetch()` for `key`, calling it only if no identical call is in
+        flight or was made recently
+
+        :param key: anything hashable that identifies the call
+        :param fetch: function that makes the call
+        :param remember: function(result) that says if a result should be kept for later calls,
+            or None to only share results while they are in flight
+        """
+        found, value = self.getRecent(key)
+        if found:
+            return value
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+            if remember and remember(value):
+                self.putRecent(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    async def arun(self, key, fetch, remember=None):
+        """
+        Async version of run(): `fetch` is a function that returns an awaitable
+        """
+        found, value = self.getRecent(key)
+        if found:
+            return value
+
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        with self.lock:
+            future = self.async_in_flight.get(flight_key)
+            owner = future is None
+            if owner:
+                future = loop.create_future()
+                self.async_in_flight[flight_key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not owner:
+            return await asyncio.shield(future)
+
+        try:
+            value = await fetch()
+            if remember and remember(value):
+                self.putRecent(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody may be waiting for it
+            future.exception()
+            raise
+        finally:
+            with self.lock:
+                self.async_in_flight.pop(flight_key, None)
+
+    def getStats(self):
+        """
+        :return: dict with the hits, shared calls, misses and calls saved so far
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'shared': self.shared,
+                    'misses': self.misses,
+                    'saved': self.hits + self.shared}
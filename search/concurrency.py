@@ -0,0 +1,152 @@
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from time import time
+
+THROTTLE_STATUS_CODES = [429, 503]
+
+
+def parseRetryAfter(value):
+    """
+    Parses a Retry-After header, which can be a number of seconds or an HTTP date
+
+    :return: number of seconds to wait, or None
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD (additive increase, multiplicative decrease) control of how many requests can be in
+    flight to a source at the same time.
+
+    While responses are healthy the limit grows by about one slot for every `limit` successful
+    responses. A throttling response (429/503) or a response much slower than the usual latency
+    cuts the limit by `decrease_factor`, at most once per round trip so that a burst of
+    failures from the same congestion event only counts once. Retry-After is honoured by not
+    handing out any slots until it has passed.
+
+    Works for both threads (acquire()) and asyncio tasks (aacquire()).
+    """
+
+    def __init__(self, name, initial_limit=2, min_limit=1, max_limit=16, decrease_factor=0.5,
+                 latency_factor=3.0, default_backoff=5., max_backoff=120.):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.default_backoff = default_backoff
+        self.max_backoff = max_backoff
+
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.last_decrease = 0.
+        self.backoff_until = 0.
+        self.consecutive_throttles = 0
+
+        self.num_increases = 0
+        self.num_decreases = 0
+        self.num_throttled = 0
+
+        self.condition = threading.Condition()
+
+    def tryAcquire(self):
+        """
+        Takes a slot if one is free
+
+        :return: tuple (acquired, seconds to wait before trying again)
+        """
+        with self.condition:
+            now = time()
+            if now < self.backoff_until:
+                return False, self.backoff_until - now
+            if self.in_flight >= int(self.limit):
+                return False, None
+
+            self.in_flight += 1
+            return True, 0.
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                acquired, wait = self.tryAcquire()
+                if acquired:
+                    return
+                self.condition.wait(timeout=wait)
+
+    async def aacquire(self):
+        while True:
+            acquired, wait = self.tryAcquire()
+            if acquired:
+                return
+            await asyncio.sleep(wait if wait else 0.05)
+
+    def release(self, status_code=None, latency=None, retry_after=None):
+        """
+        Gives back a slot and adjusts the limit based on how the request went
+
+        :param status_code: HTTP status code, or None if the request failed without a response
+        :param latency: request duration in seconds
+        :param retry_after: value of the Retry-After header, if any
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time()
+
+            if status_code in THROTTLE_STATUS_CODES:
+                self.num_throttled += 1
+                self.consecutive_throttles += 1
+                wait = parseRetryAfter(retry_after)
+                if wait is None:
+                    wait = min(self.max_backoff, self.default_backoff * 2 ** (self.consecutive_throttles - 1))
+                self.backoff_until = max(self.backoff_until, now + wait)
+                self.decrease(now)
+
+            elif status_code is not None and latency is not None:
+                self.consecutive_throttles = 0
+                if self.baseline_latency and latency > self.latency_factor * self.baseline_latency:
+                    self.decrease(now)
+                else:
+                    # exponentially weighted average of healthy latencies
+                    if self.baseline_latency is None:
+                        self.baseline_latency = latency
+                    else:
+                        self.baseline_latency = 0.9 * self.baseline_latency + 0.1 * latency
+
+                    if status_code < 500 and self.limit < self.max_limit:
+                        self.limit = min(self.max_limit, self.limit + 1. / self.limit)
+                        self.num_increases += 1
+
+            self.condition.notify_all()
+
+    def decrease(self, now):
+        round_trip = self.baseline_latency or 1.
+        if now - self.last_decrease < round_trip:
+            return
+
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self.last_decrease = now
+        self.num_decreases += 1
+
+    def getState(self):
+        with self.condition:
+            return {'source': self.name,
+                    'limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'baseline_latency': self.baseline_latency,
+                    'backoff_seconds_left': max(0., self.backoff_until - time()),
+                    'increases': self.num_increases,
+                    'decreases': self.num_decreases,
+                    'throttled': self.num_throttled}
@@ -0,0 +1,363 @@
+import hmac
+import json
+import uuid
+import socket
+import threading
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from time import time, sleep
+
+import requests
+
+from db.data import Paper
+from base.http_session import createSession
+from .metadata_harvest import enrichAndUpdateMetadata, setRateShares, all_scrapers
+
+# seconds a worker has to send back a batch before its papers are given to another worker
+DEFAULT_LEASE_SECONDS = 300
+# seconds a worker waits before asking again when all the papers are leased out
+POLL_INTERVAL = 5
+# seconds a worker waits before retrying a call to the coordinator that failed, doubling each time
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+# header the workers send the coordinator's token in
+TOKEN_HEADER = 'X-Enrichment-Token'
+
+
+class Lease:
+    def __init__(self, worker, keys, lease_seconds):
+        self.id = uuid.uuid4().hex
+        self.worker = worker
+        self.keys = keys
+        self.lease_seconds = lease_seconds
+        self.expires = time() + lease_seconds
+
+    def renew(self):
+        self.expires = time() + self.lease_seconds
+
+
+class EnrichmentCoordinator:
+    """
+    Hands out batches of papers to enrichment workers on other machines (see EnrichmentWorker)
+    and saves what they send back.
+
+    Every batch is leased to a worker for `lease_seconds`. Workers renew their leases while they
+    work; if a lease runs out, because the worker died or got stuck, its papers go back into the
+    queue for someone else. Each source's rate limit is split evenly between the workers that
+    have been in touch during the last lease period.
+
+    The protocol is JSON over HTTP, one POST per call:
+        /lease {"worker", "max_papers"} -> {"lease_id", "lease_seconds", "papers", "rate_shares"}
+            or {"papers": [], "wait": seconds} if all papers are leased out, or {"done": true}
+        /renew {"lease_id"} -> {"ok", "rate_shares"}
+        /complete {"lease_id", "results": [{"key", "bib", "extra_data", "error"}]} -> {"ok", "stored"}
+
+    If a `token` is given, calls that don't send it in the X-Enrichment-Token header are refused,
+    since whatever comes back through /complete is written to the PaperStore.
+
+    Requests are handled one at a time on the thread that called serve(), so the PaperStore is
+    only ever used from that thread.
+    """
+
+    def __init__(self, papers, paperstore, batch_size=20, lease_seconds=DEFAULT_LEASE_SECONDS, token=None):
+        """
+        :param papers: list of Paper to enrich
+        :param paperstore: PaperStore to save the enriched papers in, or None
+        :param batch_size: max papers per lease
+        :param lease_seconds: how long a worker has to finish or renew a batch
+        :param token: secret the workers have to send, or None to accept any caller
+        """
+        self.papers = {str(index): paper for index, paper in enumerate(papers)}
+        self.paperstore = paperstore
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.token = token
+
+        self.pending = deque(self.papers.keys())
+        self.leases = {}
+        self.completed = set()
+        self.failed = set()
+        self.workers = {}
+
+    @property
+    def finished(self):
+        return len(self.completed) == len(self.papers)
+
+    def getRateShares(self):
+        active = [worker for worker, last_seen in self.workers.items() if last_seen > time() - self.lease_seconds]
+        share = 1. / max(len(active), 1)
+        return {scraper.source_name: share for scraper in all_scrapers}
+
+    def reclaimExpiredLeases(self):
+        """
+        Puts the unfinished papers of leases that have run out back at the front of the queue
+        """
+        now = time()
+        for lease in [lease for lease in self.leases.values() if lease.expires < now]:
+            del self.leases[lease.id]
+            keys = [key for key in lease.keys if key not in self.completed]
+            if keys:
+                print('Lease of', lease.worker, 'ran out, requeueing', len(keys), 'papers')
+                self.pending.extendleft(reversed(keys))
+
+    def lease(self, request):
+        worker = request.get('worker', 'unknown')
+        self.workers[worker] = time()
+        self.reclaimExpiredLeases()
+
+        if self.finished:
+            return {'done': True}
+
+        keys = []
+        while self.pending and len(keys) < min(request.get('max_papers') or self.batch_size, self.batch_size):
+            key = self.pending.popleft()
+            if key not in self.completed:
+                keys.append(key)
+
+        if not keys:
+            return {'papers': [], 'wait': POLL_INTERVAL}
+
+        lease = Lease(worker, keys, self.lease_seconds)
+        self.leases[lease.id] = lease
+        return {'lease_id': lease.id,
+                'lease_seconds': self.lease_seconds,
+                'papers': [{'key': key, 'bib': self.papers[key].bib, 'extra_data': self.papers[key].extra_data}
+                           for key in keys],
+                'rate_shares': self.getRateShares()}
+
+    def renew(self, request):
+        lease = self.leases.get(request.get('lease_id'))
+        if not lease:
+            return {'ok': False}
+
+        self.workers[lease.worker] = time()
+        lease.renew()
+        return {'ok': True, 'rate_shares': self.getRateShares()}
+
+    def complete(self, request):
+        lease = self.leases.pop(request.get('lease_id'), None)
+        if lease:
+            self.workers[lease.worker] = time()
+
+        to_save = []
+        for result in request.get('results', []):
+            key = result['key']
+            # the first result back wins if a lease ran out and the batch was done twice
+            if key not in self.papers or key in self.completed:
+                continue
+
+            paper = self.papers[key]
+            paper.bib = result['bib']
+            paper.extra_data = result['extra_data']
+            self.completed.add(key)
+            if result.get('error'):
+                print('Worker failed on', paper.title, result['error'])
+                self.failed.add(key)
+            to_save.append(paper)
+
+        if self.paperstore and to_save:
+            self.paperstore.updatePapers(to_save)
+
+        # whatever the worker didn't send back is up for grabs again
+        if lease:
+            missing = [key for key in lease.keys if key not in self.completed]
+            self.pending.extendleft(reversed(missing))
+
+        print('Completed %d/%d papers' % (len(self.completed), len(self.papers)))
+        return {'ok': True, 'stored': len(to_save)}
+
+    def handle(self, path, request):
+        if path == '/lease':
+            return self.lease(request)
+        elif path == '/renew':
+            return self.renew(request)
+        elif path == '/complete':
+            return self.complete(request)
+        return None
+
+    def isAuthorized(self, token):
+        if not self.token:
+            return True
+        return hmac.compare_digest((token or '').encode('utf-8'), self.token.encode('utf-8'))
+
+    def makeServer(self, host, port):
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not coordinator.isAuthorized(self.headers.get(TOKEN_HEADER)):
+                    print('Refused call to', self.path, 'from', self.client_address[0], 'without the right token')
+                    self.send_error(403)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    response = coordinator.handle(self.path, json.loads(self.rfile.read(length) or b'{}'))
+                except Exception as e:
+                    print('Error handling', self.path, e.__class__.__name__, e)
+                    self.send_error(500, str(e))
+                    return
+
+                if response is None:
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return HTTPServer((host, port), Handler)
+
+    def serve(self, host='127.0.0.1', port=8765, linger=2 * POLL_INTERVAL):
+        """
+        Serves workers until every paper is done, and then for another `linger` seconds so the
+        workers that are waiting hear that it's over
+
+        :param host: address to listen on. Only this machine can connect by default, use e.g.
+            0.0.0.0 and a token for workers on other machines
+
+        :return: tuple (successful, unsuccessful) lists of Paper
+        """
+        server = self.makeServer(host, port)
+        server.timeout = 1
+        print('Coordinating enrichment of %d papers on %s:%d' % (len(self.papers), host, server.server_port))
+
+        try:
+            while not self.finished:
+                server.handle_request()
+                self.reclaimExpiredLeases()
+
+            stop_at = time() + linger
+            while time() < stop_at:
+                server.handle_request()
+        finally:
+            server.server_close()
+
+        successful = [paper for key, paper in self.papers.items() if key not in self.failed]
+        unsuccessful = [paper for key, paper in self.papers.items() if key in self.failed]
+        return successful, unsuccessful
+
+
+class EnrichmentWorker:
+    """
+    Takes batches of papers from an EnrichmentCoordinator, enriches them and sends them back,
+    until the coordinator has nothing left
+    """
+
+    def __init__(self, coordinator_url, identity, batch_size=20, workers_per_source=4, name=None, token=None):
+        """
+        :param coordinator_url: e.g. http://host:8765
+        :param identity: email address to provide to the APIs
+        :param batch_size: max papers to ask for at a time
+        :param workers_per_source: worker threads per source, see enrichAndUpdateMetadata()
+        :param name: how the worker is known to the coordinator
+        :param token: the coordinator's token, if it has one
+        """
+        self.coordinator_url = coordinator_url.rstrip('/')
+        self.identity = identity
+        self.batch_size = batch_size
+        self.workers_per_source = workers_per_source
+        self.name = name or '%s:%s' % (socket.gethostname(), uuid.uuid4().hex[:8])
+        self.session = createSession(pool_size=2)
+        if token:
+            self.session.headers[TOKEN_HEADER] = token
+
+    def call(self, path, data, attempts=1):
+        """
+        Posts to the coordinator, trying again with exponential backoff if it can't be reached
+        or returns an error
+
+        :param path: e.g. '/lease'
+        :param data: JSON data to send
+        :param attempts: number of tries before giving up
+        :raises requests.RequestException: if the last try failed
+        """
+        delay = RETRY_DELAY
+        for attempt in range(attempts):
+            try:
+                r = self.session.post(self.coordinator_url + path, json=data)
+                r.raise_for_status()
+                return r.json()
+            except requests.RequestException as e:
+                if attempt + 1 >= attempts:
+                    raise
+                print('Call to %s failed, trying again in %d seconds' % (path, delay), e.__class__.__name__, e)
+                sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def keepLeaseAlive(self, lease_id, lease_seconds, stop):
+        interval = lease_seconds / 3.
+        wait = interval
+        while not stop.wait(wait):
+            try:
+                response = self.call('/renew', {'lease_id': lease_id})
+                if response.get('rate_shares'):
+                    setRateShares(response['rate_shares'])
+                wait = interval
+            except requests.RequestException as e:
+                # try again sooner, backing off, but never less often than usual
+                wait = min(RETRY_DELAY if wait >= interval else wait * 2, interval)
+                print('Failed to renew lease, trying again in %d seconds' % wait, e.__class__.__name__, e)
+
+    def processBatch(self, response):
+        papers = [Paper(p['bib'], p['extra_data']) for p in response['papers']]
+        setRateShares(response.get('rate_shares') or {})
+
+        stop = threading.Event()
+        renewer = threading.Thread(target=self.keepLeaseAlive,
+                                   args=(response['lease_id'], response['lease_seconds'], stop), daemon=True)
+        renewer.start()
+        try:
+            successful, unsuccessful = enrichAndUpdateMetadata(papers, None, self.identity,
+                                                               workers_per_source=self.workers_per_source)
+        finally:
+            stop.set()
+            renewer.join()
+
+        failed = set(id(paper) for paper in unsuccessful)
+        results = [{'key': p['key'],
+                    'bib': paper.bib,
+                    'extra_data': paper.extra_data,
+                    'error': 'enrichment failed' if id(paper) in failed else None}
+                   for p, paper in zip(response['papers'], papers)]
+        try:
+            return self.call('/complete', {'lease_id': response['lease_id'], 'results': results}, attempts=5)
+        except requests.RequestException as e:
+            # the lease will run out and the papers will be handed to a worker again
+            print('Could not send back %d papers' % len(results), e.__class__.__name__, e)
+            return None
+
+    def run(self, max_connection_errors=5):
+        """
+        Works until the coordinator says everything is done, or can't be reached
+        `max_connection_errors` times in a row
+
+        :return: number of papers processed
+        """
+        processed = 0
+        while True:
+            try:
+                response = self.call('/lease', {'worker': self.name, 'max_papers': self.batch_size},
+                                     attempts=max_connection_errors)
+            except requests.RequestException as e:
+                print('Coordinator not reachable, stopping', e.__class__.__name__)
+                break
+
+            if response.get('done'):
+                break
+
+            if not response.get('papers'):
+                sleep(response.get('wait', POLL_INTERVAL))
+                continue
+
+            if self.processBatch(response) is not None:
+                processed += len(response['papers'])
+
+        print('Worker', self.name, 'processed', processed, 'papers')
+        return processed
@@ -0,0 +1,195 @@
+import re
+import json
+
+from db.data import basicTitleCleaning
+from db.ref_utils import authorListFromDict, addUrlIfNew, isPDFURL
+from db.unpaywall_snapshot import openDumpFile
+from .base_search import SearchResult
+from .metadata_harvest import CrossrefScraper
+
+doi_url_regex = re.compile(r'^https?://(dx\.)?doi\.org/', re.IGNORECASE)
+
+OPENALEX_TYPES = {'article': 'article',
+                  'journal-article': 'article',
+                  'review': 'article',
+                  'book-chapter': 'inbook',
+                  'proceedings-article': 'inproceedings',
+                  'book': 'book'}
+
+
+def iterDumpRecords(filename):
+    """
+    Streams the JSON records in a dump file, gzipped or not. Handles both JSON Lines files (one
+    record per line, like the OpenAlex snapshot) and files holding a single {"items": [...]}
+    object (like the Crossref public data file, which is split into many smallish files).
+
+    :param filename: path to the dump file
+    :return: generator of dicts
+    """
+    with openDumpFile(filename) as f:
+        first_line = f.readline()
+        try:
+            first = json.loads(first_line) if first_line.strip() else None
+        except ValueError:
+            first = None
+
+        if first is None and first_line.strip():
+            # not JSON Lines, so a single JSON document
+            f.seek(0)
+            document = json.load(f)
+            for item in document.get('items', []):
+                yield item
+            return
+
+        if first is not None:
+            if isinstance(first.get('items'), list):
+                yield from first['items']
+            else:
+                yield first
+
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print('Skipping bad line in', filename, e)
+                continue
+
+            if isinstance(record.get('items'), list):
+                yield from record['items']
+            else:
+                yield record
+
+
+def abstractFromInvertedIndex(inverted_index):
+    """
+    Rebuilds an abstract from OpenAlex's {word: [positions]} representation
+    """
+    if not inverted_index:
+        return ''
+
+    positions = []
+    for word, word_positions in inverted_index.items():
+        for position in word_positions:
+            positions.append((position, word))
+    return ' '.join(word for _, word in sorted(positions))
+
+
+def openAlexWorkToResult(work, index=0):
+    """
+    Converts an OpenAlex work into a SearchResult of the same shape CrossrefScraper.itemToResult()
+    produces
+
+    :param work: dict of an OpenAlex work
+    :param index: index of the result
+    :return: SearchResult
+    """
+    new_bib = {'title': basicTitleCleaning(work.get('title') or work.get('display_name') or '')}
+
+    if work.get('doi'):
+        new_bib['doi'] = doi_url_regex.sub('', work['doi'])
+
+    location = work.get('primary_location') or {}
+    venue = location.get('source') or work.get('host_venue') or {}
+
+    entry_type = OPENALEX_TYPES.get(work.get('type_crossref') or work.get('type'))
+    if entry_type:
+        new_bib['ENTRYTYPE'] = entry_type
+    if venue.get('display_name'):
+        if entry_type in ['inbook', 'inproceedings']:
+            new_bib['booktitle'] = venue['display_name']
+        else:
+            new_bib['journal'] = venue['display_name']
+
+    publisher = venue.get('host_organization_name') or venue.get('publisher')
+    if publisher:
+        new_bib['publisher'] = publisher
+
+    biblio = work.get('biblio') or {}
+    for field in ['volume', 'issue']:
+        if biblio.get(field):
+            new_bib[field] = str(biblio[field])
+    if biblio.get('first_page'):
+        new_bib['pages'] = str(biblio['first_page'])
+        if biblio.get('last_page') and biblio['last_page'] != biblio['first_page']:
+            new_bib['pages'] += '-' + str(biblio['last_page'])
+
+    if work.get('publication_year'):
+        new_bib['year'] = str(work['publication_year'])
+
+    abstract = abstractFromInvertedIndex(work.get('abstract_inverted_index'))
+    if abstract:
+        new_bib['abstract'] = abstract
+
+    authors = []
+    for authorship in work.get('authorships') or []:
+        bits = ((authorship.get('author') or {}).get('display_name') or '').split()
+        if bits:
+            authors.append({'given': ' '.join(bits[:-1]), 'family': bits[-1]})
+
+    if authors:
+        new_bib['author'] = authorListFromDict(authors)
+
+    new_extra = {'x_authors': authors,
+                 'language': work.get('language'),
+                 'openalex_id': (work.get('id') or '').split('/')[-1]}
+
+    ids = work.get('ids') or {}
+    if ids.get('pmid'):
+        new_extra['pmid'] = ids['pmid'].rstrip('/').split('/')[-1]
+
+    new_res = SearchResult(index, new_bib, 'openalex', new_extra)
+
+    if new_bib.get('doi'):
+        addUrlIfNew(new_res, 'https://doi.org/' + new_bib['doi'], 'main', 'openalex')
+
+    oa_url = (work.get('open_access') or {}).get('oa_url')
+    if oa_url:
+        addUrlIfNew(new_res, oa_url, 'pdf' if isPDFURL(oa_url) else 'main', 'openalex')
+
+    return new_res
+
+
+def iterCrossrefDump(filename):
+    """
+    :return: generator of (DOI, SearchResult) for the works in a Crossref dump file
+    """
+    for item in iterDumpRecords(filename):
+        if not item.get('DOI') or not item.get('title'):
+            continue
+        try:
+            yield item['DOI'].lower(), CrossrefScraper.itemToResult(item, report_unknown_types=False)
+        except Exception as e:
+            print('Skipping Crossref record', item.get('DOI'), e.__class__.__name__, e)
+
+
+def iterOpenAlexDump(filename):
+    """
+    :return: generator of (OpenAlex id, SearchResult) for the works in an OpenAlex dump file
+    """
+    for work in iterDumpRecords(filename):
+        if not work.get('id') or not (work.get('title') or work.get('display_name')):
+            continue
+        try:
+            result = openAlexWorkToResult(work)
+            yield result.extra_data['openalex_id'], result
+        except Exception as e:
+            print('Skipping OpenAlex record', work.get('id'), e.__class__.__name__, e)
+
+
+DUMP_READERS = {'crossref': iterCrossrefDump,
+                'openalex': iterOpenAlexDump}
+
+
+def importDump(mirror, filename, source):
+    """
+    Streams a dump file into a ReferenceMirror
+
+    :param mirror: ReferenceMirror
+    :param filename: path to the dump file
+    :param source: "crossref" or "openalex"
+    :return: number of records imported
+    """
+    return mirror.ingest(source, DUMP_READERS[source](filename))
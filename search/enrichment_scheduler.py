@@ -0,0 +1,476 @@
+import json
+import queue
+from time import time, sleep, strftime, localtime
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from db.data import JOB_OK, JOB_NOT_FOUND, JOB_ERROR, JOB_SKIPPED, JOB_FINISHED_STATUSES, JOB_MAX_ATTEMPTS, \
+    JOB_RETRY_DELAY
+from .source_planner import StagePlan, paperFeatureKey, paperFields
+from .circuit_breaker import SourceUnavailable
+
+
+class JobNotEligible(Exception):
+    """
+    A paper can't go on to its next stage in this run, e.g. because that stage failed recently
+    and isn't due for a retry yet, or another worker has it
+    """
+    pass
+
+
+class EnrichmentStage:
+    """
+    One step of enriching a paper: if `condition(paper)` is true when the paper gets to this
+    stage, `action(paper, identity)` is run on the worker pool for `source`.
+
+    While `available()` returns False, e.g. because the source is down, the stage is put off: it
+    isn't run, and it's left for a later run. An action that raises SourceUnavailable is put off
+    the same way.
+    """
+
+    def __init__(self, name, source, condition, action, available=None):
+        self.name = name
+        self.source = source
+        self.condition = condition
+        self.action = action
+        self.available = available
+
+    def isNeeded(self, paper):
+        return bool(self.condition(paper))
+
+    def isAvailable(self):
+        return not self.available or self.available()
+
+    def run(self, paper, identity):
+        self.action(paper, identity)
+
+    def __repr__(self):
+        return '<EnrichmentStage %s (%s)>' % (self.name, self.source)
+
+
+class EnrichmentJobTracker:
+    """
+    Keeps track of every stage of every paper in the enrichment_jobs table of a PaperStore, so
+    that a run that is interrupted can be started again and pick up where it stopped.
+
+    Each paper gets a job key (its id when it was first queued, kept in its extra_data) and a job
+    for every stage. A stage's job is claimed before it runs, and the paper is saved together with
+    the outcome of the job in the same transaction, so a stage that finished is never run again.
+    Stages that fail are retried in later runs, with exponential backoff, up to `max_attempts`.
+
+    How often each stage finds something, and how long it takes, is added up in the
+    source_stats table by the kind of paper, for the EnrichmentPlanner.
+    """
+
+    def __init__(self, paperstore, retry_delay=JOB_RETRY_DELAY, max_attempts=JOB_MAX_ATTEMPTS):
+        self.paperstore = paperstore
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.snapshots = {}
+        self.saved_ids = {}
+
+    @staticmethod
+    def getJobKey(paper):
+        return paper.extra_data.setdefault('job_key', paper.id)
+
+    @staticmethod
+    def snapshot(paper):
+        extra_data = {k: v for k, v in paper.extra_data.items() if not k.startswith('done_')}
+        return json.dumps([paper.bib, extra_data], sort_keys=True, default=str)
+
+    def start(self, papers, stages):
+        """
+        Creates the jobs for a list of papers and releases any jobs left claimed by crashed runs
+        """
+        released = self.paperstore.releaseDeadClaims()
+        if released:
+            print('Released', released, 'jobs claimed by runs that are no longer running')
+        self.paperstore.addJobs([self.getJobKey(paper) for paper in papers],
+                                [(stage.name, stage.source) for stage in stages])
+
+    def claim(self, paper, stage):
+        """
+        Called before a paper goes into a stage it needs
+
+        :return: True if the stage should be run, False if it should be skipped because its job
+            is already finished or has been given up on
+        :raises JobNotEligible: if the paper has to wait for this stage
+        """
+        job_key = self.getJobKey(paper)
+        claimed, job = self.paperstore.claimJob(job_key, stage.name, stage.source,
+                                                max_attempts=self.max_attempts)
+        if claimed:
+            self.snapshots[(id(paper), stage.name)] = (self.snapshot(paper), paperFields(paper),
+                                                       paperFeatureKey(paper))
+            return True
+
+        if job['status'] in JOB_FINISHED_STATUSES or job['attempts'] >= self.max_attempts:
+            return False
+
+        if job['status'] == JOB_ERROR:
+            raise JobNotEligible('%s is waiting to retry %s after %s (attempt %d)' % (
+                job_key, stage.name, strftime('%Y-%m-%d %H:%M:%S', localtime(job['next_eligible'])),
+                job['attempts']))
+
+        raise JobNotEligible('%s is doing %s on %s' % (job['claimed_by'], stage.name, job_key))
+
+    def stop(self):
+        """
+        Called when a run ends, finished or not. Puts back any jobs that were claimed but didn't
+        get to run.
+        """
+        self.snapshots = {}
+        self.paperstore.releaseClaims()
+
+    def skip(self, paper, stage):
+        """
+        Called when a paper doesn't need a stage
+        """
+        self.paperstore.finishJob(self.getJobKey(paper), stage.name, JOB_SKIPPED, commit=False)
+
+    def putOff(self, paper, stage, error=None):
+        """
+        Called when a stage that was claimed couldn't run because its source was unavailable.
+        Saves what the paper has and puts the job back for a later run.
+        """
+        self.snapshots.pop((id(paper), stage.name), None)
+        self.save(paper, commit=False)
+        self.paperstore.releaseJob(self.getJobKey(paper), stage.name,
+                                   error='%s: %s' % (error.__class__.__name__, error) if error else None)
+
+    def done(self, paper, stage, error, seconds=None):
+        """
+        Called when a stage has run on a paper, with the exception it raised or None and how long
+        it took. Saves the paper and the outcome of the job in one transaction.
+        """
+        before, fields_before, features = self.snapshots.pop((id(paper), stage.name), (None, None, None))
+        if error is not None:
+            status = JOB_ERROR
+        elif before != self.snapshot(paper):
+            status = JOB_OK
+        else:
+            status = JOB_NOT_FOUND
+
+        if error is None and seconds is not None and features:
+            found = paperFields(paper) - fields_before
+            self.paperstore.recordSourceOutcome(stage.name, features, bool(found), seconds, commit=False)
+
+        self.save(paper, commit=False)
+        self.paperstore.finishJob(self.getJobKey(paper), stage.name, status,
+                                  error='%s: %s' % (error.__class__.__name__, error) if error else None,
+                                  retry_delay=self.retry_delay)
+
+    def save(self, paper, commit=True):
+        """
+        Saves a paper, removing the copy saved earlier in this run if its id has changed since
+        """
+        job_key = self.getJobKey(paper)
+        paper_id = paper.id
+        previous_id = self.saved_ids.get(job_key)
+        if previous_id and previous_id != paper_id:
+            self.paperstore.deletePapers([previous_id], commit=False)
+        self.saved_ids[job_key] = paper_id
+        self.paperstore.updatePapers([paper], commit=commit)
+
+
+def runStagesSequentially(stages, paper, identity, tracker=None, plan=None):
+    """
+    Takes a paper through all the stages in order, in this thread
+
+    :param tracker: EnrichmentJobTracker, or None
+    :param plan: StagePlan to follow instead of the order of `stages`
+    :return: number of stages put off because their source was unavailable
+    """
+    plan = plan or StagePlan(stages)
+    if tracker:
+        for stage in plan.dropped:
+            tracker.skip(paper, stage)
+
+    put_off = 0
+    position = 0
+    while position < len(plan.stages):
+        stage = plan.stages[position]
+        position += 1
+
+        if not stage.isNeeded(paper):
+            if plan.notNeeded(stage) and tracker:
+                tracker.skip(paper, stage)
+            continue
+
+        if not stage.isAvailable():
+            put_off += 1
+            continue
+
+        if tracker and not tracker.claim(paper, stage):
+            continue
+
+        start = time()
+        try:
+            stage.run(paper, identity)
+        except SourceUnavailable as e:
+            if tracker:
+                tracker.putOff(paper, stage, e)
+            put_off += 1
+            continue
+        except Exception as e:
+            if tracker:
+                tracker.done(paper, stage, e)
+            raise
+
+        if tracker:
+            tracker.done(paper, stage, None, time() - start)
+
+    return put_off
+
+
+class EnrichmentScheduler:
+    """
+    Runs many papers through a list of EnrichmentStages at the same time.
+
+    Each paper is a small state machine that goes through the stages in order, exactly as
+    runStagesSequentially() would take it, so it ends up with the same data. But while one paper
+    waits on Crossref another can be on PubMed and another on Semantic Scholar: each source has
+    its own pool of worker threads, so all of them are kept busy.
+
+    Stage conditions, the tracker and the start/finish callbacks run on the thread that called
+    run(), so anything that isn't thread-safe (like a PaperStore) can be used from them.
+
+    With a `planner`, each paper goes through the stages in the order the planner chooses for it.
+
+    Stages whose source is unavailable are put off (see EnrichmentStage) and the paper carries
+    on with the next one, so a source that is down only costs the papers what it can't give them.
+    """
+
+    def __init__(self, stages, identity, workers_per_source=4, on_start=None, on_finish=None, tracker=None,
+                 planner=None, describe=None):
+        """
+        :param stages: list of EnrichmentStage
+        :param identity: email address to provide to the APIs
+        :param workers_per_source: number of worker threads for each source, or a dict
+            {source: number of threads}
+        :param on_start: function(paper) called before a paper goes into the first stage
+        :param on_finish: function(paper, error) called when a paper is done, with the exception
+            that stopped it or None
+        :param tracker: EnrichmentJobTracker to record the progress of every paper in, or None
+        :param planner: EnrichmentPlanner to choose the order of the stages for each paper, or None
+        :param describe: function that returns a short status line to show next to the progress
+            bar, or None
+        """
+        self.stages = stages
+        self.identity = identity
+        self.workers_per_source = workers_per_source
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.tracker = tracker
+        self.planner = planner
+        self.describe = describe
+        self.described = 0.
+        self.plans = {}
+        self.completed = queue.Queue()
+        self.pools = {}
+        self.in_flight = 0
+        self.put_off = 0
+
+    def getNumWorkers(self, source):
+        if isinstance(self.workers_per_source, dict):
+            return self.workers_per_source.get(source, 1)
+        return self.workers_per_source
+
+    def getPool(self, source):
+        if source not in self.pools:
+            self.pools[source] = ThreadPoolExecutor(max_workers=self.getNumWorkers(source),
+                                                    thread_name_prefix='enrich_' + source)
+        return self.pools[source]
+
+    def makePlan(self, paper):
+        if self.planner:
+            plan = self.planner.planStages(paper, self.stages)
+        else:
+            plan = StagePlan(self.stages)
+        self.plans[id(paper)] = plan
+        if self.tracker:
+            for stage in plan.dropped:
+                self.tracker.skip(paper, stage)
+
+    def getStage(self, paper, position):
+        return self.plans[id(paper)].stages[position]
+
+    def runStage(self, paper, stage, position):
+        start = time()
+        try:
+            stage.run(paper, self.identity)
+            self.completed.put((paper, position, None, time() - start))
+        except BaseException as e:
+            self.completed.put((paper, position, e, None))
+
+    def advance(self, paper, position):
+        """
+        Sends a paper to the next stage it needs from `position` on in its plan
+
+        :return: True if the paper went into a stage, False if it has none left
+        """
+        plan = self.plans[id(paper)]
+        while position < len(plan.stages):
+            stage = plan.stages[position]
+            if not stage.isNeeded(paper):
+                if plan.notNeeded(stage) and self.tracker:
+                    self.tracker.skip(paper, stage)
+            elif not stage.isAvailable():
+                self.put_off += 1
+            elif not self.tracker or self.tracker.claim(paper, stage):
+                self.in_flight += 1
+                self.getPool(stage.source).submit(self.runStage, paper, stage, position)
+                return True
+            position += 1
+        return False
+
+    def advanceOrFinish(self, paper, stage_index, failed, progress):
+        try:
+            if self.advance(paper, stage_index):
+                return
+            error = None
+        except Exception as e:
+            error = e
+
+        if error is not None:
+            failed.add(id(paper))
+        self.finish(paper, error, progress)
+
+    def finish(self, paper, error, progress):
+        self.plans.pop(id(paper), None)
+        if self.on_finish:
+            self.on_finish(paper, error)
+        self.updateDescription(progress)
+        progress.update(1)
+
+    def updateDescription(self, progress, every=0.5):
+        if self.describe and time() - self.described >= every:
+            self.described = time()
+            progress.set_postfix_str(self.describe(), refresh=False)
+
+    def run(self, papers, desc='Enriching metadata'):
+        """
+        Takes all the papers through all the stages
+
+        :param papers: list of Paper
+        :return: tuple (papers that went through every stage, papers stopped by an exception)
+        """
+        successful = []
+        unsuccessful = []
+        failed = set()
+
+        progress = tqdm(total=len(papers), desc=desc)
+        try:
+            for paper in papers:
+                if self.on_start:
+                    self.on_start(paper)
+                self.makePlan(paper)
+                self.advanceOrFinish(paper, 0, failed, progress)
+
+            while self.in_flight:
+                paper, position, error, seconds = self.completed.get()
+                self.in_flight -= 1
+                self.updateDescription(progress)
+
+                if error is not None and not isinstance(error, Exception):
+                    raise error
+
+                if isinstance(error, SourceUnavailable):
+                    self.put_off += 1
+                    if self.tracker:
+                        self.tracker.putOff(paper, self.getStage(paper, position), error)
+                    self.advanceOrFinish(paper, position + 1, failed, progress)
+                    continue
+
+                if self.tracker:
+                    self.tracker.done(paper, self.getStage(paper, position), error, seconds)
+
+                if error is not None:
+                    failed.add(id(paper))
+                    self.finish(paper, error, progress)
+                else:
+                    self.advanceOrFinish(paper, position + 1, failed, progress)
+        finally:
+            progress.close()
+            self.shutdown()
+            if self.tracker:
+                self.recordUnprocessed()
+                self.tracker.stop()
+
+        for paper in papers:
+            if id(paper) in failed:
+                unsuccessful.append(paper)
+            else:
+                successful.append(paper)
+
+        return successful, unsuccessful
+
+    def recordUnprocessed(self):
+        """
+        Records the stages that finished after the run was interrupted, so they aren't repeated
+        """
+        while True:
+            try:
+                paper, position, error, seconds = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(error, SourceUnavailable):
+                self.tracker.putOff(paper, self.getStage(paper, position), error)
+            elif error is None or isinstance(error, Exception):
+                self.tracker.done(paper, self.getStage(paper, position), error, seconds)
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.pools = {}
+
+
+def benchmark(num_papers=100, latency=0.02, workers_per_source=4):
+    """
+    Compares running papers through the stages one after the other with the scheduler, on
+    synthetic stages that each take `latency` seconds like a remote call would
+
+    :param num_papers: number of papers to run
+    :param latency: seconds each stage takes
+    :param workers_per_source: worker threads per source for the scheduler
+    """
+    from db.data import Paper
+
+    def makeAction(name):
+        def action(paper, identity):
+            sleep(latency)
+            paper.extra_data.setdefault('stages', []).append(name)
+            paper.extra_data['done_' + name] = True
+
+        return action
+
+    stages = []
+    for name in ['pubmed', 'crossref', 'semanticscholar', 'arxiv', 'unpaywall']:
+        # not every paper needs every stage
+        condition = (lambda name: lambda paper: int(paper.extra_data['n']) % 5 != len(name) % 5)(name)
+        stages.append(EnrichmentStage(name, name, condition, makeAction(name)))
+
+    def makePapers():
+        return [Paper({'title': 'Paper %d' % i}, {'n': i}) for i in range(num_papers)]
+
+    sequential_papers = makePapers()
+    start = time()
+    for paper in sequential_papers:
+        runStagesSequentially(stages, paper, None)
+    sequential_time = time() - start
+
+    scheduled_papers = makePapers()
+    start = time()
+    EnrichmentScheduler(stages, None, workers_per_source).run(scheduled_papers, desc='Benchmark')
+    scheduled_time = time() - start
+
+    assert [p.extra_data for p in sequential_papers] == [p.extra_data for p in scheduled_papers]
+
+    print('Sequential: %.2f seconds (%.1f papers/s)' % (sequential_time, num_papers / sequential_time))
+    print('Scheduled:  %.2f seconds (%.1f papers/s), %.1fx faster, same results' % (
+        scheduled_time, num_papers / scheduled_time, sequential_time / scheduled_time))
+
+
+if __name__ == '__main__':
+    benchmark()
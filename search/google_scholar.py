@@ -1,4 +1,3 @@
-import requests
 import scholarly
 from time import sleep
 from .base_search import Searcher, MAX_RESULTS, SearchResult
@@ -6,6 +5,7 @@ import bibtexparser
 from tqdm import tqdm
 from random import random
 from db.bibtex import fixBibData
+from base.http_session import createSession
 from db.ref_utils import isPDFURL, getDOIfromURL, addUrlIfNew, addUrlIfNewWithType
 
 
@@ -17,6 +17,7 @@ class GScholarSearcher(Searcher):
     def __init__(self, paperstore):
         super().__init__(paperstore)
         self.min_delay_between_requests = 0.1
+        self.session = createSession()
 
     def randomSleep(self):
         sleep(self.min_delay_between_requests + random() / 10)  # random sleep so we don't get blocked
@@ -72,7 +73,7 @@ class GScholarSearcher(Searcher):
             if result.get("url_scholarbib"):
                 bib = result["bib"]
                 try:
-                    r = requests.get(result["url_scholarbib"])
+                    r = self.session.get(result["url_scholarbib"])
                     # print(r)
                     db = bibtexparser.loads(r.text)
                     bib = db.entries[0]
@@ -0,0 +1,248 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+import requests
+
+from .circuit_breaker import SourceUnavailable
+
+
+class RequestDeadlineExceeded(requests.Timeout):
+    """
+    Raised when a request, retries included, takes longer than the source's deadline
+    """
+    pass
+
+
+class HedgedRequests:
+    """
+    Puts a hard deadline on requests to a source and hedges against slow responses.
+
+    The session's (connect, read) timeouts only apply to each socket operation, so a server that
+    trickles its response, or a string of retries, can still hold a request for much longer.
+    Here every request is made on a worker thread (or as a task, for asyncio) and given up on
+    after `deadline` seconds, however far it got.
+
+    An idempotent request that hasn't come back after the `quantile` latency of recent requests
+    (at least `min_delay` seconds) is sent a second time, and whichever copy answers first is
+    used. Hedges need a free slot (see the `try_extra` argument of call()) and are capped at
+    `max_fraction` of all requests, so a source that is slow for everyone doesn't get twice the
+    load.
+
+    A request that is given up on keeps its thread until its socket times out, and there are only
+    `max_workers` threads: once they are all taken up, call() raises SourceUnavailable rather than
+    queueing new requests behind them.
+    """
+
+    def __init__(self, name, deadline=60., min_delay=1., quantile=0.95, max_fraction=0.05, min_samples=20,
+                 max_workers=20):
+        """
+        :param deadline: seconds a request can take in total, or None for no deadline
+        :param min_delay: never hedge sooner than this, in seconds
+        :param quantile: hedge requests slower than this fraction of recent ones
+        :param max_fraction: max hedges as a fraction of requests
+        :param min_samples: latencies needed before hedging starts
+        :param max_workers: threads for sync requests
+        """
+        self.name = name
+        self.deadline = deadline
+        self.min_delay = min_delay
+        self.quantile = quantile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = None
+        self.num_running = 0
+        self.latencies = deque(maxlen=200)
+
+        self.num_requests = 0
+        self.num_hedged = 0
+        self.num_hedge_wins = 0
+        self.num_deadline_exceeded = 0
+        self.num_threads_busy = 0
+
+    def getExecutor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                   thread_name_prefix='http_' + self.name)
+            return self.executor
+
+    def submit(self, send):
+        """
+        Runs `send()` on a worker thread
+
+        :return: Future, or None if every thread is still busy
+        """
+        executor = self.getExecutor()
+        with self.lock:
+            if self.num_running >= self.max_workers:
+                return None
+            self.num_running += 1
+        future = executor.submit(send)
+        future.add_done_callback(self.finishThread)
+        return future
+
+    def finishThread(self, future):
+        with self.lock:
+            self.num_running -= 1
+
+    def getHedgeDelay(self):
+        """
+        :return: seconds to wait before hedging a request, or None if it shouldn't be
+        """
+        with self.lock:
+            if self.max_fraction <= 0 or len(self.latencies) < self.min_samples:
+                return None
+            if self.num_hedged >= self.max_fraction * self.num_requests:
+                return None
+            latencies = sorted(self.latencies)
+            return max(self.min_delay, latencies[min(len(latencies) - 1, int(self.quantile * len(latencies)))])
+
+    def startRequest(self, idempotent):
+        with self.lock:
+            self.num_requests += 1
+        return time(), self.getHedgeDelay() if idempotent else None
+
+    def countHedge(self):
+        with self.lock:
+            self.num_hedged += 1
+
+    def countResult(self, winner_index, start):
+        with self.lock:
+            if winner_index > 0:
+                self.num_hedge_wins += 1
+            self.latencies.append(time() - start)
+
+    def deadlineExceeded(self):
+        with self.lock:
+            self.num_deadline_exceeded += 1
+        return RequestDeadlineExceeded('%s: no response after %d seconds' % (self.name, self.deadline))
+
+    def call(self, send, idempotent=True, try_extra=lambda: True, release_extra=lambda: None,
+             release=lambda: None):
+        """
+        Calls `send()` on a worker thread and returns its response, or that of the hedge
+
+        :param send: function that makes the request and returns the response
+        :param idempotent: if False the request is never sent twice
+        :param try_extra: function that takes a slot for a hedge, returning False if there is none
+        :param release_extra: function that gives that slot back
+        :param release: function that gives back the slot of the request itself. It is only called
+            if the deadline is exceeded, once the abandoned request's thread is done; otherwise the
+            slot is the caller's to give back.
+        :raises RequestDeadlineExceeded: if no response came back in time
+        :raises SourceUnavailable: if every thread is still busy with earlier requests
+        """
+        if not self.deadline and not idempotent:
+            return send()
+
+        first = self.submit(send)
+        if first is None:
+            with self.lock:
+                self.num_threads_busy += 1
+            raise SourceUnavailable('%s: all %d request threads are still waiting on earlier requests' %
+                                    (self.name, self.max_workers))
+
+        start, hedge_delay = self.startRequest(idempotent)
+        futures = [first]
+        pending = set(futures)
+
+        while True:
+            elapsed = time() - start
+            timeouts = []
+            if self.deadline:
+                timeouts.append(self.deadline - elapsed)
+            if hedge_delay is not None and len(futures) == 1:
+                timeouts.append(hedge_delay - elapsed)
+            timeout = max(0., min(timeouts)) if timeouts else None
+
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.countResult(futures.index(future), start)
+                    return future.result()
+
+            if done and not pending:
+                # the session has already retried, so another copy isn't worth it
+                raise next(iter(done)).exception()
+
+            if self.deadline and time() - start >= self.deadline:
+                # the threads are left to run out their socket timeouts, and keep their slots until then
+                first.add_done_callback(lambda f: release())
+                raise self.deadlineExceeded()
+
+            if hedge_delay is not None and len(futures) == 1 and time() - start >= hedge_delay:
+                hedge_delay = None
+                if try_extra():
+                    hedge = self.submit(send)
+                    if hedge is None:
+                        release_extra()
+                        continue
+                    self.countHedge()
+                    hedge.add_done_callback(lambda f: release_extra())
+                    futures.append(hedge)
+                    pending.add(hedge)
+
+    async def acall(self, send, idempotent=True, try_extra=lambda: True, release_extra=lambda: None):
+        """
+        Async version of call(): `send` is a function that returns an awaitable
+        """
+        if not self.deadline and not idempotent:
+            return await send()
+
+        start, hedge_delay = self.startRequest(idempotent)
+        tasks = [asyncio.ensure_future(send())]
+        pending = set(tasks)
+        hedged = False
+
+        try:
+            while True:
+                elapsed = time() - start
+                timeouts = []
+                if self.deadline:
+                    timeouts.append(self.deadline - elapsed)
+                if hedge_delay is not None and len(tasks) == 1:
+                    timeouts.append(hedge_delay - elapsed)
+                timeout = max(0., min(timeouts)) if timeouts else None
+
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.countResult(tasks.index(task), start)
+                        return task.result()
+
+                if done and not pending:
+                    raise next(iter(done)).exception()
+
+                if self.deadline and time() - start >= self.deadline:
+                    raise self.deadlineExceeded()
+
+                if hedge_delay is not None and len(tasks) == 1 and time() - start >= hedge_delay:
+                    hedge_delay = None
+                    if try_extra():
+                        hedged = True
+                        self.countHedge()
+                        hedge = asyncio.ensure_future(send())
+                        tasks.append(hedge)
+                        pending.add(hedge)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                else:
+                    # so an exception nobody looked at isn't logged
+                    task.cancelled() or task.exception()
+            if hedged:
+                release_extra()
+
+    def getStats(self):
+        with self.lock:
+            return {'requests': self.num_requests,
+                    'hedged': self.num_hedged,
+                    'hedge_wins': self.num_hedge_wins,
+                    'deadline_exceeded': self.num_deadline_exceeded,
+                    'threads_busy': self.num_threads_busy}
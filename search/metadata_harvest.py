@@ -2,18 +2,36 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
-import requests
+import os
+import asyncio
+import threading
 import re, json
 import urllib.parse
-from db.bibtex import readBibtexString, fixBibData, getBibtextFromDOI
-from db.ref_utils import isPDFURL, getDOIfromURL, authorListFromDict, addUrlIfNew
+from db.bibtex import readBibtexString, writeBibtexString, fixBibData
+from db.ref_utils import isPDFURL, getDOIfromURL, authorListFromDict, addUrlIfNew, normalizeTitle
 from db.data import Paper, computeAuthorDistance, rerankByTitleSimilarity, basicTitleCleaning, dist, removeListWrapper
+from db.lookup_cache import LookupCache
+from db.unpaywall_snapshot import UnpaywallSnapshot, UNPAYWALL_SNAPSHOT_FILE
+from db.reference_mirror import ReferenceMirror, REFERENCE_MIRROR_FILE
+from base.http_session import createSession, DEFAULT_TIMEOUT, SERVER_ERROR_STATUS_CODES
+from .async_engine import AsyncEngine
+from .rate_limit import TokenBucket, SharedTokenBucket
+from .concurrency import AdaptiveConcurrency, THROTTLE_STATUS_CODES
+from .response_cache import ResponseCache, OfflineCacheMiss
+from .coalescing import RequestCoalescer
+from .circuit_breaker import CircuitBreaker, SourceUnavailable
+from .hedging import HedgedRequests, RequestDeadlineExceeded
+from .metrics import SourceMetrics, MetricsStream, formatProgressLine, writeMetrics
 from .base_search import SearchResult
+from .xml_parsing import parsePubMedArticles, parseArxivEntries
+from .enrichment_scheduler import EnrichmentStage, EnrichmentScheduler, EnrichmentJobTracker, runStagesSequentially, \
+    JobNotEligible
 from tqdm import tqdm
 import datetime
-from time import sleep
+from time import sleep, time
 from datetime import timedelta
-from io import StringIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from lxml import etree
 import datetime
 
@@ -23,7 +41,7 @@ BIB_FIELDS_TRANSFER = ['abstract', 'address', 'annote', 'author', 'booktitle', '
                        'month', 'note', 'number', 'organization',
                        'pages', 'publisher', 'school', 'series', 'type', 'volume', 'year']
 
-interval_regex = re.compile(r'((?P<hours>\d+?)hr)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?')
+interval_regex = re.compile(r'((?P<hours>\d+?)hr?)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?')
 
 
 def parse_time(time_str):
@@ -94,81 +112,453 @@ def mergeResultData(result1, result2):
     return result1
 
 
+def selectBestMatch(paper, results, ok_title_distance=0.1, ok_author_distance=0.1):
+    """
+    Picks the search result that matches a paper, if any is close enough. A title distance of
+    up to 0.1 is always accepted, and up to `ok_title_distance` if the authors match too.
+
+    :param paper: Paper to match
+    :param results: list of SearchResult
+    :param ok_title_distance: max title distance to accept if the authors match
+    :param ok_author_distance: max author distance for that
+    :return: the matching SearchResult or None
+    """
+    if not results:
+        return None
+
+    sorted_results = rerankByTitleSimilarity(results, paper.title)
+
+    top_res = sorted_results[0][1]
+
+    title_distance = dist.distance(top_res['title'].lower(), paper.title.lower())
+    author_distance = computeAuthorDistance(paper, top_res)
+
+    if title_distance > 0.1:
+        if title_distance <= ok_title_distance and author_distance <= ok_author_distance:
+            print('\n[matched] Title distance is above 0.1, but within settings')
+            print('Title:', paper.title)
+            print('Best match:', top_res['title'])
+            print('title distance:', title_distance, 'author distance:', author_distance)
+        else:
+            print('\n[skipped] Distance is too great \n')
+            print('Title:', paper.title)
+            print('title distance:', title_distance, 'author distance:', author_distance)
+            print('Options:\n' + '\n'.join([r[1]['title'] for r in sorted_results]), '\n')
+            return None
+
+    return top_res
+
+
 class NiceScraper:
-    def __init__(self, basic_delay=0., rate_limit=None, rate_interval=None):
-        self.response_times = []
-        self.request_times = []
-        self.avg_response_time = 0
+    """
+    Base class for all metadata sources. Every request goes through request() (sync) or
+    arequest() (async), which enforce rate limits and adjust the wait time between requests.
+
+    Each operation is written once, as a generator that yields the keyword arguments of the
+    request it needs and receives the response back (see runSteps()). The sync methods
+    (search(), getMetadata(), ...) run these generators over a pooled requests session, and the
+    async ones (asearch(), agetMetadata(), ...) run them over aiohttp. The async API is there for
+    code using the scrapers as a library; the scripts only use the sync one.
+
+    How many requests can be in flight to a source at once, from any number of threads or
+    tasks, is adjusted on the fly by an AdaptiveConcurrency controller, up to `max_in_flight`.
+
+    If a ResponseCache is set, successful responses are kept on disk for `cache_ttl` seconds and
+    served from there on later runs.
+
+    Every request has to be done within `request_deadline` seconds, and slow GETs are hedged by
+    sending them twice (see HedgedRequests). After `failure_threshold` failed requests in a row
+    a CircuitBreaker stops sending requests to the source for a while and raises
+    SourceUnavailable instead, so the papers can be tried on it again later.
+
+    What happens to the requests (latencies, status codes, bytes, retries, rate limit waits and
+    cache hits) is counted in `metrics`, see getMetrics().
+    """
+
+    cache_ttl = 30 * 24 * 3600
+    # a local match only saves a search on this source if it has one of these identifiers
+    local_match_id_types = ['doi', 'pmid']
+
+    def __init__(self, basic_delay=0., rate_limit=None, rate_interval=None,
+                 pool_size=10, max_retries=3, timeout=DEFAULT_TIMEOUT, max_in_flight=16, initial_in_flight=2,
+                 max_throttle_retries=3, request_deadline=60., hedge=True, failure_threshold=5, cool_down=30.):
+        # 429 and 503 are left to the concurrency controller rather than retried blindly by the session
+        self.session = createSession(pool_size=pool_size, max_retries=max_retries, timeout=timeout,
+                                     retry_status_codes=SERVER_ERROR_STATUS_CODES)
+        self.async_engine = AsyncEngine(pool_size=pool_size, max_retries=max_retries, timeout=timeout,
+                                        retry_status_codes=SERVER_ERROR_STATUS_CODES)
+        self.concurrency = AdaptiveConcurrency(self.source_name, initial_limit=min(initial_in_flight, max_in_flight),
+                                               max_limit=max_in_flight)
+        self.max_throttle_retries = max_throttle_retries
+        self.hedger = HedgedRequests(self.source_name, deadline=request_deadline, max_fraction=0.05 if hedge else 0.,
+                                     max_workers=2 * pool_size)
+        self.breaker = CircuitBreaker(self.source_name, failure_threshold=failure_threshold, cool_down=cool_down)
+        self.metrics = SourceMetrics(self.source_name)
         self.basic_delay = basic_delay
-        self.delay = 0.0
         self.rate_limit = rate_limit
         if isinstance(rate_interval, str):
             self.rate_interval = parse_time(rate_interval)
         else:
             self.rate_interval = rate_interval
+        self.rate_limiter = TokenBucket(self.source_name, self.rate_limit, self.rate_interval)
+        # fraction of the source's rate limit this process can use, when others share it
+        self.rate_share = 1.
+        self.response_cache = None
+        self.coalescer = RequestCoalescer(self.source_name)
+        self.local_matcher = None
+        self.remote_searches_skipped = 0
+        self.stats_lock = threading.Lock()
+
+    @property
+    def source_name(self):
+        return self.__class__.__name__.split('.')[-1]
+
+    def useSharedRateLimits(self, db_file):
+        """
+        Moves this scraper's rate limiter to a sqlite file so that all processes using the same
+        file share one budget for this source
 
-    def playNice(self):
+        :param db_file: path to the sqlite file
+        """
+        self.rate_limiter = SharedTokenBucket(self.source_name, self.rate_limit, self.rate_interval,
+                                              db_file=db_file)
 
-        if self.rate_limit and len(self.request_times) >= self.rate_limit:
-            now = datetime.datetime.now()
+    def useLocalMatcher(self, local_matcher):
+        """
+        Makes matchPaperFromResults() look for a match among local records before searching
+        this source
 
-            diff = now - self.request_times[-self.rate_limit]
-            if diff < self.rate_interval:
-                print('Waiting for the rate limit')
-                sleep(self.rate_interval - diff.total_seconds())
+        :param local_matcher: function(paper) that returns a list of candidate SearchResult, or
+            None to always search the source
+        """
+        self.local_matcher = local_matcher
 
-        if len(self.response_times) > 0:
-            self.avg_response_time = sum(self.response_times[-10:]) / len(self.response_times[-10:])
-            if self.response_times[-1] > self.avg_response_time:
-                self.delay += 0.1
-            else:
-                self.delay -= 0.1
-                self.delay = max(self.delay, 0)
+    def matchPaperLocally(self, paper, ok_title_distance=0.1, ok_author_distance=0.1):
+        """
+        Looks for a local record that matches a paper with the same rules as a remote search,
+        and that has an identifier this source would have given us
+
+        :return: True if one was found and merged into the paper
+        """
+        if not self.local_matcher:
+            return False
+
+        own_key = paper.extra_data.get('job_key')
+        candidates = []
+        for candidate in self.local_matcher(paper):
+            # the paper's own copy, saved before it was done
+            if own_key and candidate.extra_data.get('job_key') == own_key:
+                continue
+            if any(getattr(candidate, id_type, None) for id_type in self.local_match_id_types):
+                candidates.append(candidate)
+
+        top_res = selectBestMatch(paper, candidates, ok_title_distance, ok_author_distance)
+        if not top_res:
+            return False
+
+        mergeResultData(paper, top_res)
+        with self.stats_lock:
+            self.remote_searches_skipped += 1
+        return True
+
+    def getConcurrencyState(self):
+        """
+        Returns the current concurrency limit, requests in flight and backoff state for this source
+        """
+        return self.concurrency.getState()
+
+    def getMetrics(self):
+        """
+        Returns everything there is to know about the requests to this source so far, as a JSON
+        serializable dict
+        """
+        return dict(self.metrics.getSnapshot(),
+                    coalescing=self.coalescer.getStats(),
+                    local_matches=self.remote_searches_skipped,
+                    hedging=self.hedger.getStats(),
+                    breaker=self.breaker.getState(),
+                    concurrency=self.getConcurrencyState())
+
+    def isAvailable(self):
+        """
+        Returns False while the circuit breaker for this source is open
+        """
+        return self.breaker.isAvailable()
+
+    def recordOutcome(self, r):
+        """
+        Tells the circuit breaker how a request went: a response is a failure if it's a server
+        error, None if the request raised an exception
+        """
+        if r is None or r.status_code >= 500:
+            self.breaker.recordFailure()
         else:
-            self.avg_response_time = 0
+            self.breaker.recordSuccess()
+
+    def tryExtraSlot(self):
+        """
+        Takes a concurrency slot and a rate limit token for a hedged request, if both are free
+        right now
+        """
+        acquired, _ = self.concurrency.tryAcquire()
+        if not acquired:
+            return False
+        if not self.rate_limiter.tryReserve():
+            self.concurrency.release()
+            return False
+        return True
+
+    def getNiceDelay(self):
+        """
+        Returns how long to wait before the next request, in seconds, to respect the rate limit
+        """
+        wait = self.rate_limiter.reserve()
+        if wait:
+            self.metrics.recordRateLimitWait(wait)
+
+        # the fixed delay is shared out too, so N processes with a share of 1/N each keep the same pace
+        return wait + self.basic_delay / max(self.rate_share, 0.01)
+
+    def playNice(self):
+        wait = self.getNiceDelay()
+        if wait:
+            sleep(wait)
+
+    def startRequest(self):
+        return datetime.datetime.now()
+
+    def finishRequest(self, r, before):
+        """
+        Records how a request went and picks up any rate limits from its headers
+
+        :return: duration in seconds
+        """
+        duration = (datetime.datetime.now() - before).total_seconds()
+
+        self.setRateLimitsFromHeaders(r)
+
+        self.metrics.recordResponse(r.status_code, duration, len(r.content or b''), self.getSessionRetries(r))
+        return duration
+
+    def failRequest(self, error, before, release=True):
+        """
+        Records a request that raised an exception
+
+        :param release: if False the concurrency slot is left to whoever still holds it
+        """
+        self.metrics.recordError(error, (datetime.datetime.now() - before).total_seconds())
+        if release:
+            self.concurrency.release()
+        self.recordOutcome(None)
+
+    @staticmethod
+    def getSessionRetries(r):
+        """
+        Returns how many times the session retried a request before it got this response
+        """
+        retries = getattr(getattr(r, 'raw', None), 'retries', None)
+        if retries is not None and hasattr(retries, 'history'):
+            return len(retries.history)
+        return getattr(r, 'retries', 0)
 
-        if self.delay:
-            sleep(self.delay)
+    def getCachedResponse(self, url, data=None, post=False, use_cache=True):
+        """
+        Looks for the response to a request in the response cache, if there is one
 
-    def request(self, url, headers=None, data=None, post=False):
+        :return: tuple (cache key, CachedResponse or None)
+        """
+        if not self.response_cache:
+            return None, None
+
+        if not use_cache:
+            if self.response_cache.offline:
+                raise OfflineCacheMiss('%s: %s can\'t be served from the response cache' % (self.source_name, url))
+            return None, None
+
+        cache_key = self.response_cache.makeKey(url, data, post)
+        cached = self.response_cache.get(cache_key, self.cache_ttl)
+        if cached is None and self.response_cache.offline:
+            raise OfflineCacheMiss('%s: %s is not in the response cache' % (self.source_name, url))
+        if cached is not None:
+            self.metrics.recordCacheHit()
+        return cache_key, cached
+
+    def cacheResponse(self, cache_key, url, r):
+        if self.response_cache and cache_key:
+            self.response_cache.put(cache_key, self.source_name, url, r)
+
+    def request(self, url, headers=None, data=None, post=False, use_cache=True):
         """
-        Makes a nice request, enforcing rate limits and adjusting the wait time
-        between requests based on latency
+        Makes a nice request, enforcing rate limits and the adaptive concurrency limit for
+        this source, and backing off and retrying when the server says we're going too fast.
+        Identical requests that are in flight at the same time share one response. Served from
+        the response cache when possible.
 
         :param url: url to fetch
         :param headers: headers to pass
+        :param data: JSON data to send if post
+        :param post: if True, makes a POST request instead of GET
+        :param use_cache: if False, the response cache is neither read nor written, for responses
+            that are only valid for a short time
         :return: request object
         """
-        class_name = self.__class__.__name__.split('.')[-1]
-        status_code = 0
-        retries = 0
+        # responses aren't kept once they are done with: replaying them is the response cache's job
+        return self.coalescer.run(ResponseCache.makeKey(url, data, post),
+                                  lambda: self.makeRequest(url, headers, data, post, use_cache))
+
+    def makeRequest(self, url, headers=None, data=None, post=False, use_cache=True):
+        """
+        Does the work of request(), without sharing the response with identical requests
+        """
+        cache_key, cached = self.getCachedResponse(url, data, post, use_cache)
+        if cached:
+            return cached
 
-        while status_code != 200 and retries < 2:
+        attempts = 0
+
+        while True:
+            self.breaker.check()
+            self.concurrency.acquire()
             self.playNice()
 
-            self.request_times.append(datetime.datetime.now())
-            before = datetime.datetime.now()
+            before = self.startRequest()
+            try:
+                r = self.sendRequest(url, headers, data, post)
+            except RequestDeadlineExceeded as e:
+                # the abandoned request gives its slot back when its thread is done
+                self.failRequest(e, before, release=False)
+                raise
+            except Exception as e:
+                self.failRequest(e, before)
+                raise
+
+            duration = self.finishRequest(r, before)
+            self.concurrency.release(r.status_code, duration, r.headers.get('Retry-After'))
+            self.recordOutcome(r)
+            attempts += 1
 
-            if post:
-                r = requests.post(url, json=data, headers=headers)
-            else:
-                r = requests.get(url, headers=headers)
+            if r.status_code not in THROTTLE_STATUS_CODES or attempts >= self.max_throttle_retries:
+                self.cacheResponse(cache_key, url, r)
+                return r
+
+            self.metrics.recordRetry()
 
-            if r.status_code == 429:
-                print(class_name, ': Status code 429: waiting and retrying')
-                sleep(30)
+    def sendRequest(self, url, headers=None, data=None, post=False):
+        """
+        Makes the HTTP call within this source's deadline, hedging GETs that are slow
+        """
+        if post:
+            send = lambda: self.session.post(url, json=data, headers=headers)
+        else:
+            send = lambda: self.session.get(url, headers=headers)
+        return self.hedger.call(send, idempotent=not post, try_extra=self.tryExtraSlot,
+                                release_extra=self.concurrency.release, release=self.concurrency.release)
 
-            status_code = r.status_code
-            retries += 1
+    async def asendRequest(self, url, headers=None, data=None, post=False):
+        """
+        Async version of sendRequest()
+        """
+        return await self.hedger.acall(lambda: self.async_engine.fetch(url, headers=headers, data=data, post=post),
+                                       idempotent=not post, try_extra=self.tryExtraSlot,
+                                       release_extra=self.concurrency.release)
 
-        duration = datetime.datetime.now() - before
+    async def arequest(self, url, headers=None, data=None, post=False, use_cache=True):
+        """
+        Async version of request()
 
-        self.setRateLimitsFromHeaders(r)
+        :return: AsyncResponse
+        """
+        return await self.coalescer.arun(ResponseCache.makeKey(url, data, post),
+                                         lambda: self.amakeRequest(url, headers, data, post, use_cache))
+
+    async def amakeRequest(self, url, headers=None, data=None, post=False, use_cache=True):
+        """
+        Async version of makeRequest()
+        """
+        cache_key, cached = self.getCachedResponse(url, data, post, use_cache)
+        if cached:
+            return cached
+
+        attempts = 0
+
+        while True:
+            self.breaker.check()
+            await self.concurrency.aacquire()
+            wait = self.getNiceDelay()
+            if wait:
+                await asyncio.sleep(wait)
+
+            before = self.startRequest()
+            try:
+                r = await self.asendRequest(url, headers, data, post)
+            except Exception as e:
+                self.failRequest(e, before)
+                raise
 
-        self.response_times.append(duration.total_seconds())
-        print(class_name, "request took", self.response_times[-1])
+            duration = self.finishRequest(r, before)
+            self.concurrency.release(r.status_code, duration, r.headers.get('Retry-After'))
+            self.recordOutcome(r)
+            attempts += 1
 
-        return r
+            if r.status_code not in THROTTLE_STATUS_CODES or attempts >= self.max_throttle_retries:
+                self.cacheResponse(cache_key, url, r)
+                return r
+
+            self.metrics.recordRetry()
+
+    def runSteps(self, steps):
+        """
+        Runs an operation generator synchronously: every dict it yields is passed as keyword
+        arguments to request() and the response is sent back in. Exceptions raised by the
+        request are thrown back into the generator so it can handle them.
+
+        :param steps: generator
+        :return: the generator's return value
+        """
+        response = None
+        error = None
+        while True:
+            try:
+                if error is not None:
+                    request_args = steps.throw(error)
+                else:
+                    request_args = steps.send(response)
+            except StopIteration as e:
+                return e.value
+
+            try:
+                response = self.request(**request_args)
+                error = None
+            except Exception as e:
+                response = None
+                error = e
+
+    async def arunSteps(self, steps):
+        """
+        Async version of runSteps(), making the requests through arequest(). The requests share
+        one aiohttp session, which is closed when the last call running on the loop is done.
+        """
+        async with self.async_engine.opened():
+            response = None
+            error = None
+            while True:
+                try:
+                    if error is not None:
+                        request_args = steps.throw(error)
+                    else:
+                        request_args = steps.send(response)
+                except StopIteration as e:
+                    return e.value
+
+                try:
+                    response = await self.arequest(**request_args)
+                    error = None
+                except Exception as e:
+                    response = None
+                    error = e
+
+    async def aclose(self):
+        await self.async_engine.close()
 
     def setRateLimitsFromHeaders(self, request):
         if request.headers.get('X-Rate-Limit-Limit'):
@@ -181,10 +571,58 @@ class NiceScraper:
                       request.headers['X-Rate-Limit-Interval'])
                 self.rate_interval = None
 
-    def search(self, title, identity, max_results=5):
+        self.applyRateLimits()
+
+    def setRateShare(self, share):
+        """
+        Limits this process to a fraction of the source's rate limit, e.g. when several machines
+        are working through the same source. Applies to the limit given when the scraper was
+        created as well as to one learned from the response headers, and to the basic delay.
+
+        :param share: between 0 and 1
+        """
+        self.rate_share = share
+        self.applyRateLimits()
+
+    def applyRateLimits(self):
+        if self.rate_limit and self.rate_interval:
+            self.rate_limiter.setLimits(self.rate_limit * self.rate_share, self.rate_interval)
+
+    def searchSteps(self, title, identity, max_results=5):
         raise NotImplementedError
+        yield
+
+    def getMetadataSteps(self, paper, identity):
+        """
+        Gets the metadata for a paper from this source and merges it in. Sources that can look
+        papers up by identifier override this, the default is to match the paper by title with
+        matchPaperFromResults()
+
+        :return: the paper if it was found, else None
+        """
+        matched = yield from self.matchPaperFromResultsSteps(paper, identity)
+        return paper if matched else None
+
+    def search(self, *args, **kwargs):
+        return self.runSteps(self.searchSteps(*args, **kwargs))
+
+    async def asearch(self, *args, **kwargs):
+        return await self.arunSteps(self.searchSteps(*args, **kwargs))
+
+    def getMetadata(self, *args, **kwargs):
+        return self.runSteps(self.getMetadataSteps(*args, **kwargs))
+
+    async def agetMetadata(self, *args, **kwargs):
+        return await self.arunSteps(self.getMetadataSteps(*args, **kwargs))
 
     def matchPaperFromResults(self, paper, identity, ok_title_distance=0.1, ok_author_distance=0.1):
+        return self.runSteps(self.matchPaperFromResultsSteps(paper, identity, ok_title_distance, ok_author_distance))
+
+    async def amatchPaperFromResults(self, paper, identity, ok_title_distance=0.1, ok_author_distance=0.1):
+        return await self.arunSteps(
+            self.matchPaperFromResultsSteps(paper, identity, ok_title_distance, ok_author_distance))
+
+    def matchPaperFromResultsSteps(self, paper, identity, ok_title_distance=0.1, ok_author_distance=0.1):
         """
         Tries to match a paper with a DOI and retrieves its metadata if successful
 
@@ -194,35 +632,27 @@ class NiceScraper:
         """
         class_name = self.__class__.__name__.split('.')[-1]
 
+        if self.matchPaperLocally(paper, ok_title_distance, ok_author_distance):
+            return True
+
+        # copies of the same paper often differ only in case, spacing or punctuation
+        search_key = ('search', normalizeTitle(paper.title))
         try:
-            results = self.search(paper.title, identity, max_results=5)
+            found, results = self.coalescer.getResult(search_key)
+            if not found:
+                results = yield from self.searchSteps(paper.title, identity, max_results=5)
+                self.coalescer.putResult(search_key, results)
+        except (OfflineCacheMiss, SourceUnavailable):
+            # not a failed lookup, we just don't know yet
+            raise
         except Exception as e:
             print('Error during %s.matchPaperFromResults()' % class_name, e)
             results = None
 
-        if not results:
+        top_res = selectBestMatch(paper, results, ok_title_distance, ok_author_distance)
+        if not top_res:
             return False
 
-        sorted_results = rerankByTitleSimilarity(results, paper.title)
-
-        top_res = sorted_results[0][1]
-
-        title_distance = dist.distance(top_res['title'].lower(), paper.title.lower())
-        author_distance = computeAuthorDistance(paper, top_res)
-
-        if title_distance > 0.1:
-            if title_distance <= ok_title_distance and author_distance <= ok_author_distance:
-                print('\n[matched] Title distance is above 0.1, but within settings')
-                print('Title:', paper.title)
-                print('Best match:', top_res['title'])
-                print('title distance:', title_distance, 'author distance:', author_distance)
-            else:
-                print('\n[skipped] Distance is too great \n')
-                print('Title:', paper.title)
-                print('title distance:', title_distance, 'author distance:', author_distance)
-                print('Options:\n' + '\n'.join([r[1]['title'] for r in sorted_results]), '\n')
-                return False
-
         try:
             mergeResultData(paper, top_res)
             return True
@@ -231,13 +661,154 @@ class NiceScraper:
             return False
 
 
+CROSSREF_API_URL = 'https://api.crossref.org/works'
+
+# the fields itemToResult() uses. Asking for just these makes responses several times smaller
+CROSSREF_SELECT_FIELDS = ['DOI', 'title', 'container-title', 'type', 'publisher', 'publisher-location', 'issue',
+                          'volume', 'page', 'URL', 'issued', 'author', 'language', 'link']
+
+
 class CrossrefScraper(NiceScraper):
+    local_match_id_types = ['doi']
+
+    def bulkSearchCrossref(self, papers, identity, ok_title_distance=0.1, ok_author_distance=0.1,
+                           max_workers=8, doi_batch_size=50):
+        """
+        Matches many papers against Crossref at once. Papers that have a DOI are fetched
+        `doi_batch_size` at a time with a doi: filter. The rest are matched by bibliographic
+        search, running up to `max_workers` queries at the same time (the adaptive concurrency
+        limit for Crossref still applies) and accepting results with the same title/author
+        rules as matchPaperFromResults().
+
+        :param papers: list of Paper
+        :param identity: email address to provide to Crossref
+        :param ok_title_distance: see selectBestMatch()
+        :param ok_author_distance: see selectBestMatch()
+        :param max_workers: max number of concurrent bibliographic queries
+        :param doi_batch_size: number of DOIs per request
+        :return: tuple (matched papers, unmatched papers, papers that couldn't be tried in offline mode
+            or while Crossref was unavailable)
+        """
+        matched = []
+        unmatched = []
+        not_tried = []
+
+        with_doi = [paper for paper in papers if paper.doi]
+        without_doi = [paper for paper in papers if not paper.doi]
+
+        for start in range(0, len(with_doi), doi_batch_size):
+            batch = with_doi[start:start + doi_batch_size]
+            try:
+                found = self.getMetadataForDOIs([paper.doi for paper in batch], identity)
+            except (OfflineCacheMiss, SourceUnavailable):
+                not_tried.extend(batch)
+                continue
+            except Exception as e:
+                print('Error during CrossrefScraper.bulkSearchCrossref()', e.__class__.__name__, e)
+                found = {}
+
+            for paper in batch:
+                result = found.get(paper.doi.lower())
+                if result:
+                    mergeResultData(paper, result)
+                    matched.append(paper)
+                else:
+                    unmatched.append(paper)
+
+        def matchPaper(paper):
+            try:
+                return self.matchPaperFromResults(paper, identity, ok_title_distance, ok_author_distance)
+            except (OfflineCacheMiss, SourceUnavailable):
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for paper, success in zip(without_doi, executor.map(matchPaper, without_doi)):
+                if success is None:
+                    not_tried.append(paper)
+                elif success:
+                    matched.append(paper)
+                else:
+                    unmatched.append(paper)
+
+        return matched, unmatched, not_tried
+
+    @staticmethod
+    def itemToResult(item, index=0, report_unknown_types=True):
+        """
+        Converts a Crossref JSON work item into a SearchResult
+
+        :param item: dict of a Crossref work
+        :param index: index of the result
+        :param report_unknown_types: if True, prints items of types we don't map to a BibTeX type
+        :return: SearchResult
+        """
+        # print(item.get('type'))
+        new_bib = {'doi': item['DOI'],
+                   'title': basicTitleCleaning(removeListWrapper(item['title']))}
+
+        if 'container-title' in item:
+            # reference-entry, book
+
+            if item.get('type') in ['journal-article', 'reference-entry']:
+                new_bib['journal'] = removeListWrapper(item['container-title'])
+                new_bib['ENTRYTYPE'] = 'article'
+            elif item.get('type') in ['book-chapter']:
+                new_bib['ENTRYTYPE'] = 'inbook'
+                new_bib['booktitle'] = removeListWrapper(item['container-title'])
+            elif item.get('type') in ['proceedings-article']:
+                new_bib['ENTRYTYPE'] = 'inproceedings'
+                new_bib['booktitle'] = removeListWrapper(item['container-title'])
+
+        if item.get('type') in ['book']:
+            new_bib['ENTRYTYPE'] = 'book'
+
+        if report_unknown_types and item.get('type') not in ['journal-article', 'reference-entry', 'book',
+                                                             'book-chapter', 'proceedings-article']:
+            print(json.dumps(item, indent=3))
+
+        for field in [('publisher-location', 'address'),
+                      ('publisher', 'publisher'),
+                      ('issue', 'issue'),
+                      ('volume', 'volume'),
+                      ('page', 'pages'),
+                      ]:
+            if field[0] in item:
+                new_bib[field[1]] = str(item[field[0]])
+
+        if 'URL' in item:
+            new_bib['url'] = item['URL']
+
+        if "issued" in item:
+            date_parts = item['issued']['date-parts'][0]
+            new_bib['year'] = str(date_parts[0])
+            if len(date_parts) > 1:
+                new_bib['month'] = str(date_parts[1])
+            if len(date_parts) > 2:
+                new_bib['day'] = str(date_parts[2])
+
+        authors = []
+        for author in item.get('author', []):
+            authors.append({'given': author.get('given', ''), 'family': author.get('family', '')})
+
+        if item.get('author'):
+            new_bib['author'] = authorListFromDict(authors)
+
+        new_extra = {'x_authors': authors,
+                     'language': item.get('language')
+                     }
 
-    def bulkSearchCrossref(self, papers):
-        pass
-        # r = requests.get("https://doi.crossref.org/simpleTextQuery")
+        new_res = SearchResult(index, new_bib, 'crossref', new_extra)
 
-    def search(self, title, identity, year=None, max_results=1):
+        addUrlIfNew(new_res, item['URL'], 'main', 'crossref')
+
+        if 'link' in item:
+            for link in item['link']:
+                if isPDFURL(link['URL']):
+                    addUrlIfNew(new_res, link['URL'], 'pdf', 'crossref')
+
+        return new_res
+
+    def searchSteps(self, title, identity, year=None, max_results=1):
         """
         Searchs and returns a number of results from Crossref
 
@@ -247,14 +818,14 @@ class CrossrefScraper(NiceScraper):
         :param max_results:
         :return: list of Crossref JSON data results
         """
-        urllib.parse.quote(title, safe='')
         headers = {'User-Agent': 'ReviewBuilder(mailto:%s)' % identity}
         # changed because of https://status.crossref.org/incidents/4y45gj63jsp4
-        url = 'https://api.crossref.org/works?rows={}&query.bibliographic={}'.format(max_results, title)
+        url = CROSSREF_API_URL + '?rows={}&select={}&query.bibliographic={}'.format(
+            max_results, ','.join(CROSSREF_SELECT_FIELDS), urllib.parse.quote(title, safe=''))
         if year:
             url += '&query.published=' + str(year)
 
-        r = self.request(url, headers)
+        r = yield {'url': url, 'headers': headers}
 
         d = r.json()
         if d['status'] != 'ok':
@@ -262,94 +833,98 @@ class CrossrefScraper(NiceScraper):
 
         results = []
         for index, item in enumerate(d['message']['items']):
-            # print(item.get('type'))
-            new_bib = {'doi': item['DOI'],
-                       'title': basicTitleCleaning(removeListWrapper(item['title']))}
-
-            if 'container-title' in item:
-                # reference-entry, book
-
-                if item.get('type') in ['journal-article', 'reference-entry']:
-                    new_bib['journal'] = removeListWrapper(item['container-title'])
-                    new_bib['ENTRYTYPE'] = 'article'
-                elif item.get('type') in ['book-chapter']:
-                    new_bib['ENTRYTYPE'] = 'inbook'
-                    new_bib['booktitle'] = removeListWrapper(item['container-title'])
-                elif item.get('type') in ['proceedings-article']:
-                    new_bib['ENTRYTYPE'] = 'inproceedings'
-                    new_bib['booktitle'] = removeListWrapper(item['container-title'])
-
-            if item.get('type') in ['book']:
-                new_bib['ENTRYTYPE'] = 'book'
-
-            if item.get('type') not in ['journal-article', 'reference-entry', 'book', 'book-chapter',
-                                        'proceedings-article']:
-                print(json.dumps(item, indent=3))
-
-            for field in [('publisher-location', 'address'),
-                          ('publisher', 'publisher'),
-                          ('issue', 'issue'),
-                          ('volume', 'volume'),
-                          ('page', 'pages'),
-                          ]:
-                if field[0] in item:
-                    new_bib[field[1]] = str(item[field[0]])
-
-            if 'URL' in item:
-                new_bib['url'] = item['URL']
-
-            if "issued" in item:
-                date_parts = item['issued']['date-parts'][0]
-                new_bib['year'] = str(date_parts[0])
-                if len(date_parts) > 1:
-                    new_bib['month'] = str(date_parts[1])
-                if len(date_parts) > 2:
-                    new_bib['day'] = str(date_parts[2])
-
-            authors = []
-            for author in item.get('author', []):
-                authors.append({'given': author.get('given', ''), 'family': author.get('family', '')})
-
-            if item.get('author'):
-                new_bib['author'] = authorListFromDict(authors)
-
-            new_extra = {'x_authors': authors,
-                         'language': item.get('language')
-                         }
-
-            new_res = SearchResult(index, new_bib, 'crossref', new_extra)
-
-            addUrlIfNew(new_res, item['URL'], 'main', 'crossref')
-
-            if 'link' in item:
-                for link in item['link']:
-                    if isPDFURL(link['URL']):
-                        addUrlIfNew(new_res, link['URL'], 'pdf', 'crossref')
-
-            results.append(new_res)
+            results.append(self.itemToResult(item, index))
 
         return results
 
+    def getMetadataForDOIs(self, dois, identity):
+        return self.runSteps(self.getMetadataForDOIsSteps(dois, identity))
 
-class UnpaywallScraper(NiceScraper):
+    async def agetMetadataForDOIs(self, dois, identity):
+        return await self.arunSteps(self.getMetadataForDOIsSteps(dois, identity))
 
-    def getMetadata(self, paper, identity):
-        if not paper.doi:
-            raise ValueError("Paper has no DOI")
+    def getMetadataForDOIsSteps(self, dois, identity):
+        """
+        Fetches the Crossref records for many DOIs in a single request using a doi: filter
 
-        url = 'https://api.unpaywall.org/v2/%s?email=%s' % (paper.doi, identity)
+        :param dois: list of DOIs. Keep it short enough for the URL, around 50
+        :param identity: email address to provide to Crossref
+        :return: dict {lowercase DOI: SearchResult}
+        """
+        doi_filter = ','.join(['doi:' + urllib.parse.quote(doi, safe='/') for doi in dois])
 
-        r = self.request(url)
+        results = {}
+        items = yield from self.iterWorksSteps(identity, filters=doi_filter, max_results=len(dois))
+        for index, item in enumerate(items):
+            results[item['DOI'].lower()] = self.itemToResult(item, index)
 
-        data = r.json()
-        if data.get('error') == 'true':
-            return
+        return results
 
-        top_url = data.get('best_oa_location')
-        if not top_url:
-            return
+    def iterWorks(self, identity, filters=None, query=None, max_results=1000):
+        return self.runSteps(self.iterWorksSteps(identity, filters, query, max_results))
+
+    async def aiterWorks(self, identity, filters=None, query=None, max_results=1000):
+        return await self.arunSteps(self.iterWorksSteps(identity, filters, query, max_results))
+
+    def iterWorksSteps(self, identity, filters=None, query=None, max_results=1000, rows=1000):
+        """
+        Fetches the works matching a filter and/or bibliographic query, following Crossref's
+        deep paging cursor for result sets larger than one page
+
+        :param identity: email address to provide to Crossref
+        :param filters: Crossref filter string, e.g. "doi:10.1000/1,doi:10.1000/2"
+        :param query: bibliographic query
+        :param max_results: max number of works to return
+        :param rows: works per page, 1000 at most
+        :return: list of Crossref JSON work items
+        """
+        headers = {'User-Agent': 'ReviewBuilder(mailto:%s)' % identity}
+        url = CROSSREF_API_URL + '?rows={}&select={}'.format(min(rows, max_results), ','.join(CROSSREF_SELECT_FIELDS))
+        if filters:
+            url += '&filter=' + filters
+        if query:
+            url += '&query.bibliographic=' + urllib.parse.quote(query, safe='')
+
+        items = []
+        cursor = '*'
+        while len(items) < max_results:
+            r = yield {'url': url + '&cursor=' + urllib.parse.quote(cursor, safe=''), 'headers': headers}
+
+            d = r.json()
+            if d['status'] != 'ok':
+                raise ValueError(
+                    'Error in request:' + d.get('status', 'NO STATUS') + str(d.get('message', 'NO MESSAGE')))
+
+            page = d['message']['items']
+            items.extend(page)
+
+            cursor = d['message'].get('next-cursor')
+            if not page or not cursor or len(items) >= d['message'].get('total-results', 0):
+                break
+
+        return items[:max_results]
+
+
+class UnpaywallScraper(NiceScraper):
+    # open access locations change more often than bibliographic metadata
+    cache_ttl = 7 * 24 * 3600
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.snapshot = None
+
+    def useSnapshot(self, snapshot):
+        """
+        Makes lookups go to a local UnpaywallSnapshot first. The API is only asked about DOIs that
+        aren't in the snapshot, e.g. those newer than it
 
-        if top_url.get('url_for_pdf') in top_url:
+        :param snapshot: UnpaywallSnapshot or None
+        """
+        self.snapshot = snapshot
+
+    @staticmethod
+    def addOALocation(paper, top_url):
+        if top_url.get('url_for_pdf'):
             addUrlIfNew(paper, top_url['url_for_pdf'], 'pdf', 'unpaywall')
         if top_url.get('url_for_landing_page'):
             addUrlIfNew(paper, top_url['url_for_landing_page'], 'main', 'unpaywall')
@@ -362,27 +937,132 @@ class UnpaywallScraper(NiceScraper):
 
             addUrlIfNew(paper, url, type, 'unpaywall')
 
+    def getMetadataSteps(self, paper, identity):
+        if not paper.doi:
+            raise ValueError("Paper has no DOI")
+
+        if self.snapshot:
+            found, top_url = self.snapshot.lookup(paper.doi)
+            if found:
+                if top_url:
+                    self.addOALocation(paper, top_url)
+                paper.extra_data['done_unpaywall'] = True
+                return
+
+        url = 'https://api.unpaywall.org/v2/%s?email=%s' % (paper.doi, identity)
+
+        r = yield {'url': url}
+
+        data = r.json()
+        if data.get('error') == 'true':
+            return
+
+        top_url = data.get('best_oa_location')
+        if not top_url:
+            return
+
+        self.addOALocation(paper, top_url)
+
         paper.extra_data['done_unpaywall'] = True
 
 
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+IDCONV_URL = 'https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/'
+
+
 class PubMedScraper(NiceScraper):
-    def search(self, title, identity, max_results=5):
-        url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&retmode=json&retmax={max_results}&sort=relevance&term='
+    cache_ttl = 90 * 24 * 3600
+    local_match_id_types = ['pmid']
+    # max number of ids per efetch/idconv request
+    batch_size = 200
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mirror = None
+
+    def useMirror(self, mirror):
+        """
+        Makes lookups go to the PubMed records in a local ReferenceMirror first (see
+        import_pubmed_baseline.py)
+
+        :param mirror: ReferenceMirror or None
+        """
+        self.mirror = mirror
+
+    def searchSteps(self, title, identity, max_results=5):
+        if self.mirror:
+            results = self.mirror.findByTitle(title, source='pubmed')
+            if results:
+                return results[:max_results]
+
+        url = EUTILS_URL + f'esearch.fcgi?db=pubmed&retmode=json&retmax={max_results}&sort=relevance&term='
         url += urllib.parse.quote(title)
 
-        r = self.request(url)
+        r = yield {'url': url}
         d = r.json()
         id_list = d['esearchresult']['idlist']
 
         try:
-            result = self.getMetadata(id_list)
+            result = yield from self.getMetadataSteps(id_list)
+        except (OfflineCacheMiss, SourceUnavailable):
+            raise
         except Exception as e:
             print('Error during %s.getMetadata()' % self.__class__.__name__.split('.')[-1], e)
             result = None
 
         return result
 
-    def getMetadata(self, pmids: list):
+    def searchAll(self, query, max_results=100, min_year=None, max_year=None):
+        return self.runSteps(self.searchAllSteps(query, max_results, min_year, max_year))
+
+    async def asearchAll(self, query, max_results=100, min_year=None, max_year=None):
+        return await self.arunSteps(self.searchAllSteps(query, max_results, min_year, max_year))
+
+    def searchAllSteps(self, query, max_results=100, min_year=None, max_year=None):
+        """
+        Runs a query and fetches the full records of up to `max_results` results. The result set is
+        kept on the E-utilities history server and paged through `batch_size` records at a time
+        instead of passing the PMIDs back and forth.
+
+        :param query: PubMed query
+        :param max_results: max number of records to fetch
+        :param min_year: earliest publication year
+        :param max_year: latest publication year
+        :return: list of SearchResult
+        """
+        url = EUTILS_URL + 'esearch.fcgi?db=pubmed&retmode=json&usehistory=y&retmax=0&sort=relevance&term='
+        url += urllib.parse.quote(query)
+        if min_year or max_year:
+            url += '&datetype=pdat&mindate=%s&maxdate=%s' % (min_year or 1800, max_year or 3000)
+
+        # a WebEnv expires after a few hours, so none of this can be replayed from the cache
+        r = yield {'url': url, 'use_cache': False}
+        d = r.json()['esearchresult']
+
+        count = min(int(d['count']), max_results)
+        if not count:
+            return []
+
+        return (yield from self.fetchFromHistorySteps(d['webenv'], d['querykey'], count))
+
+    def fetchFromHistorySteps(self, webenv, query_key, count):
+        """
+        Fetches the records of a result set stored on the E-utilities history server
+
+        :param webenv: WebEnv returned by esearch
+        :param query_key: query_key returned by esearch
+        :param count: number of records to fetch
+        :return: list of SearchResult
+        """
+        results = []
+        for start in range(0, count, self.batch_size):
+            url = EUTILS_URL + 'efetch.fcgi?db=pubmed&retmode=xml&query_key=%s&WebEnv=%s&retstart=%d&retmax=%d' % (
+                query_key, webenv, start, min(self.batch_size, count - start))
+            r = yield {'url': url, 'use_cache': False}
+            results.extend(self.parseArticles(r.content, index_offset=len(results)))
+        return results
+
+    def getMetadataSteps(self, pmids: list):
         """
         Returns a dict with metadata extracted from PubMed from a PMID
 
@@ -397,166 +1077,261 @@ class PubMedScraper(NiceScraper):
         if not pmids:
             return []
 
-        if len(pmids) > 1:
-            pmids = ','.join(pmids)
-        else:
-            pmids = pmids[0]
-
-        url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&retmode=xml&id=' + pmids
-        r = self.request(url)
-
-        text = StringIO(r.content.decode('utf-8'))
-        tree = etree.parse(text)
-
-        results = []
-
-        for index, article_node in enumerate(tree.xpath('/PubmedArticleSet/PubmedArticle')):
-            new_bib = {}
-
-            article = article_node.xpath('MedlineCitation/Article')[0]
-
-            doi = article.xpath('ELocationID[@EIdType="doi"]')
-            if doi:
-                new_bib['doi'] = doi[0].text
-
-            new_bib['title'] = article.xpath('ArticleTitle')[0].text
+        pmids = [str(p) for p in pmids]
 
-            abstract = ""
-            for abs_piece in article.xpath('Abstract/AbstractText'):
-                if 'Label' in abs_piece.keys():
-                    abstract += abs_piece.get('Label') + "\n"
+        local = {}
+        if self.mirror:
+            for pmid in pmids:
+                results = self.mirror.getByPMID(pmid, source='pubmed')
+                if results:
+                    local[pmid] = results[0]
 
-                abstract += abs_piece.text + '\n'
-            new_bib['abstract'] = abstract
+        fetched = {}
+        missing = [pmid for pmid in pmids if pmid not in local]
+        if missing:
+            url = EUTILS_URL + 'efetch.fcgi?db=pubmed&retmode=xml&id=' + ','.join(missing)
+            r = yield {'url': url}
 
-            authors = []
-            for author in article.xpath('AuthorList/Author'):
-                new_author = {'given': author.xpath('ForeName')[0].text,
-                              'family': author.xpath('LastName')[0].text, }
-                authors.append(new_author)
+            for result in self.parseArticles(r.content):
+                fetched[result.extra_data['pmid']] = result
 
-            new_bib['author'] = authorListFromDict(authors)
-            if article.xpath('ArticleDate'):
-                date_node = article.xpath('ArticleDate')[0]
-            elif article_node.xpath('PubmedData/History/PubMedPubDate[@PubStatus="pubmed"]'):
-                date_node = article_node.xpath('PubmedData/History/PubMedPubDate[@PubStatus="pubmed"]')[0]
+        # in the order they were asked for
+        results = []
+        for pmid in pmids:
+            result = local.get(pmid) or fetched.get(pmid)
+            if result:
+                result.index = len(results)
+                results.append(result)
+        return results
 
-            new_bib['year'] = date_node.xpath('Year')[0].text
-            new_bib['month'] = date_node.xpath('Month')[0].text
-            new_bib['day'] = date_node.xpath('Day')[0].text
+    @staticmethod
+    def parseArticles(content, index_offset=0):
+        """
+        Parses a PubmedArticleSet XML document
 
-            new_extra = {'pmid': article_node.xpath('MedlineCitation/PMID')[0].text,
-                         'x_authors': authors,
-                         'language': article.xpath('Language')[0].text}
+        :param content: XML as bytes
+        :param index_offset: index of the first result
+        :return: list of SearchResult
+        """
+        return parsePubMedArticles(content, index_offset)
 
-            new_res = SearchResult(index, new_bib, 'pubmed', new_extra)
-            results.append(new_res)
+    def getAlternateIDs(self, pmids: list, identity=None):
+        return self.runSteps(self.getAlternateIDsSteps(pmids, identity))
 
-        return results
+    async def agetAlternateIDs(self, pmids: list, identity=None):
+        return await self.arunSteps(self.getAlternateIDsSteps(pmids, identity))
 
-    def getAlternateIDs(self, pmids: list):
+    def getAlternateIDsSteps(self, pmids: list, identity=None):
         """
-        Gets DOI and PMCID for a list of PMIDs
+        Gets DOI and PMCID for a list of PMIDs, `batch_size` PMIDs per request
 
         :param pmids: list of PMID to resolve
-        :return:
+        :param identity: email address to provide to NCBI
+        :return: dict {pmid: {'doi':..., 'pmcid':...}}, PMIDs with no record are left out
         """
-        if isinstance(pmids, list):
-            if len(pmids) > 1:
-                pmids = ','.join([str(p) for p in pmids])
-            else:
-                pmids = pmids[0]
+        if not isinstance(pmids, list):
+            pmids = [pmids]
 
+        pmids = [str(p) for p in pmids]
         res = {}
 
-        r = requests.get(
-            'https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=my_tool&email=my_email@example.com&ids=' + str(
-                pmids))
-
-        text = StringIO(r.content.decode('utf-8'))
-        tree = etree.parse(text)
-        for record in tree.xpath('/pmcids/record'):
-            new_res = {}
-            if 'pmcid' in record.keys():
-                new_res['pmcid'] = record.get('pmcid')
-            if 'doi' in record.keys():
-                new_res['doi'] = record.get('doi')
-            res[record.get('pmid')] = new_res
+        for start in range(0, len(pmids), self.batch_size):
+            batch = pmids[start:start + self.batch_size]
+            url = IDCONV_URL + '?tool=ReviewBuilder&ids=' + ','.join(batch)
+            if identity:
+                url += '&email=' + urllib.parse.quote(identity)
+
+            r = yield {'url': url}
+
+            tree = etree.parse(BytesIO(r.content))
+            for record in tree.xpath('/pmcids/record'):
+                new_res = {}
+                if 'pmcid' in record.keys():
+                    new_res['pmcid'] = record.get('pmcid')
+                if 'doi' in record.keys():
+                    new_res['doi'] = record.get('doi')
+                res[record.get('pmid')] = new_res
         return res
 
-    def enrichWithMetadata(self, paper):
-        if not paper.pmid:
-            return
-
-        if not paper.doi:
-            ids = self.getAlternateIDs(paper.pmid)
-            if 'doi' in ids[paper.pmid]:
-                paper.doi = ids[paper.pmid]['doi']
-            if 'pmcid' in ids[paper.pmid]:
-                paper.pmcid = ids[paper.pmid]['pmcid']
+    @staticmethod
+    def mergeRecord(paper, ids, result):
+        """
+        Merges what PubMed returned for a paper into it
 
-        res = self.getMetadata([paper.pmid])[0]
+        :param paper: Paper
+        :param ids: dict from getAlternateIDs() for this paper
+        :param result: SearchResult from getMetadata() for this paper, or None if there was no record
+        """
+        if 'doi' in ids and not paper.doi:
+            paper.doi = ids['doi']
+        if 'pmcid' in ids:
+            paper.pmcid = ids['pmcid']
 
-        mergeResultData(paper, res)
+        if result:
+            mergeResultData(paper, result)
 
         paper.extra_data['done_pubmed'] = True
 
+    def enrichWithMetadata(self, paper, identity=None):
+        return self.runSteps(self.enrichWithMetadataSteps(paper, identity))
 
-class arXivSearcher(NiceScraper):
-    def search(self, title, identity, max_results=5):
-        url = 'http://export.arxiv.org/api/query?search_query=title:{}&start=0&max_results={}'.format(
-            urllib.parse.quote(title), max_results)
-        r = self.request(url)
+    async def aenrichWithMetadata(self, paper, identity=None):
+        return await self.arunSteps(self.enrichWithMetadataSteps(paper, identity))
 
-        text = BytesIO(r.content)
-        tree = etree.parse(text)
+    def enrichWithMetadataSteps(self, paper, identity=None):
+        if not paper.pmid:
+            return
 
-        ns_map = {'ns': 'http://www.w3.org/2005/Atom',
-                  'arxiv': 'http://arxiv.org/schemas/atom'}
+        pmid = str(paper.pmid)
+        results = yield from self.getMetadataSteps([pmid])
+        result = results[0] if results else None
 
-        results = []
-        for index, entry in enumerate(tree.xpath('/ns:feed/ns:entry', namespaces=ns_map)):
-            new_bib = {'arxivid': entry.xpath('ns:id', namespaces=ns_map)[0].text.split('/')[-1],
-                       'title': entry.xpath('ns:title', namespaces=ns_map)[0].text,
-                       'abstract': entry.xpath('ns:summary', namespaces=ns_map)[0].text,
-                       }
+        # the record itself usually has the DOI already
+        ids = {}
+        if not paper.doi and not (result and result.bib.get('doi')):
+            ids = yield from self.getAlternateIDsSteps([pmid], identity)
 
-            published = entry.xpath('ns:published', namespaces=ns_map)[0].text
-            match = re.search(r"(\d{4})-(\d{2})-(\d{2})", published)
+        self.mergeRecord(paper, ids.get(pmid, {}), result)
 
-            new_bib['year'] = match.group(1)
-            new_bib['month'] = str(int(match.group(2)))
-            new_bib['date'] = str(int(match.group(3)))
+    def enrichWithMetadataBatch(self, papers, identity=None):
+        return self.runSteps(self.enrichWithMetadataBatchSteps(papers, identity))
 
-            authors = []
-            for author in entry.xpath('ns:author', namespaces=ns_map):
-                bits = author.xpath('ns:name', namespaces=ns_map)[0].text.split()
-                authors.append({'given': bits[0], 'family': bits[-1]})
+    async def aenrichWithMetadataBatch(self, papers, identity=None):
+        return await self.arunSteps(self.enrichWithMetadataBatchSteps(papers, identity))
 
-            new_bib['author'] = authorListFromDict(authors)
-            new_extra = {
-                'x_authors': authors,
-                'ax_main_category': entry.xpath('arxiv:primary_category', namespaces=ns_map)[0].get('term'),
+    def enrichWithMetadataBatchSteps(self, papers, identity=None):
+        """
+        Batch version of enrichWithMetadata() for papers that already have a PMID: alternate IDs
+        and records are fetched for `batch_size` papers per request and then merged back into
+        each paper.
 
-            }
+        :param papers: list of Paper
+        :param identity: email address to provide to NCBI
+        :return: list of the papers that were enriched
+        """
+        papers = [paper for paper in papers if paper.pmid]
+        if not papers:
+            return []
 
-            categories = []
-            for cat in entry.xpath('ns:category', namespaces=ns_map):
-                categories.append(cat.get('term'))
+        pmids = list(dict.fromkeys([str(paper.pmid) for paper in papers]))
+        records = {}
+        for start in range(0, len(pmids), self.batch_size):
+            for result in (yield from self.getMetadataSteps(pmids[start:start + self.batch_size])):
+                records[result.extra_data['pmid']] = result
 
-            new_extra['ax_categories'] = categories
+        # the records themselves usually have the DOI already
+        no_doi = list(dict.fromkeys([str(paper.pmid) for paper in papers if not paper.doi]))
+        no_doi = [pmid for pmid in no_doi if pmid not in records or not records[pmid].bib.get('doi')]
+        ids = yield from self.getAlternateIDsSteps(no_doi, identity)
 
-            new_res = SearchResult(index, new_bib, 'arxiv', new_extra)
+        for paper in papers:
+            pmid = str(paper.pmid)
+            self.mergeRecord(paper, ids.get(pmid, {}), records.get(pmid))
 
-            for link in entry.xpath('ns:link', namespaces=ns_map):
-                if link.get('title') == 'pdf':
-                    addUrlIfNew(new_res, link.get('href'), 'pdf', 'arxiv')
-                elif 'arxiv.org/abs/' in link.get('href'):
-                    addUrlIfNew(new_res, link.get('href'), 'main', 'arxiv')
+        return papers
 
-            results.append(new_res)
 
-        return results
+ARXIV_API_URL = 'http://export.arxiv.org/api/query'
+
+arxiv_version_regex = re.compile(r'v\d+$')
+
+
+class arXivSearcher(NiceScraper):
+    cache_ttl = 90 * 24 * 3600
+    local_match_id_types = ['arxivid']
+    # max number of ids per id_list request
+    batch_size = 200
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.entry_cache = LookupCache('arxiv_entries', ttl=self.cache_ttl, negative_ttl=7 * 24 * 3600)
+
+    def searchSteps(self, title, identity, max_results=5):
+        url = ARXIV_API_URL + '?search_query=title:{}&start=0&max_results={}'.format(
+            urllib.parse.quote(title), max_results)
+        r = yield {'url': url}
+
+        return parseArxivEntries(r.content)
+
+    @staticmethod
+    def baseID(arxivid):
+        """
+        Returns an arXiv id without its version suffix, e.g. 2001.00001v2 -> 2001.00001
+        """
+        return arxiv_version_regex.sub('', str(arxivid).strip())
+
+    def getMetadataForIDs(self, arxivids):
+        return self.runSteps(self.getMetadataForIDsSteps(arxivids))
+
+    async def agetMetadataForIDs(self, arxivids):
+        return await self.arunSteps(self.getMetadataForIDsSteps(arxivids))
+
+    def getMetadataForIDsSteps(self, arxivids):
+        """
+        Fetches the arXiv entries for a list of ids, `batch_size` ids per id_list request. Entries
+        are cached per id, so only the ones we haven't seen before are requested.
+
+        :param arxivids: list of arXiv ids, with or without version
+        :return: dict {id without version: SearchResult}, ids arXiv doesn't know about are left out
+        """
+        ids = list(dict.fromkeys([self.baseID(arxivid) for arxivid in arxivids if arxivid]))
+
+        res = {}
+        cached, missing = self.entry_cache.getMany(ids)
+        for arxivid, text in cached.items():
+            if text:
+                d = json.loads(text)
+                res[arxivid] = SearchResult(len(res), d['bib'], 'arxiv', d['extra_data'])
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            url = ARXIV_API_URL + '?id_list={}&start=0&max_results={}'.format(','.join(batch), len(batch))
+            r = yield {'url': url}
+
+            found = {}
+            for result in parseArxivEntries(r.content, index_offset=len(res)):
+                found[self.baseID(result.bib['arxivid'])] = result
+
+            to_cache = []
+            for arxivid in batch:
+                result = found.get(arxivid)
+                if result:
+                    res[arxivid] = result
+                    to_cache.append((arxivid, json.dumps({'bib': result.bib, 'extra_data': result.extra_data})))
+                else:
+                    to_cache.append((arxivid, None))
+            self.entry_cache.setMany(to_cache)
+
+        return res
+
+    def enrichWithMetadataBatch(self, papers):
+        return self.runSteps(self.enrichWithMetadataBatchSteps(papers))
+
+    async def aenrichWithMetadataBatch(self, papers):
+        return await self.arunSteps(self.enrichWithMetadataBatchSteps(papers))
+
+    def enrichWithMetadataBatchSteps(self, papers):
+        """
+        Merges the arXiv entries of papers whose arXiv id we already know into them
+
+        :param papers: list of Paper
+        :return: tuple (papers found on arXiv, papers not found)
+        """
+        papers = [paper for paper in papers if paper.arxivid]
+        entries = yield from self.getMetadataForIDsSteps([paper.arxivid for paper in papers])
+
+        found = []
+        not_found = []
+        for paper in papers:
+            result = entries.get(self.baseID(paper.arxivid))
+            if result:
+                mergeResultData(paper, result)
+                paper.extra_data['done_arxiv'] = True
+                found.append(paper)
+            else:
+                not_found.append(paper)
+
+        return found, not_found
 
 
 class GScholarScraper(NiceScraper):
@@ -571,6 +1346,8 @@ class GScholarScraper(NiceScraper):
                 text = r.content.decode('utf-8')
                 bib = readBibtexString(text)[0]
 
+            except SourceUnavailable:
+                raise
             except Exception as e:
                 print(e.__class__.__name__, e)
 
@@ -581,266 +1358,946 @@ class GScholarScraper(NiceScraper):
             paper.bib = bib
 
 
+SEMANTIC_SCHOLAR_API_URL = os.environ.get('SEMANTIC_SCHOLAR_API_URL', 'https://api.semanticscholar.org')
+
+SS_PAPER_FIELDS = ['paperId', 'externalIds', 'title', 'abstract', 'year', 'venue', 'authors', 's2FieldsOfStudy']
+
+
 class SemanticScholarScraper(NiceScraper):
+    # citation counts and lists keep growing
+    cache_ttl = 14 * 24 * 3600
+    local_match_id_types = ['ssid']
+    # can point to a local stub of the API for testing
+    api_url = SEMANTIC_SCHOLAR_API_URL
 
     @classmethod
     def loadSSAuthors(self, authors_dict):
         authors = []
         for author in authors_dict:
-            bits = author['name'].split()
+            bits = (author.get('name') or '').split()
+            if not bits:
+                continue
             new_author = {'given': bits[0], 'family': bits[-1]}
             if len(bits) > 2:
                 new_author['middle'] = " ".join(bits[1:len(bits) - 1])
             authors.append(new_author)
         return authors
 
-    def search(self, title, identity, max_results=5, min_year=None, max_year=None):
-        url = 'https://www.semanticscholar.org/api/1/search'
+    def searchSteps(self, title, identity, max_results=5, min_year=None, max_year=None):
+        """
+        Searches the Graph API for papers by title
 
-        yearFilter = None
+        :return: list of SearchResult
+        """
+        params = {'query': title,
+                  'fields': ','.join(SS_PAPER_FIELDS + ['url', 'openAccessPdf'])}
 
         if min_year or max_year:
-            yearFilter = {}
-            if not max_year:
-                now = datetime.datetime.now()
-                max_year = now.year
-
-            if min_year:
-                yearFilter['min'] = int(min_year)
-            if max_year:
-                yearFilter['max'] = int(max_year)
-
-        results_left = max_results
-        page_num = 1
+            params['year'] = '%s-%s' % (int(min_year) if min_year else '', int(max_year) if max_year else '')
 
         return_results = []
 
-        while results_left > 0:
-            data = {"queryString": title,
-                    "page": page_num,
-                    "pageSize": 10,
-                    "sort": "relevance",
-                    "authors": [],
-                    "coAuthors": [],
-                    "venues": [],
-                    "yearFilter": yearFilter,
-                    "requireViewablePdf": False,
-                    "publicationTypes": [],
-                    "externalContentTypes": []
-                    }
-
-            r = self.request(url, data=data, post=True)
+        while len(return_results) < max_results:
+            params['offset'] = len(return_results)
+            params['limit'] = min(100, max_results - len(return_results))
+            r = yield {'url': self.api_url + '/graph/v1/paper/search?' + urllib.parse.urlencode(params)}
 
             results_dict = r.json()
+            if 'data' not in results_dict:
+                raise ValueError('SemanticScholar error: ' + str(results_dict.get('error', results_dict.get('message'))))
 
-            if results_dict.get('totalResults') and max_results != results_dict['totalResults']:
-                max_results = min(max_results, results_dict['totalResults'])
-                results_left = max_results
+            for res in results_dict['data']:
+                paper = self.paperFromData(res, len(return_results))
 
-            if 'results' in results_dict:
-                results = results_dict['results']
-            else:
-                results = []
+                extra_data = dict(paper.extra_data, x_authors=self.loadSSAuthors(res.get('authors') or []))
+                if res.get('venue'):
+                    extra_data['venue'] = res['venue']
 
-            results_left -= len(results)
+                # the ID and ENTRYTYPE made up by paperFromData() shouldn't replace the paper's
+                bib = {key: value for key, value in paper.bib.items()
+                       if value is not None and key not in ('ID', 'ENTRYTYPE')}
+                new_res = SearchResult(len(return_results), bib, 'semanticscholar', extra_data)
+                if res.get('url'):
+                    new_res.bib['url'] = res['url']
 
-            for index, res in enumerate(results[:results_left]):
+                pdf = (res.get('openAccessPdf') or {}).get('url')
+                if pdf:
+                    new_res.bib['eprint'] = pdf
+                    addUrlIfNew(new_res, pdf, 'pdf', 'semanticscholar')
 
-                res_title = res['title']['text']
+                return_results.append(new_res)
 
-                authors_processed = []
-                for author_list in res['authors']:
-                    for author_dict in author_list:
-                        if 'name' in author_dict:
-                            authors_processed.append(author_dict)
+            if not results_dict['data'] or 'next' not in results_dict:
+                break
 
-                authors = self.loadSSAuthors(authors_processed)
+        return return_results[:max_results]
 
-                bib = {'title': res_title,
-                       'abstract': res['paperAbstract']['text'],
-                       'year': res['year']['text'],
-                       'url': 'https://www.semanticscholar.org/paper/{}/{}'.format(res['slug'],
-                                                                                   res['id']),
-                       'author': authorListFromDict(authors),
-                       }
+    def getMetadataSteps(self, paper, get_citing_papers=False, max_citations=1000):
+        """
+        Fetches a paper's metadata from the Semantic Scholar Graph API and merges it into the paper
 
-                if res.get('doiInfo'):
-                    bib['doi'] = res['doiInfo'].get('doi')
+        :param paper: Paper with a DOI or a Semantic Scholar id
+        :param get_citing_papers: if True, also returns up to `max_citations` papers citing it
+        :param max_citations: see above
+        :return: paper, or tuple (paper, list of citing Paper) if get_citing_papers
+        """
+        unique_id = self.getPaperID(paper)
+        if not unique_id:
+            raise ValueError('paper has no DOI or SSID')
 
-                extra_data = {
-                    'ss_id': res['id'],
-                    'x_authors': authors
-                }
+        url = self.api_url + '/graph/v1/paper/{}?fields={}'.format(urllib.parse.quote(unique_id, safe=':/'),
+                                                                   ','.join(SS_PAPER_FIELDS))
 
-                new_res = SearchResult(index, bib, 'semantischolar', extra_data)
+        r = yield {'url': url}
+        d = r.json()
 
-                for link in res.get('links', []):
-                    if isPDFURL(link['url']):
-                        bib['eprint'] = link['url']
-                        addUrlIfNew(new_res, link['url'], 'pdf', 'semanticscholar')
+        if 'error' in d or 'paperId' not in d:
+            print("SemanticScholar error:", d.get('error', d.get('message')))
+            return (paper, []) if get_citing_papers else None
 
-                venue = res['venue'].get('text')
-                extra_data['venue'] = venue
-                return_results.append(new_res)
+        self.mergePaperData(paper, d)
 
-        return return_results
+        if get_citing_papers:
+            citing_papers = yield from self.getCitationsSteps(paper, max_results=max_citations)
+            return paper, citing_papers
+        return paper
 
-    def getMetadata(self, paper, get_citing_papers=False):
-        if not paper.doi and not paper.extra_data.get('ss_id'):
+    @staticmethod
+    def getPaperID(paper):
+        """
+        Returns the id to look a paper up by in the Graph API: its Semantic Scholar id if known,
+        or else an external id with its prefix (DOI:, ARXIV:, PMID:)
+        """
+        if paper.extra_data.get('ss_id'):
+            return paper.extra_data['ss_id']
+        if paper.doi:
+            return 'DOI:' + paper.doi
+        if paper.arxivid:
+            return 'ARXIV:' + paper.arxivid
+        if paper.pmid:
+            return 'PMID:' + str(paper.pmid)
+        return None
+
+    def mergePaperData(self, paper, d):
+        """
+        Merges a Graph API paper record into a Paper
+        """
+        for field in ['abstract', 'year', 'venue']:
+            if d.get(field):
+                paper.bib[field] = str(d[field])
+
+        external_ids = d.get('externalIds') or {}
+        if external_ids.get('ArXiv'):
+            paper.arxivid = external_ids['ArXiv']
+        if external_ids.get('DOI') and not paper.doi:
+            paper.doi = external_ids['DOI']
+        if external_ids.get('PubMed') and not paper.pmid:
+            paper.pmid = external_ids['PubMed']
+
+        if d.get('authors'):
+            authors = self.loadSSAuthors(d['authors'])
+            paper.bib['author'] = authorListFromDict(authors)
+            paper.extra_data['ss_authors'] = d['authors']
+
+        if d.get('s2FieldsOfStudy'):
+            paper.extra_data['ss_topics'] = self.loadSSTopics(d['s2FieldsOfStudy'])
+
+        paper.extra_data['ss_id'] = d['paperId']
+
+    @staticmethod
+    def loadSSTopics(fields_of_study):
+        """
+        Turns the Graph API's s2FieldsOfStudy into the list of {'topic': ...} dicts that the old
+        API's topics were kept as in ss_topics
+        """
+        topics = []
+        for field in fields_of_study:
+            category = field.get('category')
+            if category and category not in [topic['topic'] for topic in topics]:
+                topics.append({'topic': category, 'source': field.get('source')})
+        return topics
+
+    def paperFromData(self, d, index=0):
+        """
+        Makes a new Paper out of a Graph API paper record
+        """
+        ss_authors = self.loadSSAuthors(d.get('authors') or [])
+        external_ids = d.get('externalIds') or {}
+
+        bib = {
+            'title': d.get('title') or '',
+            'author': authorListFromDict(ss_authors),
+            'year': d.get('year'),
+        }
+        for field, value in [('doi', external_ids.get('DOI')),
+                             ('abstract', d.get('abstract')),
+                             ('venue', d.get('venue'))]:
+            if value:
+                bib[field] = value
+
+        bib = fixBibData(bib, index)
+
+        extra_data = {
+            'ss_id': d.get('paperId'),
+            'ss_authors': d.get('authors') or [],
+        }
+        if external_ids.get('ArXiv'):
+            extra_data['arxivid'] = external_ids['ArXiv']
+        if external_ids.get('PubMed'):
+            extra_data['pmid'] = external_ids['PubMed']
+        if d.get('s2FieldsOfStudy'):
+            extra_data['ss_topics'] = self.loadSSTopics(d['s2FieldsOfStudy'])
+
+        return Paper(bib, extra_data)
+
+    def getMetadataBatch(self, papers, batch_size=500):
+        return self.runSteps(self.getMetadataBatchSteps(papers, batch_size))
+
+    async def agetMetadataBatch(self, papers, batch_size=500):
+        return await self.arunSteps(self.getMetadataBatchSteps(papers, batch_size))
+
+    def getMetadataBatchSteps(self, papers, batch_size=500):
+        """
+        Batch version of getMetadata(): looks up to `batch_size` papers per request through the
+        Graph API's paper batch endpoint and merges the results into them
+
+        :param papers: list of Paper with a DOI, Semantic Scholar id, arXiv id or PMID
+        :param batch_size: papers per request, 500 at most
+        :return: tuple (papers found, papers looked up but not found)
+        """
+        to_fetch = [(paper, self.getPaperID(paper)) for paper in papers]
+        to_fetch = [(paper, paper_id) for paper, paper_id in to_fetch if paper_id]
+
+        url = self.api_url + '/graph/v1/paper/batch?fields=' + ','.join(SS_PAPER_FIELDS)
+
+        found = []
+        not_found = []
+        for start in range(0, len(to_fetch), batch_size):
+            batch = to_fetch[start:start + batch_size]
+            r = yield {'url': url, 'data': {'ids': [paper_id for _, paper_id in batch]}, 'post': True}
+            records = r.json()
+            if not isinstance(records, list):
+                raise ValueError('SemanticScholar error: ' + str(records.get('error', records.get('message'))))
+
+            # the response has one entry per id, in order, with null for unknown ids
+            for (paper, _), d in zip(batch, records):
+                if d:
+                    self.mergePaperData(paper, d)
+                    found.append(paper)
+                else:
+                    not_found.append(paper)
+
+        return found, not_found
+
+    def getCitations(self, paper, max_results=1000, page_size=100):
+        return self.runSteps(self.getCitationsSteps(paper, max_results, page_size))
+
+    async def agetCitations(self, paper, max_results=1000, page_size=100):
+        return await self.arunSteps(self.getCitationsSteps(paper, max_results, page_size))
+
+    def getReferences(self, paper, max_results=1000, page_size=100):
+        return self.runSteps(self.getCitationsSteps(paper, max_results, page_size, references=True))
+
+    async def agetReferences(self, paper, max_results=1000, page_size=100):
+        return await self.arunSteps(self.getCitationsSteps(paper, max_results, page_size, references=True))
+
+    def getCitationsSteps(self, paper, max_results=1000, page_size=100, references=False):
+        """
+        Pages through the papers citing a paper (or the papers it cites), stopping once
+        `max_results` have been retrieved. Each one comes with its metadata, so there's no
+        need to look them up again.
+
+        :param paper: Paper with a DOI or a Semantic Scholar id
+        :param max_results: budget of papers to retrieve
+        :param page_size: papers per request, 1000 at most
+        :param references: if True, returns the papers this paper cites instead
+        :return: list of Paper
+        """
+        unique_id = self.getPaperID(paper)
+        if not unique_id:
             raise ValueError('paper has no DOI or SSID')
 
-        if paper.extra_data.get('ss_id'):
-            unique_id = paper.extra_data.get('ss_id')
+        if references:
+            endpoint, key = 'references', 'citedPaper'
         else:
-            unique_id = paper.doi
+            endpoint, key = 'citations', 'citingPaper'
 
-        url = 'https://api.semanticscholar.org/v1/paper/' + unique_id
+        url = self.api_url + '/graph/v1/paper/{}/{}?fields={}'.format(urllib.parse.quote(unique_id, safe=':/'),
+                                                                      endpoint,
+                                                                      ','.join(SS_PAPER_FIELDS + ['isInfluential']))
 
-        r = self.request(url)
-        d = r.json()
+        papers = []
+        offset = 0
+        while len(papers) < max_results:
+            limit = min(page_size, max_results - len(papers))
+            r = yield {'url': url + '&offset={}&limit={}'.format(offset, limit)}
+            d = r.json()
 
-        if 'error' in d:
-            print("SemanticScholar error:", d['error'])
-            return
+            if 'data' not in d:
+                print("SemanticScholar error:", d.get('error', d.get('message')))
+                break
 
-        for field in ['abstract', 'year', 'venue']:
-            if d.get(field):
-                paper.bib[field] = str(d[field])
+            for item in d['data']:
+                if not item.get(key) or not item[key].get('paperId'):
+                    continue
+                new_paper = self.paperFromData(item[key], len(papers))
+                new_paper.extra_data['ss_influential'] = item.get('isInfluential', False)
+                papers.append(new_paper)
 
-        if d.get('arxivId'):
-            paper.arxivid = d['arxivId']
+            if d.get('next') is None or not d['data']:
+                break
+            offset = d['next']
 
-        for topic in d['topics']:
-            # we really don't need to store the url, it's just
-            # https://www.semanticscholar.org/topic/{topicId}
-            del topic['url']
+        return papers[:max_results]
 
-        authors = self.loadSSAuthors(d['authors'])
-        paper.bib['author'] = authorListFromDict(authors)
 
-        paper.extra_data['ss_topics'] = d['topics']
-        paper.extra_data['ss_authors'] = d['authors']
-        paper.extra_data['ss_id'] = d['paperId']
+class DOIResolver(NiceScraper):
+    """
+    Gets BibTeX for DOIs from doi.org content negotiation, so that those lookups have the same
+    rate limits, deadlines, circuit breaker and metrics as the other sources
+    """
+    # the BibTeX is also kept in doi_bibtex_cache
+    cache_ttl = 180 * 24 * 3600
+    local_match_id_types = ['doi']
 
-        if get_citing_papers:
-            citing_papers = []
-            for index, citation in enumerate(d['citations']):
-                ss_authors = semanticscholarmetadata.loadSSAuthors(citation['authors'])
-                authors = authorListFromDict(ss_authors)
-
-                bib = {
-                    'title': citation['title'],
-                    'author': authors,
-                    'year': citation['year'],
-                    'doi': citation['year'],
-                }
-                bib = fixBibData(bib, index)
-
-                extra_data = {
-                    'ss_id': citation['paperId'],
-                    'ss_influential': citation['isInfluential'],
-                    'ss_authors': ss_authors
-                }
-                if citation.get('arxivId'):
-                    extra_data['arxivid'] = citation.get('arxivId')
-
-                new_paper = Paper(bib, extra_data)
-                citing_papers.append(new_paper)
-            return paper, citing_papers
-        return paper
+    def getBibtex(self, doi, cache=None):
+        return self.runSteps(self.getBibtexSteps(doi, cache))
+
+    async def agetBibtex(self, doi, cache=None):
+        return await self.arunSteps(self.getBibtexSteps(doi, cache))
+
+    def getBibtexSteps(self, doi, cache=None):
+        """
+        :param doi: DOI to resolve
+        :param cache: optional LookupCache of DOI -> BibTeX text. DOIs that resolve to nothing are
+            cached as negatives
+        :return: list of bib dicts, empty if the DOI couldn't be resolved
+        """
+        assert doi
+        if cache:
+            found, text = cache.get(doi)
+            if found:
+                return readBibtexString(text) if text else []
+
+        r = yield {'url': 'https://doi.org/' + doi, 'headers': {'Accept': 'text/bibliography; style=bibtex'}}
+        text = r.content.decode('utf-8')
+        bib = readBibtexString(text) if r.status_code == 200 else []
+
+        if cache:
+            if bib:
+                cache.set(doi, text)
+            elif r.status_code in [200, 404]:
+                # only remember definite failures, not server errors
+                cache.set(doi, None)
+        return bib
 
 
 crossref_scraper = CrossrefScraper()
-scholar_scraper = GScholarScraper(basic_delay=0.1)
-unpaywall_scraper = UnpaywallScraper(rate_limit=100000, rate_interval='24h')
-pubmed_scraper = PubMedScraper()
-arxiv_scraper = arXivSearcher()
-semanticscholarmetadata = SemanticScholarScraper()
+# Scholar blocks clients that look like bots, so no duplicate requests
+scholar_scraper = GScholarScraper(basic_delay=0.1, hedge=False)
+unpaywall_scraper = UnpaywallScraper(rate_limit=100000, rate_interval='24h', timeout=(5, 15), request_deadline=30.)
+# NCBI allows 3 requests per second without an API key, arXiv asks for one every 3 seconds.
+# efetch and the batch endpoint return hundreds of records at a time
+pubmed_scraper = PubMedScraper(rate_limit=3, rate_interval=1, timeout=(5, 60), request_deadline=120.)
+arxiv_scraper = arXivSearcher(rate_limit=1, rate_interval=3, timeout=(5, 60), request_deadline=120.)
+semanticscholarmetadata = SemanticScholarScraper(timeout=(5, 60), request_deadline=120.)
+doi_resolver = DOIResolver(timeout=(5, 30), request_deadline=60.)
+
+all_scrapers = [crossref_scraper, scholar_scraper, unpaywall_scraper, pubmed_scraper, arxiv_scraper,
+                semanticscholarmetadata, doi_resolver]
+
+
+def getSourceStates():
+    """
+    Returns the concurrency, backoff, circuit breaker and hedging state of every source, for
+    monitoring
+    """
+    return {scraper.source_name: dict(scraper.getConcurrencyState(), breaker=scraper.breaker.getState(),
+                                      hedging=scraper.hedger.getStats())
+            for scraper in all_scrapers}
+
+
+def getMetrics():
+    """
+    Returns the request metrics of every source, see NiceScraper.getMetrics()
+    """
+    return {scraper.source_name: scraper.getMetrics() for scraper in all_scrapers}
+
+
+def getProgressLine():
+    """
+    Returns one short line with how many requests each source has made so far, how fast and
+    how slow they are, for showing next to a progress bar
+    """
+    return formatProgressLine({scraper.source_name: scraper.metrics.getSnapshot() for scraper in all_scrapers})
+
+
+def dumpMetrics(filename):
+    """
+    Writes the request metrics of every source to a JSON file, and prints the summary line
+    """
+    writeMetrics(getMetrics(), filename)
+    line = getProgressLine()
+    if line:
+        print(line)
+    print('Request metrics written to', filename)
+
+
+def startMetricsStream(filename, interval=30.):
+    """
+    Appends the request metrics of every source to a JSON lines file every `interval` seconds
+    until the returned MetricsStream is stopped
+    """
+    return MetricsStream(getMetrics, filename, interval).start()
+
+
+def useLocalStore(paperstore):
+    """
+    Makes title searches on every source try to match the paper against the papers already in
+    `paperstore` and the local reference mirror first. None goes back to always searching
+    """
+    if not paperstore:
+        for scraper in all_scrapers:
+            scraper.useLocalMatcher(None)
+        return
+
+    def findLocalMatches(paper):
+        candidates = [SearchResult(index, candidate.bib, 'local', candidate.extra_data)
+                      for index, candidate in enumerate(paperstore.findMatchCandidates(paper.title))]
+        if reference_mirror:
+            candidates.extend(reference_mirror.findByTitle(paper.title))
+        return candidates
+
+    for scraper in all_scrapers:
+        scraper.useLocalMatcher(findLocalMatches)
+
+
+def getLocalMatchStats():
+    """
+    Returns how many title searches on each source were saved by a local match
+    """
+    return {scraper.source_name: scraper.remote_searches_skipped for scraper in all_scrapers}
+
+
+def getCoalescingStats():
+    """
+    Returns how many requests to each source were saved by sharing the response of an identical
+    one, see RequestCoalescer
+    """
+    return {scraper.source_name: scraper.coalescer.getStats() for scraper in all_scrapers}
+
+
+response_cache = None
+
+
+def useResponseCache(cache):
+    """
+    Sets the ResponseCache used by all the scrapers. None disables caching
+
+    :param cache: ResponseCache or None
+    """
+    global response_cache
+    response_cache = cache
+    for scraper in all_scrapers:
+        scraper.response_cache = cache
+
+
+def setOfflineMode(offline=True):
+    """
+    In offline mode, scrapers only answer from the response cache and never go to the network
+    """
+    if offline and not response_cache:
+        raise ValueError('Offline mode needs the response cache')
+    response_cache.offline = offline
+
+
+def useUnpaywallSnapshot(db_file=UNPAYWALL_SNAPSHOT_FILE):
+    """
+    Makes the Unpaywall scraper look DOIs up in a local snapshot index (see
+    import_unpaywall_snapshot.py) before going to the API. None stops using it
+    """
+    unpaywall_scraper.useSnapshot(UnpaywallSnapshot(db_file) if db_file else None)
+
+
+reference_mirror = None
+
+
+def useReferenceMirror(db_file=REFERENCE_MIRROR_FILE):
+    """
+    Makes enrichment look papers up in a local ReferenceMirror of metadata dumps (see
+    import_metadata_dump.py) before going to the network. None stops using it
+    """
+    global reference_mirror
+    reference_mirror = ReferenceMirror(db_file) if db_file else None
+    pubmed_scraper.useMirror(reference_mirror)
+
+
+def useLocalData(cache_responses=True, unpaywall_snapshot=None, mirror=None):
+    """
+    Sets up the local data the command line scripts use: the response cache, and the Unpaywall
+    snapshot and reference mirror, from the files given or from their default paths if they've
+    been built there
+
+    :param cache_responses: if True, HTTP responses are cached in a ResponseCache
+    :param unpaywall_snapshot: SQLite file of an Unpaywall snapshot index, or None
+    :param mirror: SQLite file of a ReferenceMirror, or None
+    """
+    if cache_responses:
+        useResponseCache(ResponseCache())
+
+    if not unpaywall_snapshot and os.path.exists(UNPAYWALL_SNAPSHOT_FILE):
+        unpaywall_snapshot = UNPAYWALL_SNAPSHOT_FILE
+    if unpaywall_snapshot:
+        useUnpaywallSnapshot(unpaywall_snapshot)
+
+    if not mirror and os.path.exists(REFERENCE_MIRROR_FILE):
+        mirror = REFERENCE_MIRROR_FILE
+    if mirror:
+        useReferenceMirror(mirror)
+
+
+def matchFromMirror(paper):
+    """
+    Looks a paper up in the local reference mirror, by DOI or PMID if it has one, or else by
+    normalized title (checked with the same rules as matchPaperFromResults()), and merges in
+    whatever is found
+
+    :param paper: Paper
+    :return: True if the paper was found in the mirror
+    """
+    if not reference_mirror:
+        return False
+
+    if paper.doi:
+        results = reference_mirror.getByDOI(paper.doi)
+    elif paper.pmid:
+        results = reference_mirror.getByPMID(paper.pmid)
+    elif paper.title:
+        top_res = selectBestMatch(paper, reference_mirror.findByTitle(paper.title))
+        results = [top_res] if top_res else []
+    else:
+        results = []
+
+    for result in results:
+        mergeResultData(paper, result)
+
+    return bool(results)
+
+
+def shareRateLimitsAcrossProcesses(db_file):
+    """
+    Makes all the scrapers keep their rate limit state in `db_file`, so several enrichment
+    processes running on the same machine stay within each API's limits together
+    """
+    for scraper in all_scrapers:
+        scraper.useSharedRateLimits(db_file)
 
 
-def enrichAndUpdateMetadata(papers, paperstore, identity):
+def setRateShares(shares):
+    """
+    Limits each source to a fraction of its rate limit
+
+    :param shares: dict {source name: share between 0 and 1}. Sources not in it get all of theirs
+    """
+    for scraper in all_scrapers:
+        scraper.setRateShare(shares.get(scraper.source_name, 1.))
+
+
+doi_bibtex_cache = LookupCache('doi_bibtex', ttl=180 * 24 * 3600, negative_ttl=7 * 24 * 3600)
+# BibTeX we made ourselves out of Crossref records is kept apart from what doi.org returned, so
+# resolveBibtexForDOI() never serves it as if it came from there
+crossref_bibtex_cache = LookupCache('crossref_bibtex', ttl=180 * 24 * 3600)
+
+
+def resolveBibtexForDOI(doi):
+    """
+    Gets the BibTeX for a DOI from doi.org through the DOI -> BibTeX cache, which is all we can
+    use in offline mode
+    """
+    if response_cache and response_cache.offline:
+        found, text = doi_bibtex_cache.get(doi)
+        if not found:
+            raise OfflineCacheMiss('doi.org: %s is not in the DOI cache' % doi)
+        return readBibtexString(text) if text else []
+
+    return doi_resolver.getBibtex(doi, cache=doi_bibtex_cache)
+
+
+def resolveBibtexForDOIs(dois, identity, batch_size=50):
+    """
+    Batch version of resolveBibtexForDOI(). Serves what it can from the DOI -> BibTeX caches and
+    fetches the rest from Crossref in batches of `batch_size` DOIs per request. DOIs that Crossref
+    doesn't know about (e.g. DataCite DOIs) fall back to doi.org content negotiation.
+
+    :param dois: list of DOIs to resolve
+    :param identity: email address to provide to Crossref
+    :param batch_size: number of DOIs per Crossref request
+    :return: dict {doi: list of bib dicts}, with an empty list for DOIs that couldn't be resolved
+    """
+    res = {}
+    cached, missing = doi_bibtex_cache.getMany(dois)
+    built, missing = crossref_bibtex_cache.getMany(missing)
+    for doi, text in list(cached.items()) + list(built.items()):
+        res[doi] = readBibtexString(text) if text else []
+
+    # commas would break the filter syntax
+    not_batchable = [doi for doi in missing if ',' in doi]
+    missing = [doi for doi in missing if ',' not in doi]
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        try:
+            found = crossref_scraper.getMetadataForDOIs(batch, identity)
+        except Exception as e:
+            print('Error during resolveBibtexForDOIs()', e.__class__.__name__, e)
+            found = {}
+
+        to_cache = []
+        for doi in batch:
+            result = found.get(doi.lower())
+            if result:
+                bib = fixBibData(dict(result.bib), 0)
+                text = writeBibtexString([bib])
+                to_cache.append((doi, text))
+                res[doi] = readBibtexString(text)
+            else:
+                not_batchable.append(doi)
+        crossref_bibtex_cache.setMany(to_cache)
+
+    for doi in not_batchable:
+        res[doi] = resolveBibtexForDOI(doi)
+
+    return res
+
+
+def matchOnCrossref(papers, identity):
+    """
+    Batch version of the Crossref step of enrichMetadata(): finds DOIs for papers that don't have
+    one and merges in the BibTeX for those DOIs
+
+    :param papers: list of Paper without a DOI
+    :param identity: email address to provide to Crossref
+    """
+    matched, unmatched, _ = crossref_scraper.bulkSearchCrossref(papers, identity)
+
+    bibs = resolveBibtexForDOIs([paper.doi for paper in matched if paper.doi], identity)
+    for paper in matched:
+        new_bib = bibs.get(paper.doi)
+        if new_bib:
+            mergeResultData(paper, SearchResult(1, new_bib[0], 'crossref', paper.extra_data))
+
+    for paper in matched + unmatched:
+        paper.extra_data['done_crossref'] = True
+
+
+def enrichAndUpdateMetadata(papers, paperstore, identity, workers_per_source=4, resumable=True, planner=None):
+    """
+    Enriches the metadata of a list of papers and saves them to the paperstore as they finish
+
+    :param papers: list of Paper
+    :param paperstore: PaperStore, or None to only enrich the papers in memory
+    :param identity: email address to provide to the APIs
+    :param workers_per_source: worker threads for each source, so different papers can be at
+        different sources at the same time. 0 or None goes through the papers one at a time.
+    :param resumable: if True, the progress of every paper is saved as it goes in the paperstore's
+        enrichment_jobs table, so an interrupted run can be picked up where it stopped
+    :param planner: EnrichmentPlanner to choose the order of the sources for each paper, or None
+        to always go through them in the order of ENRICHMENT_STAGES
+    :return: tuple (successful, unsuccessful) lists of Paper
+    """
     successful = []
     unsuccessful = []
 
-    for paper in tqdm(papers, desc='Enriching metadata'):
+    tracker = None
+    if paperstore and resumable:
+        tracker = EnrichmentJobTracker(paperstore)
+        tracker.start(papers, ENRICHMENT_STAGES)
+
+    # whatever is in the local mirror doesn't need to go to the network at all
+    for paper in papers:
+        paper.title = basicTitleCleaning(paper.title)
         try:
-            enrichMetadata(paper, identity)
-            successful.append(paper)
+            # ids found for this paper before, under any of its other ids, save a lookup each
+            if paperstore:
+                paperstore.fillIdentifiers(paper)
+            matchFromMirror(paper)
         except Exception as e:
-            print(e.__class__.__name__, e)
+            print('Error during local mirror lookup', e.__class__.__name__, e)
+
+    if tracker:
+        for paper in papers:
+            tracker.save(paper, commit=False)
+        paperstore.conn.commit()
+
+    # papers that already have a PMID get their PubMed records in a few batched requests up front
+    runBatchStage('pubmed_by_pmid', papers, lambda batch: pubmed_scraper.enrichWithMetadataBatch(batch, identity),
+                  pubmed_scraper.batch_size, tracker, planner)
+
+    # and papers without a DOI are matched on Crossref concurrently
+    runBatchStage('crossref', papers, lambda batch: matchOnCrossref(batch, identity), 100, tracker, planner)
+
+    # then Semantic Scholar for everything that has a DOI by now, up to 500 papers per request
+    def semanticScholarBatch(batch):
+        found, not_found = semanticscholarmetadata.getMetadataBatch(batch)
+        for paper in found + not_found:
+            paper.extra_data['done_semanticscholar'] = True
+
+    runBatchStage('semanticscholar_by_doi', papers, semanticScholarBatch, 500, tracker, planner)
+
+    # arXiv isn't batched up front: it comes after the title searches, which often find the abstract
+    # already. enrichFromArxiv() still looks papers with an arXiv id up by id.
+
+    def savePaper(paper):
+        if tracker:
+            tracker.save(paper)
+        elif paperstore:
+            paperstore.updatePapers([paper])
+
+    if not workers_per_source:
+        put_off = 0
+        try:
+            progress = tqdm(papers, desc='Enriching metadata')
+            for paper in progress:
+                progress.set_postfix_str(getProgressLine(), refresh=False)
+                try:
+                    put_off += enrichMetadata(paper, identity, use_mirror=False, tracker=tracker, planner=planner)
+                    successful.append(paper)
+                except Exception as e:
+                    print(e.__class__.__name__, e)
+                    unsuccessful.append(paper)
+
+                savePaper(paper)
+        finally:
+            if tracker:
+                tracker.stop()
+
+        reportPutOff(put_off)
+        return successful, unsuccessful
+
+    original_titles = {}
+
+    def onStart(paper):
+        original_titles[id(paper)] = startEnrichment(paper, use_mirror=False)
+
+    def onFinish(paper, error):
+        if error is None:
+            try:
+                finishEnrichment(paper, original_titles[id(paper)])
+            except Exception as e:
+                error = e
+
+        if error is None:
+            successful.append(paper)
+        else:
+            print(error.__class__.__name__, error)
             unsuccessful.append(paper)
 
-        paperstore.updatePapers([paper])
+        savePaper(paper)
 
+    scheduler = EnrichmentScheduler(ENRICHMENT_STAGES, identity, workers_per_source,
+                                    on_start=onStart, on_finish=onFinish, tracker=tracker,
+                                    planner=planner, describe=getProgressLine)
+    scheduler.run(papers)
+
+    reportPutOff(scheduler.put_off)
     return successful, unsuccessful
 
 
-def enrichMetadata(paper: Paper, identity):
+def runBatchStage(stage_name, papers, run_batch, batch_size, tracker=None, planner=None):
     """
-    Tries to retrieve metadata from Crossref and abstract from SemanticScholar for a given paper,
-    Google Scholar bib if all else fails
+    Runs the batch version of one of the ENRICHMENT_STAGES on the papers that need it,
+    `batch_size` papers at a time. With a tracker, the job of each paper is claimed first, and as
+    soon as its batch is done the paper is saved and the job finished, so an interrupted run only
+    loses the batch it was on.
 
-    :param paper: Paper instance
+    Papers the batch doesn't take care of, or whose batch fails, have their job put back to be
+    tried again one paper at a time.
+
+    With a planner, a paper only goes into the batch if the stage is the next one its plan would
+    take it to, so sources the planner puts later or drops aren't called for it up front.
+
+    :param stage_name: name of the stage in ENRICHMENT_STAGES
+    :param run_batch: function(list of Paper) that enriches them in place
+    :param planner: EnrichmentPlanner, or None
     """
-    paper.title = basicTitleCleaning(paper.title)
-    original_title = paper.title
+    stage = [stage for stage in ENRICHMENT_STAGES if stage.name == stage_name][0]
+    papers = [paper for paper in papers if stage.isNeeded(paper)]
+    if planner:
+        papers = [paper for paper in papers if
+                  next((planned for planned in planner.planStages(paper, ENRICHMENT_STAGES).stages
+                        if planned.isNeeded(paper)), None) is stage]
+
+    for start in range(0, len(papers), batch_size):
+        batch = papers[start:start + batch_size]
+        if tracker:
+            claimed = []
+            for paper in batch:
+                try:
+                    if tracker.claim(paper, stage):
+                        claimed.append(paper)
+                except JobNotEligible:
+                    pass
+            batch = claimed
+        if not batch:
+            continue
+
+        started = time()
+        error = None
+        try:
+            run_batch(batch)
+        except Exception as e:
+            # whatever is left will be tried again one paper at a time
+            print('Error during %s batch' % stage_name, e.__class__.__name__, e)
+            error = e
 
-    if paper.pmid and not paper.extra_data.get("done_pubmed"):
-        pubmed_scraper.enrichWithMetadata(paper)
-        paper.extra_data['done_pubmed'] = True
+        if not tracker:
+            continue
 
-    # if we don't have a DOI, we need to find it on Crossref
-    if not paper.doi and not paper.extra_data.get('done_crossref', False):
-        crossref_scraper.matchPaperFromResults(paper, identity)
+        seconds = (time() - started) / len(batch)
+        for paper in batch:
+            if error is None and not stage.isNeeded(paper):
+                tracker.done(paper, stage, None, seconds)
+            else:
+                tracker.putOff(paper, stage, error)
 
-        if paper.doi:
-            new_bib = getBibtextFromDOI(paper.doi)
-            paper = mergeResultData(paper,
-                                    SearchResult(1, new_bib[0], 'crossref', paper.extra_data))
-        paper.extra_data['done_crossref'] = True
 
-    # if we have a DOI and we haven't got the abstract yet
-    if paper.doi and not paper.extra_data.get('done_semanticscholar'):
-        semanticscholarmetadata.getMetadata(paper)
-        paper.extra_data['done_semanticscholar'] = True
-
-    # try PubMed if we still don't have a  PMID
-    if not paper.pmid and not paper.extra_data.get('done_pubmed'):
-        # if (not paper.doi or not paper.has_full_abstract) and not paper.pmid and not paper.extra_data.get('done_pubmed'):
-        if pubmed_scraper.matchPaperFromResults(paper, identity, ok_title_distance=0.4):
-            pubmed_scraper.enrichWithMetadata(paper)
-        paper.extra_data['done_pubmed'] = True
+def reportPutOff(put_off):
+    if put_off:
+        print('%d lookups were put off because their source was unavailable, run again to retry them' % put_off)
 
-    # still no DOI? maybe we can get something from SemanticScholar
-    if not paper.extra_data.get('ss_id') and not paper.extra_data.get('done_semanticscholar'):
-        semanticscholarmetadata.matchPaperFromResults(paper, identity)
-        paper.extra_data['done_semanticscholar'] = True
 
-    # # time to try Scopus, see if it's behind a paywall
-    # if not paper.doi and not paper.extra_data.get('done_scopus'):
-    #     semanticscholarmetadata.getMetadata(paper)
-    #     paper.extra_data['done_semanticscholar'] = True
+def startEnrichment(paper, use_mirror=True):
+    """
+    First thing done to a paper before it goes through the ENRICHMENT_STAGES
+
+    :return: the title of the paper before enrichment
+    """
+    paper.title = basicTitleCleaning(paper.title)
 
-    # if we don't have an abstract maybe it's on arXiv
-    if not paper.has_full_abstract and not paper.extra_data.get('done_arxiv'):
-        # if not paper.extra_data.get('done_arxiv'):
-        arxiv_scraper.matchPaperFromResults(paper, identity, ok_title_distance=0.35)
-        paper.extra_data['done_arxiv'] = True
+    if use_mirror:
+        matchFromMirror(paper)
 
-    # try to get open access links if DOI present and missing PDF link
-    if not paper.has_pdf_link and paper.doi and not paper.extra_data.get('done_unpaywall'):
-        unpaywall_scraper.getMetadata(paper, identity)
-        paper.extra_data['done_unpaywall'] = True
+    return paper.title
 
-    # if all else has failed but we have a link to Google Scholar bib data, get that
-    if not paper.year and paper.extra_data.get('url_scholarbib'):
-        scholar_scraper.getBibtex(paper)
 
+def finishEnrichment(paper, original_title):
+    """
+    Last thing done to a paper after it has gone through the ENRICHMENT_STAGES
+    """
     if paper.title != original_title:
         print('Original: %s\nNew: %s' % (original_title, paper.title))
     paper.bib = fixBibData(paper.bib, 1)
 
 
+def enrichFromPubMedByPMID(paper, identity):
+    pubmed_scraper.enrichWithMetadata(paper, identity)
+    paper.extra_data['done_pubmed'] = True
+
+
+def enrichFromCrossref(paper, identity):
+    crossref_scraper.matchPaperFromResults(paper, identity)
+
+    if paper.doi:
+        new_bib = resolveBibtexForDOI(paper.doi)
+        if new_bib:
+            mergeResultData(paper, SearchResult(1, new_bib[0], 'crossref', paper.extra_data))
+    paper.extra_data['done_crossref'] = True
+
+
+def enrichFromSemanticScholarByDOI(paper, identity):
+    semanticscholarmetadata.getMetadata(paper)
+    paper.extra_data['done_semanticscholar'] = True
+
+
+def enrichFromPubMedByTitle(paper, identity):
+    if pubmed_scraper.matchPaperFromResults(paper, identity, ok_title_distance=0.4):
+        pubmed_scraper.enrichWithMetadata(paper, identity)
+    paper.extra_data['done_pubmed'] = True
+
+
+def enrichFromSemanticScholarByTitle(paper, identity):
+    semanticscholarmetadata.matchPaperFromResults(paper, identity)
+    paper.extra_data['done_semanticscholar'] = True
+
+
+def enrichFromArxiv(paper, identity):
+    found = []
+    if paper.arxivid:
+        found, _ = arxiv_scraper.enrichWithMetadataBatch([paper])
+    # the fuzzy title search is only for when we don't know the arXiv id
+    if not found:
+        arxiv_scraper.matchPaperFromResults(paper, identity, ok_title_distance=0.35)
+    paper.extra_data['done_arxiv'] = True
+
+
+def enrichFromUnpaywall(paper, identity):
+    unpaywall_scraper.getMetadata(paper, identity)
+    paper.extra_data['done_unpaywall'] = True
+
+
+def enrichFromScholarBib(paper, identity):
+    scholar_scraper.getBibtex(paper)
+
+
+# The steps of enrichMetadata(), in order. Each runs only if its condition holds when the paper
+# gets to it, given what the steps before it found, and is put off while its source's circuit
+# breaker is open.
+ENRICHMENT_STAGES = [
+    # we already know the PMID
+    EnrichmentStage('pubmed_by_pmid', 'pubmed',
+                    lambda paper: paper.pmid and not paper.extra_data.get('done_pubmed'),
+                    enrichFromPubMedByPMID, pubmed_scraper.isAvailable),
+    # if we don't have a DOI, we need to find it on Crossref
+    EnrichmentStage('crossref', 'crossref',
+                    lambda paper: not paper.doi and not paper.extra_data.get('done_crossref', False),
+                    enrichFromCrossref, crossref_scraper.isAvailable),
+    # if we have a DOI and we haven't got the abstract yet
+    EnrichmentStage('semanticscholar_by_doi', 'semanticscholar',
+                    lambda paper: paper.doi and not paper.extra_data.get('done_semanticscholar'),
+                    enrichFromSemanticScholarByDOI, semanticscholarmetadata.isAvailable),
+    # try PubMed if we still don't have a PMID
+    EnrichmentStage('pubmed_by_title', 'pubmed',
+                    lambda paper: not paper.pmid and not paper.extra_data.get('done_pubmed'),
+                    enrichFromPubMedByTitle, pubmed_scraper.isAvailable),
+    # still no DOI? maybe we can get something from SemanticScholar
+    EnrichmentStage('semanticscholar_by_title', 'semanticscholar',
+                    lambda paper: not paper.extra_data.get('ss_id') and
+                                  not paper.extra_data.get('done_semanticscholar'),
+                    enrichFromSemanticScholarByTitle, semanticscholarmetadata.isAvailable),
+    # if we don't have an abstract maybe it's on arXiv
+    EnrichmentStage('arxiv', 'arxiv',
+                    lambda paper: not paper.has_full_abstract and not paper.extra_data.get('done_arxiv'),
+                    enrichFromArxiv, arxiv_scraper.isAvailable),
+    # try to get open access links if DOI present and missing PDF link
+    EnrichmentStage('unpaywall', 'unpaywall',
+                    lambda paper: not paper.has_pdf_link and paper.doi and
+                                  not paper.extra_data.get('done_unpaywall'),
+                    enrichFromUnpaywall, unpaywall_scraper.isAvailable),
+    # if all else has failed but we have a link to Google Scholar bib data, get that
+    EnrichmentStage('scholar_bib', 'scholar',
+                    lambda paper: not paper.year and paper.extra_data.get('url_scholarbib'),
+                    enrichFromScholarBib, scholar_scraper.isAvailable),
+]
+
+
+def enrichMetadata(paper: Paper, identity, use_mirror=True, tracker=None, planner=None):
+    """
+    Tries to retrieve metadata from Crossref and abstract from SemanticScholar for a given paper,
+    Google Scholar bib if all else fails
+
+    :param paper: Paper instance
+    :param use_mirror: if True, the local reference mirror is tried before any network call
+    :param tracker: EnrichmentJobTracker to record the progress of the paper in, or None
+    :param planner: EnrichmentPlanner to choose the order of the sources, or None
+    :return: number of lookups put off because their source was unavailable
+    """
+    original_title = startEnrichment(paper, use_mirror)
+    plan = planner.planStages(paper, ENRICHMENT_STAGES) if planner else None
+    put_off = runStagesSequentially(ENRICHMENT_STAGES, paper, identity, tracker, plan)
+    finishEnrichment(paper, original_title)
+    return put_off
+
+
 def test():
     title = 'NegBio: a high-performance tool for negation and uncertainty detection in radiology reports'
 
@@ -0,0 +1,186 @@
+import json
+import threading
+from bisect import bisect_left
+from time import time, strftime, localtime
+
+# upper bounds of the latency histogram buckets, in seconds. The last bucket has no bound.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.]
+
+
+class SourceMetrics:
+    """
+    Counts what happens to the requests made to one source: how long they take (as a
+    histogram), their status codes, bytes received, exceptions, retries, time spent waiting for
+    the rate limit and responses served from the cache.
+
+    Safe to update from any number of threads and asyncio tasks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time()
+
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.
+        self.latency_max = 0.
+        self.status_codes = {}
+        self.errors = {}
+        self.bytes_received = 0
+        self.retries = 0
+        self.rate_limit_waits = 0
+        self.rate_limit_wait_seconds = 0.
+        self.cache_hits = 0
+
+    def recordLatency(self, seconds):
+        self.latency_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def recordResponse(self, status_code, seconds, num_bytes=0, retries=0):
+        """
+        :param retries: retries the session made before it got this response
+        """
+        with self.lock:
+            self.recordLatency(seconds)
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+            self.bytes_received += num_bytes
+            self.retries += retries
+
+    def recordError(self, error, seconds):
+        with self.lock:
+            self.recordLatency(seconds)
+            name = error.__class__.__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def recordRetry(self):
+        with self.lock:
+            self.retries += 1
+
+    def recordRateLimitWait(self, seconds):
+        with self.lock:
+            self.rate_limit_waits += 1
+            self.rate_limit_wait_seconds += seconds
+
+    def recordCacheHit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def getPercentile(self, fraction):
+        """
+        Estimates a latency percentile from the histogram, as the upper bound of its bucket
+
+        :return: seconds, or None if there are no requests
+        """
+        total = sum(self.latency_counts)
+        if not total:
+            return None
+
+        seen = 0
+        for index, count in enumerate(self.latency_counts):
+            seen += count
+            if seen >= fraction * total:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.latency_max
+        return self.latency_max
+
+    def getSnapshot(self):
+        """
+        :return: dict with all the counts so far, JSON serializable
+        """
+        with self.lock:
+            requests = sum(self.latency_counts)
+            elapsed = max(time() - self.started, 1e-6)
+            buckets = ['<=%g' % bound for bound in LATENCY_BUCKETS] + ['>%g' % LATENCY_BUCKETS[-1]]
+            return {'requests': requests,
+                    'requests_per_second': requests / elapsed,
+                    'status_codes': {str(code): count for code, count in sorted(self.status_codes.items())},
+                    'errors': dict(self.errors),
+                    'bytes_received': self.bytes_received,
+                    'retries': self.retries,
+                    'rate_limit_waits': self.rate_limit_waits,
+                    'rate_limit_wait_seconds': self.rate_limit_wait_seconds,
+                    'cache_hits': self.cache_hits,
+                    'latency': {'mean': self.latency_total / requests if requests else None,
+                                'p50': self.getPercentile(0.5),
+                                'p95': self.getPercentile(0.95),
+                                'max': self.latency_max,
+                                'histogram': dict(zip(buckets, self.latency_counts))}}
+
+
+def formatProgressLine(metrics):
+    """
+    Sums up what every source has done so far in one short line, e.g.
+    "Crossref 120 (2.1/s p95 1s 3 err) | PubMed 40 (0.8/s p95 0.5s, 12 cached)"
+
+    :param metrics: dict {source name: snapshot from SourceMetrics.getSnapshot()}
+    """
+    parts = []
+    for name, snapshot in metrics.items():
+        if not snapshot['requests'] and not snapshot['cache_hits']:
+            continue
+
+        details = ['%.1f/s' % snapshot['requests_per_second']]
+        if snapshot['latency']['p95'] is not None:
+            details.append('p95 %gs' % snapshot['latency']['p95'])
+        errors = sum(snapshot['errors'].values()) + sum(count for code, count in snapshot['status_codes'].items()
+                                                        if int(code) >= 500)
+        if errors:
+            details.append('%d err' % errors)
+        if snapshot['retries']:
+            details.append('%d retries' % snapshot['retries'])
+        if snapshot['rate_limit_wait_seconds'] >= 1:
+            details.append('%ds waiting' % snapshot['rate_limit_wait_seconds'])
+        if snapshot['cache_hits']:
+            details.append('%d cached' % snapshot['cache_hits'])
+
+        parts.append('%s %d (%s)' % (name.replace('Scraper', '').replace('Searcher', ''), snapshot['requests'],
+                                     ' '.join(details)))
+    return ' | '.join(parts)
+
+
+def writeMetrics(metrics, filename):
+    with open(filename, 'w') as f:
+        json.dump(metrics, f, indent=2)
+
+
+class MetricsStream:
+    """
+    Appends the metrics to a JSON lines file every `interval` seconds from a background thread,
+    to follow a long run as it goes
+    """
+
+    def __init__(self, get_metrics, filename, interval=30.):
+        """
+        :param get_metrics: function that returns the metrics as a JSON serializable dict
+        :param filename: file to append to
+        :param interval: seconds between snapshots
+        """
+        self.get_metrics = get_metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def writeSnapshot(self):
+        line = json.dumps({'time': strftime('%Y-%m-%d %H:%M:%S', localtime()), 'sources': self.get_metrics()})
+        with open(self.filename, 'a') as f:
+            f.write(line + '\n')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.writeSnapshot()
+            except Exception as e:
+                print('Error writing metrics', e.__class__.__name__, e)
+
+    def stop(self):
+        """
+        Stops the thread and writes one last snapshot
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.writeSnapshot()
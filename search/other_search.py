@@ -18,4 +18,5 @@ class PubMedSearcher(Searcher):
         self.scraper = PubMedScraper()
 
     def search(self, query, min_year=None, max_year=None, max_results=MAX_RESULTS):
-        self.scraper.search(query, identity='')
+        res = self.scraper.searchAll(query, max_results=max_results, min_year=min_year, max_year=max_year)
+        return res
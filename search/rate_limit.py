@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+from datetime import timedelta
+from time import time, sleep
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: allows bursts of up to `rate_limit` requests, refilling at
+    `rate_limit` tokens per `rate_interval`. Safe to share between threads.
+
+    Callers reserve a token and get back how long they need to wait before using it, so the
+    waiting itself can be done with time.sleep() or asyncio.sleep(). Reservations can take the
+    bucket below zero, which queues callers up in the order they asked.
+    """
+
+    def __init__(self, name, rate_limit=None, rate_interval=None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.rate_limit = None
+        self.interval_seconds = None
+        self.tokens = 0.
+        self.updated = time()
+        self.setLimits(rate_limit, rate_interval)
+
+    @staticmethod
+    def intervalToSeconds(rate_interval):
+        if isinstance(rate_interval, timedelta):
+            return rate_interval.total_seconds()
+        return rate_interval
+
+    def setLimits(self, rate_limit, rate_interval):
+        """
+        Sets the limit to `rate_limit` requests per `rate_interval`. Either as None disables limiting
+
+        :param rate_limit: number of requests
+        :param rate_interval: timedelta or number of seconds
+        """
+        with self.lock:
+            self.storeLimits(rate_limit, self.intervalToSeconds(rate_interval))
+
+    def storeLimits(self, rate_limit, interval_seconds):
+        if rate_limit != self.rate_limit:
+            if self.rate_limit is None:
+                # a new bucket starts full
+                self.tokens = float(rate_limit or 0)
+                self.updated = time()
+            else:
+                # but don't hand out a new burst when a known limit changes
+                self.tokens = min(self.tokens, rate_limit or 0)
+        self.rate_limit = rate_limit
+        self.interval_seconds = interval_seconds
+
+    @staticmethod
+    def refill(tokens, updated, rate_limit, interval_seconds, now):
+        rate = rate_limit / interval_seconds
+        return min(float(rate_limit), tokens + (now - updated) * rate)
+
+    def reserve(self, tokens=1):
+        """
+        Takes `tokens` tokens from the bucket
+
+        :return: number of seconds the caller must wait before making the request
+        """
+        with self.lock:
+            if not self.rate_limit or not self.interval_seconds:
+                return 0.
+
+            now = time()
+            self.tokens = self.refill(self.tokens, self.updated, self.rate_limit, self.interval_seconds, now) - tokens
+            self.updated = now
+
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens * self.interval_seconds / self.rate_limit
+
+    def tryReserve(self, tokens=1):
+        """
+        Takes `tokens` tokens from the bucket only if they are there right now
+
+        :return: True if they were taken
+        """
+        with self.lock:
+            if not self.rate_limit or not self.interval_seconds:
+                return True
+
+            now = time()
+            available = self.refill(self.tokens, self.updated, self.rate_limit, self.interval_seconds, now)
+            if available < tokens:
+                return False
+            self.tokens = available - tokens
+            self.updated = now
+            return True
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            sleep(wait)
+        return wait
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A TokenBucket whose state lives in a sqlite file, so that several processes hitting the same
+    API share a single budget. Limits learned from response headers by one process are picked up
+    by all the others.
+    """
+
+    def __init__(self, name, rate_limit=None, rate_interval=None, db_file=None):
+        assert db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "token_buckets" (
+                         "name" text primary key,
+                         "tokens" real,
+                         "updated" real,
+                         "rate_limit" integer,
+                         "interval_seconds" real
+                           )""")
+        super().__init__(name, rate_limit, rate_interval)
+
+    def loadRow(self):
+        row = self.conn.execute('SELECT tokens, updated, rate_limit, interval_seconds FROM token_buckets WHERE name=?',
+                                (self.name,)).fetchone()
+        return row
+
+    def saveRow(self, tokens, updated, rate_limit, interval_seconds):
+        self.conn.execute('REPLACE INTO token_buckets (name, tokens, updated, rate_limit, interval_seconds) '
+                          'VALUES (?,?,?,?,?)', (self.name, tokens, updated, rate_limit, interval_seconds))
+
+    def storeLimits(self, rate_limit, interval_seconds):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.loadRow()
+            if row is None:
+                self.saveRow(rate_limit or 0, time(), rate_limit, interval_seconds)
+            elif rate_limit is not None and (row[2] != rate_limit or row[3] != interval_seconds):
+                tokens = rate_limit if row[2] is None else min(row[0], rate_limit)
+                self.saveRow(tokens, row[1], rate_limit, interval_seconds)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        self.rate_limit = rate_limit
+        self.interval_seconds = interval_seconds
+
+    def reserve(self, tokens=1):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                current_tokens, updated, rate_limit, interval_seconds = self.loadRow()
+                if not rate_limit or not interval_seconds:
+                    self.conn.execute('COMMIT')
+                    return 0.
+
+                now = time()
+                current_tokens = self.refill(current_tokens, updated, rate_limit, interval_seconds, now) - tokens
+                self.saveRow(current_tokens, now, rate_limit, interval_seconds)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        if current_tokens >= 0:
+            return 0.
+        return -current_tokens * interval_seconds / rate_limit
+
+    def tryReserve(self, tokens=1):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                current_tokens, updated, rate_limit, interval_seconds = self.loadRow()
+                if not rate_limit or not interval_seconds:
+                    self.conn.execute('COMMIT')
+                    return True
+
+                now = time()
+                available = self.refill(current_tokens, updated, rate_limit, interval_seconds, now)
+                taken = available >= tokens
+                if taken:
+                    self.saveRow(available - tokens, now, rate_limit, interval_seconds)
+                self.conn.execute('COMMIT')
+                return taken
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
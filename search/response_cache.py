@@ -0,0 +1,190 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from time import time
+
+from requests.structures import CaseInsensitiveDict
+
+from db.data import CACHE_FILE
+from .async_engine import AsyncResponse
+
+RESPONSE_CACHE_FILE = os.path.join(os.path.dirname(CACHE_FILE), "responses.sqlite")
+
+# an entry's last access time is only updated if it's older than this, in seconds
+ACCESS_RESOLUTION = 3600
+# access times are written in batches of this many, or after this many seconds
+ACCESS_FLUSH_SIZE = 1000
+ACCESS_FLUSH_INTERVAL = 60
+# how often to check the size of the cache on disk, which other processes may be adding to
+SIZE_CHECK_INTERVAL = 60
+
+
+class OfflineCacheMiss(Exception):
+    """
+    Raised in offline mode when a request isn't in the response cache
+    """
+    pass
+
+
+class CachedResponse(AsyncResponse):
+    from_cache = True
+
+
+class ResponseCache:
+    """
+    On-disk cache of successful HTTP responses for the scrapers, keyed by method + URL + a hash of
+    the request body. Entries expire after the TTL given by each source, and the least recently
+    used entries are evicted once the cache grows beyond `max_size` bytes.
+
+    In offline mode nothing goes to the network: requests are served only from the cache and a
+    miss raises OfflineCacheMiss.
+
+    Hits don't write to the database each time: access times are only kept to the hour, and are
+    written in batches (see flush()). The file can be shared by several processes, so its size
+    is read back from the database every so often rather than only counted here.
+    """
+
+    def __init__(self, db_file=RESPONSE_CACHE_FILE, max_size=2 * 1024 ** 3, offline=False):
+        self.db_file = db_file
+        self.max_size = max_size
+        self.offline = offline
+        self.conn = None
+        self.total_size = 0
+        self.last_size_check = 0.
+        self.pending_access = {}
+        self.last_flush = time()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn:
+            return
+
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "responses" (
+                         "key" text primary key,
+                         "source" text,
+                         "url" text,
+                         "status" integer,
+                         "headers" text,
+                         "content" blob,
+                         "stored" real,
+                         "accessed" real,
+                         "size" integer
+                           )""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)""")
+        self.conn.commit()
+
+        self.readTotalSize()
+
+    def readTotalSize(self):
+        self.total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.last_size_check = time()
+
+    @staticmethod
+    def makeKey(url, data=None, post=False):
+        method = 'POST' if post else 'GET'
+        body = json.dumps(data, sort_keys=True) if data is not None else ''
+        body_hash = hashlib.sha1(body.encode('utf-8')).hexdigest()
+        return hashlib.sha1(' '.join([method, url, body_hash]).encode('utf-8')).hexdigest()
+
+    def get(self, key, ttl=None):
+        """
+        Returns the cached response for a key if there is one and it's not older than `ttl` seconds
+
+        :return: CachedResponse or None
+        """
+        with self.lock:
+            self.connect()
+            row = self.conn.execute('SELECT url, status, headers, content, stored, accessed FROM responses WHERE key=?',
+                                    (key,)).fetchone()
+            if not row:
+                return None
+
+            url, status, headers, content, stored, accessed = row
+            now = time()
+            # in offline mode a stale answer is better than none
+            if ttl is not None and now - stored > ttl and not self.offline:
+                return None
+
+            if now - accessed > ACCESS_RESOLUTION:
+                self.pending_access[key] = now
+            if len(self.pending_access) >= ACCESS_FLUSH_SIZE or now - self.last_flush > ACCESS_FLUSH_INTERVAL:
+                self.flushAccessTimes()
+
+        return CachedResponse(url, status, CaseInsensitiveDict(json.loads(headers)), content)
+
+    def put(self, key, source, url, response):
+        """
+        Stores a response. Only successful (200) responses are cached
+        """
+        if response.status_code != 200:
+            return
+
+        content = response.content
+        size = len(content)
+
+        with self.lock:
+            self.connect()
+            previous = self.conn.execute('SELECT size FROM responses WHERE key=?', (key,)).fetchone()
+            if previous:
+                self.total_size -= previous[0]
+
+            now = time()
+            self.pending_access.pop(key, None)
+            self.conn.execute('REPLACE INTO responses (key, source, url, status, headers, content, stored, accessed, size) '
+                              'VALUES (?,?,?,?,?,?,?,?,?)',
+                              (key, source, url, response.status_code, json.dumps(dict(response.headers)),
+                               content, now, now, size))
+            self.total_size += size
+
+            if self.total_size > self.max_size or now - self.last_size_check > SIZE_CHECK_INTERVAL:
+                self.readTotalSize()
+                if self.total_size > self.max_size:
+                    self.evict()
+
+            self.conn.commit()
+
+    def flush(self):
+        """
+        Writes the access times of recent hits to the database
+        """
+        with self.lock:
+            if self.conn:
+                self.flushAccessTimes()
+
+    def flushAccessTimes(self):
+        if self.pending_access:
+            self.conn.executemany('UPDATE responses SET accessed=? WHERE key=?',
+                                  [(accessed, key) for key, accessed in self.pending_access.items()])
+            self.conn.commit()
+            self.pending_access = {}
+        self.last_flush = time()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache is under 90% of its max size
+        """
+        self.flushAccessTimes()
+        # other processes may have added to the file since we last looked
+        self.readTotalSize()
+        target = self.max_size * 0.9
+        rows = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed ASC')
+
+        to_delete = []
+        for key, size in rows:
+            if self.total_size <= target:
+                break
+            to_delete.append((key,))
+            self.total_size -= size
+
+        self.conn.executemany('DELETE FROM responses WHERE key=?', to_delete)
+
+    def clear(self):
+        with self.lock:
+            self.connect()
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.total_size = 0
+            self.pending_access = {}
@@ -0,0 +1,411 @@
+import copy
+import json
+from time import time
+
+from db.data import Paper
+
+# how papers are grouped when keeping track of how well each source does for them
+YEAR_BUCKETS = [(2020, '2020+'), (2015, '2015-2019'), (2010, '2010-2014'), (2000, '2000-2009'), (0, '<2000')]
+
+VENUE_TYPES = {'article': 'journal',
+               'inproceedings': 'conference',
+               'conference': 'conference',
+               'proceedings': 'conference',
+               'book': 'book',
+               'inbook': 'book',
+               'incollection': 'book',
+               'misc': 'preprint',
+               'unpublished': 'preprint',
+               'techreport': 'preprint'}
+
+# the things a stage can find for a paper, as far as planning is concerned
+ID_STATE = ['doi', 'pmid', 'arxivid', 'ssid']
+
+# used instead of the real values when replaying a corpus
+PLACEHOLDER_DOI = '10.0000/replay'
+PLACEHOLDER_ABSTRACT = 'Replayed abstract.'
+
+
+def yearBucket(year):
+    try:
+        year = int(str(year)[:4])
+    except (TypeError, ValueError):
+        return 'unknown'
+
+    for start, bucket in YEAR_BUCKETS:
+        if year >= start:
+            return bucket
+
+
+def hasArxivLink(paper):
+    if paper.arxivid:
+        return True
+    return any('arxiv.org' in url.get('url', '') for url in paper.extra_data.get('urls', []))
+
+
+def paperFeatures(paper):
+    """
+    Returns the features of a paper that the hit rates of sources are kept by
+    """
+    return {'pmid': int(bool(paper.pmid)),
+            'arxiv': int(hasArxivLink(paper)),
+            'venue': VENUE_TYPES.get((paper.bib.get('ENTRYTYPE') or '').lower(), 'other'),
+            'year': yearBucket(paper.year)}
+
+
+FEATURE_ORDER = ['pmid', 'arxiv', 'venue', 'year']
+
+
+def featureKey(features):
+    """
+    Turns features into a string like "pmid=1|arxiv=0|venue=journal|year=2015-2019", most
+    important first, so that coarser groups are prefixes of finer ones
+    """
+    return '|'.join('%s=%s' % (name, features[name]) for name in FEATURE_ORDER)
+
+
+def paperFeatureKey(paper):
+    return featureKey(paperFeatures(paper))
+
+
+class SourceStats:
+    """
+    Running totals of calls, hits and seconds spent for every enrichment stage and group of
+    papers, as kept in the source_stats table of a PaperStore
+    """
+
+    def __init__(self, rows=None):
+        self.totals = {}
+        for stage, features, calls, hits, seconds in rows or []:
+            self.totals[(stage, features)] = [calls, hits, seconds]
+
+    @classmethod
+    def fromPaperStore(cls, paperstore):
+        return cls(paperstore.getSourceStats())
+
+    def record(self, stage, features, hit, seconds):
+        totals = self.totals.setdefault((stage, features), [0, 0, 0.])
+        totals[0] += 1
+        totals[1] += int(bool(hit))
+        totals[2] += seconds
+
+    def estimate(self, stage, features, min_samples=20):
+        """
+        Estimates how likely a stage is to find something for papers with `features`, and how
+        long it takes. If there aren't `min_samples` calls for this exact group of papers, the
+        last features are dropped one by one until there are.
+
+        :param features: feature key
+        :return: tuple (hit rate, mean seconds, number of calls), or None if there is too little
+            data even for the stage as a whole
+        """
+        parts = features.split('|')
+        for length in range(len(parts), -1, -1):
+            prefix = '|'.join(parts[:length])
+            calls = hits = seconds = 0
+            for (total_stage, total_features), (c, h, s) in self.totals.items():
+                if total_stage == stage and (length == 0 or total_features == prefix or
+                                             total_features.startswith(prefix + '|')):
+                    calls += c
+                    hits += h
+                    seconds += s
+            if calls >= min_samples:
+                return hits / calls, seconds / calls, calls
+        return None
+
+
+class StagePlan:
+    """
+    The order in which one paper goes through the enrichment stages.
+
+    When the stages aren't in their usual order, a stage that isn't needed when the paper gets to
+    it may become needed later (e.g. Unpaywall once some other source has found the DOI), so with
+    `revisit` such a stage gets one more chance at the end. Stages in `dropped` aren't tried.
+    """
+
+    def __init__(self, stages, revisit=False, dropped=None):
+        self.stages = list(stages)
+        self.revisit = revisit
+        self.dropped = dropped or []
+        self.revisited = set()
+
+    def notNeeded(self, stage):
+        """
+        Called when the paper doesn't need a stage it got to
+
+        :return: True if that's final, False if the stage will be looked at again
+        """
+        if self.revisit and stage.name not in self.revisited:
+            self.revisited.add(stage.name)
+            self.stages.append(stage)
+            return False
+        return True
+
+
+class EnrichmentPlanner:
+    """
+    Chooses the order of the enrichment stages for each paper from the hit rates and latencies
+    the sources have had for similar papers, to make as few calls as possible per completed
+    record: stages most likely to find something go first, so that the ones after them often
+    aren't needed, and stages that almost never find anything for papers like this are dropped.
+    """
+
+    # hit rate assumed for stages there's no data for, which puts them after the others in their
+    # usual order, but they are never dropped
+    prior_hit_rate = 0.
+
+    def __init__(self, stats, min_samples=20, skip_below=0.02):
+        """
+        :param stats: SourceStats
+        :param min_samples: calls needed before the numbers for a group of papers are trusted
+        :param skip_below: stages with a lower hit rate than this are dropped
+        """
+        self.stats = stats
+        self.min_samples = min_samples
+        self.skip_below = skip_below
+
+    def planStages(self, paper, stages, features=None):
+        """
+        :param features: feature key to plan for, instead of the paper's
+        :return: StagePlan
+        """
+        features = features or paperFeatureKey(paper)
+        planned = []
+        dropped = []
+        for index, stage in enumerate(stages):
+            estimate = self.stats.estimate(stage.name, features, self.min_samples)
+            if estimate and estimate[0] < self.skip_below:
+                dropped.append(stage)
+                continue
+
+            hit_rate, seconds = (estimate[0], estimate[1]) if estimate else (self.prior_hit_rate, 0.)
+            planned.append((-round(hit_rate, 2), seconds, index, stage))
+
+        planned.sort(key=lambda item: item[:3])
+        return StagePlan([item[3] for item in planned], revisit=True, dropped=dropped)
+
+
+# Replay evaluation
+
+def paperState(paper):
+    """
+    Returns what a paper has, as far as the stage conditions are concerned: which identifiers,
+    whether it has a full abstract, a PDF link and a year, and which done_* flags are set
+
+    :return: set of strings
+    """
+    state = set(id_type for id_type in ID_STATE if getattr(paper, id_type))
+    if paper.has_full_abstract:
+        state.add('full_abstract')
+    if paper.has_pdf_link:
+        state.add('pdf')
+    if paper.year:
+        state.add('year')
+    if paper.extra_data.get('url_scholarbib'):
+        state.add('url_scholarbib')
+    state.update(key for key, value in paper.extra_data.items() if key.startswith('done_') and value)
+    return state
+
+
+def paperFields(paper):
+    """
+    Returns everything a paper has, for telling whether a stage found anything: the names of its
+    non-empty BibTeX fields and extra_data entries (venue, authors, any identifier...) plus
+    what paperState() says, without the done_* flags
+
+    :return: set of strings
+    """
+    fields = set(key for key, value in paper.bib.items() if value and key not in ('ID', 'ENTRYTYPE'))
+    fields.update(key for key, value in paper.extra_data.items()
+                  if value and not key.startswith('done_') and key != 'job_key')
+    fields.update(item for item in paperState(paper) if not item.startswith('done_'))
+    return fields
+
+
+def paperFromState(state, record):
+    """
+    Builds a stand-in Paper that has what `state` says, for evaluating the stage conditions
+    """
+    paper = Paper({'title': record['title'], 'ENTRYTYPE': record.get('entrytype') or 'article'}, {})
+    if 'doi' in state:
+        paper.doi = PLACEHOLDER_DOI
+    if 'pmid' in state:
+        paper.pmid = '1'
+    if 'arxivid' in state:
+        paper.arxivid = '0000.00000'
+    if 'ssid' in state:
+        paper.ssid = 'replay'
+    if 'full_abstract' in state:
+        paper.bib['abstract'] = PLACEHOLDER_ABSTRACT
+    if 'pdf' in state:
+        paper.extra_data['urls'] = [{'url': 'replay.pdf', 'type': 'pdf', 'source': 'replay'}]
+    if 'year' in state:
+        paper.bib['year'] = '2000'
+    if 'url_scholarbib' in state:
+        paper.extra_data['url_scholarbib'] = 'replay'
+    for item in state:
+        if item.startswith('done_'):
+            paper.extra_data[item] = True
+    return paper
+
+
+def runStageOnCopy(stage, paper, identity):
+    """
+    Runs a stage on a copy of a paper whether it's needed or not, and records what it found
+
+    :return: tuple (outcome dict, the copy)
+    """
+    paper_copy = Paper(copy.deepcopy(paper.bib), copy.deepcopy(paper.extra_data))
+    before = paperState(paper_copy)
+    fields_before = paperFields(paper_copy)
+    start = time()
+    try:
+        stage.run(paper_copy, identity)
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+
+    after = paperState(paper_copy)
+    provides = sorted(after - before) if not error else []
+    fields = sorted(paperFields(paper_copy) - fields_before) if not error else []
+    return {'hit': bool(fields),
+            'seconds': time() - start,
+            'provides': provides,
+            'fields': fields,
+            'error': error}, paper_copy
+
+
+def recordPaper(paper, stages, identity):
+    """
+    Records what every stage finds for a paper, both from scratch and, for the stages that
+    depend on them, once the identifiers the other stages found are known
+
+    :return: corpus record, a dict
+    """
+    record = {'title': paper.title,
+              'entrytype': paper.bib.get('ENTRYTYPE'),
+              'features': paperFeatureKey(paper),
+              'state': sorted(paperState(paper)),
+              'fields': sorted(paperFields(paper)),
+              'outcomes': {}}
+
+    found_ids = {}
+    for stage in stages:
+        outcome, paper_copy = runStageOnCopy(stage, paper, identity)
+        record['outcomes'][stage.name] = {'scratch': outcome}
+        for id_type in ID_STATE:
+            if getattr(paper_copy, id_type) and not getattr(paper, id_type):
+                found_ids.setdefault(id_type, getattr(paper_copy, id_type))
+
+    if found_ids:
+        with_ids = Paper(copy.deepcopy(paper.bib), copy.deepcopy(paper.extra_data))
+        for id_type, value in found_ids.items():
+            setattr(with_ids, id_type, value)
+        for stage in stages:
+            outcome, _ = runStageOnCopy(stage, with_ids, identity)
+            record['outcomes'][stage.name]['with_ids'] = outcome
+
+    return record
+
+
+def recordCorpus(papers, stages, identity, filename):
+    """
+    Records a corpus for replayCorpus(), appending one JSON line per paper to `filename`. Every
+    stage is run on every paper (twice, for papers other stages find identifiers for), so this
+    is meant for a sample of papers, ideally with the response cache on.
+
+    :return: number of papers recorded
+    """
+    count = 0
+    with open(filename, 'a') as f:
+        for paper in papers:
+            f.write(json.dumps(recordPaper(paper, stages, identity)) + '\n')
+            f.flush()
+            count += 1
+    return count
+
+
+def loadCorpus(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def isComplete(state):
+    """
+    A record is complete when it has an identifier we can link to and a full abstract
+    """
+    return 'full_abstract' in state and ('doi' in state or 'pmid' in state)
+
+
+def replayCorpus(records, stages, planner=None, stats=None):
+    """
+    Replays the recorded outcomes of the stages, in the usual order or in the order a planner
+    chooses, and counts the calls it takes
+
+    :param records: corpus records, see recordPaper()
+    :param stages: list of EnrichmentStage
+    :param planner: EnrichmentPlanner, or None for the usual order
+    :param stats: SourceStats to record every replayed call in, or None
+    :return: dict with the number of papers, calls, seconds, complete records and calls per
+        complete record
+    """
+    totals = {'papers': 0, 'calls': 0, 'seconds': 0., 'completed': 0}
+
+    for record in records:
+        state = set(record['state'])
+        # corpora recorded before the fields were kept only have the state
+        fields = set(record.get('fields', state))
+        original_ids = state & set(ID_STATE)
+        paper = paperFromState(state, record)
+        plan = planner.planStages(paper, stages, record['features']) if planner else StagePlan(stages)
+
+        position = 0
+        while position < len(plan.stages):
+            stage = plan.stages[position]
+            position += 1
+
+            if not stage.isNeeded(paperFromState(state, record)):
+                plan.notNeeded(stage)
+                continue
+
+            outcomes = record['outcomes'].get(stage.name)
+            if not outcomes:
+                continue
+
+            scratch = outcomes['scratch']
+            provides = set(scratch['provides'])
+            outcome = scratch
+            if (state & set(ID_STATE)) - original_ids and 'with_ids' in outcomes:
+                # the identifiers a stage finds by itself it also finds when it knows others
+                outcome = outcomes['with_ids']
+                provides = set(outcome['provides']) | (provides & set(ID_STATE))
+            new_fields = set(outcome.get('fields', provides)) | (set(scratch.get('fields', provides)) & set(ID_STATE))
+
+            found = set(item for item in new_fields - fields if not item.startswith('done_'))
+            totals['calls'] += 1
+            totals['seconds'] += outcome['seconds']
+            if stats and not outcome.get('error'):
+                stats.record(stage.name, record['features'], bool(found), outcome['seconds'])
+            state.update(provides)
+            fields.update(new_fields)
+
+        totals['papers'] += 1
+        totals['completed'] += int(isComplete(state))
+
+    totals['calls_per_completed'] = totals['calls'] / totals['completed'] if totals['completed'] else None
+    return totals
+
+
+def evaluatePlanner(records, stages, min_samples=20, skip_below=0.02):
+    """
+    Learns the source stats from the first half of a corpus, replayed in the usual order, and
+    compares the usual order with the planner on the second half
+
+    :return: tuple (totals in the usual order, totals with the planner)
+    """
+    half = len(records) // 2
+    stats = SourceStats()
+    replayCorpus(records[:half], stages, stats=stats)
+
+    planner = EnrichmentPlanner(stats, min_samples=min_samples, skip_below=skip_below)
+    return replayCorpus(records[half:], stages), replayCorpus(records[half:], stages, planner)
@@ -0,0 +1,333 @@
+import re
+from io import BytesIO
+
+from lxml import etree
+
+from db.ref_utils import authorListFromDict, addUrlIfNew
+from .base_search import SearchResult
+
+# PubMed
+
+pm_article = etree.XPath('MedlineCitation/Article')
+pm_pmid = etree.XPath('string(MedlineCitation/PMID)')
+pm_doi = etree.XPath('ELocationID[@EIdType="doi"]/text()')
+pm_doi_from_ids = etree.XPath('PubmedData/ArticleIdList/ArticleId[@IdType="doi"]/text()')
+pm_pmcid_from_ids = etree.XPath('PubmedData/ArticleIdList/ArticleId[@IdType="pmc"]/text()')
+pm_title = etree.XPath('ArticleTitle')
+pm_abstract_pieces = etree.XPath('Abstract/AbstractText')
+pm_authors = etree.XPath('AuthorList/Author')
+pm_fore_name = etree.XPath('string(ForeName)')
+pm_last_name = etree.XPath('string(LastName)')
+pm_collective_name = etree.XPath('string(CollectiveName)')
+pm_language = etree.XPath('Language/text()')
+pm_journal = etree.XPath('string(Journal/Title)')
+pm_article_date = etree.XPath('ArticleDate')
+pm_pubmed_date = etree.XPath('PubmedData/History/PubMedPubDate[@PubStatus="pubmed"]')
+pm_issue_date = etree.XPath('Journal/JournalIssue/PubDate')
+pm_year = etree.XPath('string(Year)')
+pm_month = etree.XPath('string(Month)')
+pm_day = etree.XPath('string(Day)')
+pm_medline_date = etree.XPath('string(MedlineDate)')
+pm_deleted_pmids = etree.XPath('PMID/text()')
+
+
+def elementText(element):
+    """
+    Returns all the text inside an element, including that of inline markup like <i> or <sup>
+    """
+    if element is None:
+        return ''
+    return ''.join(element.itertext()).strip()
+
+
+def clearElement(element):
+    """
+    Frees a finished element and the siblings before it, so iterparse() keeps memory flat
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def getPubMedDate(article_node, article):
+    """
+    Returns (year, month, day) for an article, trying the electronic publication date, then the
+    date it was added to PubMed, then the journal issue date. Any of them can be empty.
+    """
+    for date_nodes in [pm_article_date(article), pm_pubmed_date(article_node), pm_issue_date(article)]:
+        if not date_nodes:
+            continue
+
+        date_node = date_nodes[0]
+        year = pm_year(date_node)
+        if not year:
+            match = re.search(r'\d{4}', pm_medline_date(date_node))
+            year = match.group(0) if match else ''
+
+        if year:
+            return year, pm_month(date_node), pm_day(date_node)
+
+    return '', '', ''
+
+
+def parsePubMedArticle(article_node, index=0):
+    """
+    Converts a <PubmedArticle> element into a SearchResult
+
+    :param article_node: PubmedArticle element
+    :param index: index of the result
+    :return: SearchResult, or None if the element has no article in it
+    """
+    articles = pm_article(article_node)
+    if not articles:
+        return None
+
+    article = articles[0]
+    new_bib = {}
+
+    doi = pm_doi(article) or pm_doi_from_ids(article_node)
+    if doi:
+        new_bib['doi'] = doi[0].strip()
+
+    titles = pm_title(article)
+    new_bib['title'] = elementText(titles[0]) if titles else ''
+
+    abstract = ""
+    for abs_piece in pm_abstract_pieces(article):
+        if abs_piece.get('Label'):
+            abstract += abs_piece.get('Label') + "\n"
+
+        abstract += elementText(abs_piece) + '\n'
+    new_bib['abstract'] = abstract
+
+    authors = []
+    for author in pm_authors(article):
+        family = pm_last_name(author)
+        if family:
+            authors.append({'given': pm_fore_name(author), 'family': family})
+        elif pm_collective_name(author):
+            authors.append({'given': '', 'family': pm_collective_name(author)})
+
+    new_bib['author'] = authorListFromDict(authors)
+
+    journal = pm_journal(article)
+    if journal:
+        new_bib['journal'] = journal
+
+    year, month, day = getPubMedDate(article_node, article)
+    for field, value in [('year', year), ('month', month), ('day', day)]:
+        if value:
+            new_bib[field] = value
+
+    language = pm_language(article)
+    new_extra = {'pmid': pm_pmid(article_node),
+                 'x_authors': authors,
+                 'language': language[0] if language else None}
+
+    pmcid = pm_pmcid_from_ids(article_node)
+    if pmcid:
+        new_extra['pmcid'] = pmcid[0]
+
+    return SearchResult(index, new_bib, 'pubmed', new_extra)
+
+
+def iterPubMedArticles(source, index_offset=0):
+    """
+    Streams the articles in a PubmedArticleSet XML document one at a time, without building the
+    whole tree. An article that can't be parsed is reported and skipped rather than aborting
+    the rest.
+
+    :param source: filename or binary file-like object
+    :param index_offset: index of the first result
+    :return: generator of SearchResult
+    """
+    index = index_offset
+    for _, article_node in etree.iterparse(source, events=('end',), tag='PubmedArticle'):
+        try:
+            result = parsePubMedArticle(article_node, index)
+        except Exception as e:
+            print('Error parsing PubMed article', pm_pmid(article_node), e.__class__.__name__, e)
+            result = None
+
+        clearElement(article_node)
+
+        if result:
+            index += 1
+            yield result
+
+
+def iterPubMedUpdates(source):
+    """
+    Streams the contents of a PubMed baseline or update file: new and revised articles, and
+    the PMIDs of articles that have been deleted
+
+    :param source: filename or binary file-like object
+    :return: generator of (pmid, SearchResult), with None as the SearchResult for deleted articles
+    """
+    for _, node in etree.iterparse(source, events=('end',), tag=('PubmedArticle', 'DeleteCitation')):
+        if node.tag == 'DeleteCitation':
+            for pmid in pm_deleted_pmids(node):
+                yield pmid.strip(), None
+        else:
+            try:
+                result = parsePubMedArticle(node)
+            except Exception as e:
+                print('Error parsing PubMed article', pm_pmid(node), e.__class__.__name__, e)
+                result = None
+
+            if result and result.extra_data['pmid']:
+                yield result.extra_data['pmid'], result
+
+        clearElement(node)
+
+
+def parsePubMedArticles(content, index_offset=0):
+    """
+    Parses a PubmedArticleSet XML response
+
+    :param content: XML as bytes
+    :param index_offset: index of the first result
+    :return: list of SearchResult
+    """
+    return list(iterPubMedArticles(BytesIO(content), index_offset))
+
+
+# arXiv
+
+ARXIV_NS = {'ns': 'http://www.w3.org/2005/Atom',
+            'arxiv': 'http://arxiv.org/schemas/atom'}
+
+ARXIV_ENTRY_TAG = '{%s}entry' % ARXIV_NS['ns']
+
+ax_id = etree.XPath('string(ns:id)', namespaces=ARXIV_NS)
+ax_title = etree.XPath('string(ns:title)', namespaces=ARXIV_NS)
+ax_summary = etree.XPath('string(ns:summary)', namespaces=ARXIV_NS)
+ax_published = etree.XPath('string(ns:published)', namespaces=ARXIV_NS)
+ax_author_names = etree.XPath('ns:author/ns:name/text()', namespaces=ARXIV_NS)
+ax_primary_category = etree.XPath('arxiv:primary_category/@term', namespaces=ARXIV_NS)
+ax_categories = etree.XPath('ns:category/@term', namespaces=ARXIV_NS)
+ax_doi = etree.XPath('arxiv:doi/text()', namespaces=ARXIV_NS)
+ax_links = etree.XPath('ns:link', namespaces=ARXIV_NS)
+
+
+def parseArxivEntry(entry, index=0):
+    """
+    Converts an Atom <entry> from the arXiv API into a SearchResult
+
+    :param entry: entry element
+    :param index: index of the result
+    :return: SearchResult, or None if the entry has no id (e.g. an API error)
+    """
+    entry_id = ax_id(entry).strip()
+    if not entry_id or '/api/errors' in entry_id:
+        return None
+
+    new_bib = {'arxivid': entry_id.split('/abs/')[-1],
+               'title': ' '.join(ax_title(entry).split()),
+               'abstract': ax_summary(entry).strip(),
+               }
+
+    match = re.search(r"(\d{4})-(\d{2})-(\d{2})", ax_published(entry))
+    if match:
+        new_bib['year'] = match.group(1)
+        new_bib['month'] = str(int(match.group(2)))
+        new_bib['date'] = str(int(match.group(3)))
+
+    doi = ax_doi(entry)
+    if doi:
+        new_bib['doi'] = doi[0].strip()
+
+    authors = []
+    for name in ax_author_names(entry):
+        bits = name.split()
+        if bits:
+            authors.append({'given': bits[0], 'family': bits[-1]})
+
+    new_bib['author'] = authorListFromDict(authors)
+
+    primary_category = ax_primary_category(entry)
+    new_extra = {
+        'x_authors': authors,
+        'ax_main_category': primary_category[0] if primary_category else None,
+        'ax_categories': list(ax_categories(entry)),
+    }
+
+    new_res = SearchResult(index, new_bib, 'arxiv', new_extra)
+
+    for link in ax_links(entry):
+        href = link.get('href', '')
+        if link.get('title') == 'pdf':
+            addUrlIfNew(new_res, href, 'pdf', 'arxiv')
+        elif 'arxiv.org/abs/' in href:
+            addUrlIfNew(new_res, href, 'main', 'arxiv')
+
+    return new_res
+
+
+def iterArxivEntries(source, index_offset=0):
+    """
+    Streams the entries of an arXiv API Atom feed one at a time
+
+    :param source: filename or binary file-like object
+    :param index_offset: index of the first result
+    :return: generator of SearchResult
+    """
+    index = index_offset
+    for _, entry in etree.iterparse(source, events=('end',), tag=ARXIV_ENTRY_TAG):
+        try:
+            result = parseArxivEntry(entry, index)
+        except Exception as e:
+            print('Error parsing arXiv entry', ax_id(entry), e.__class__.__name__, e)
+            result = None
+
+        clearElement(entry)
+
+        if result:
+            index += 1
+            yield result
+
+
+def parseArxivEntries(content, index_offset=0):
+    """
+    Parses an arXiv API Atom response
+
+    :param content: XML as bytes
+    :param index_offset: index of the first result
+    :return: list of SearchResult
+    """
+    return list(iterArxivEntries(BytesIO(content), index_offset))
+
+
+def benchmark(num_articles=20000):
+    """
+    Times the PubMed parser on a synthetic efetch response
+
+    :param num_articles: number of articles to generate
+    """
+    from time import time
+
+    article = ('<PubmedArticle><MedlineCitation><PMID>{0}</PMID><Article>'
+               '<Journal><Title>Journal of Studies</Title></Journal>'
+               '<ArticleTitle>A study of <i>things</i> number {0}</ArticleTitle>'
+               '<Abstract><AbstractText Label="BACKGROUND">' + 'Some background. ' * 40 + '</AbstractText>'
+               '<AbstractText Label="RESULTS">' + 'Some results. ' * 40 + '</AbstractText></Abstract>'
+               '<AuthorList><Author><LastName>Smith</LastName><ForeName>John</ForeName></Author>'
+               '<Author><LastName>Doe</LastName></Author><Author><CollectiveName>The Group</CollectiveName></Author>'
+               '</AuthorList><Language>eng</Language>'
+               '<ELocationID EIdType="doi">10.1000/test.{0}</ELocationID></Article></MedlineCitation>'
+               '<PubmedData><History><PubMedPubDate PubStatus="pubmed"><Year>2019</Year><Month>3</Month>'
+               '<Day>1</Day></PubMedPubDate></History></PubmedData></PubmedArticle>\n')
+
+    content = ('<PubmedArticleSet>\n' + ''.join(article.format(i) for i in range(num_articles)) +
+               '</PubmedArticleSet>').encode('utf-8')
+
+    start = time()
+    count = sum(1 for _ in iterPubMedArticles(BytesIO(content)))
+    duration = time() - start
+
+    print('Parsed %d articles (%.1f MB of XML) in %.2f seconds (%.0f articles/s)' % (
+        count, len(content) / 1024 ** 2, duration, count / duration))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,13 +1,14 @@
 from base.general_utils import loadEntriesAndSetUp, writeOutputBib
 from argparse import ArgumentParser
 from filter_results import filterPapers, printReport, filterOnePaper
-from search.metadata_harvest import semanticscholarmetadata, enrichAndUpdateMetadata
+from search.metadata_harvest import semanticscholarmetadata, enrichAndUpdateMetadata, setOfflineMode, \
+    useLocalData, startMetricsStream, dumpMetrics
 import pandas as pd
 
 
-def getCitingPapers(paper):
+def getCitingPapers(paper, max_citations=1000):
     try:
-        paper, citing_papers = semanticscholarmetadata.getMetadata(paper, get_citing_papers=True)
+        citing_papers = semanticscholarmetadata.getCitations(paper, max_results=max_citations)
     except Exception as e:
         print(e.__class__.__name__, e)
         return []
@@ -19,23 +20,31 @@ def deDupePaperList():
     pass
 
 
-def snowballCitations(paperstore, all_papers):
+def snowballCitations(paperstore, all_papers, max_citations=1000):
     newfound_paper_list = []
     report = []
 
     all_titles_ever_seen = {}
     search_nodes = all_papers
 
+    # seed papers need a Semantic Scholar id (or a DOI) to get their citations
+    to_look_up = [paper for paper in search_nodes if not paper.extra_data.get('ss_id')]
+    if to_look_up:
+        try:
+            semanticscholarmetadata.getMetadataBatch(to_look_up)
+        except Exception as e:
+            print(e.__class__.__name__, e)
+
     while len(search_nodes) > 0:
         paper = search_nodes.pop(0)
-        new_papers = getCitingPapers(paper)
+        new_papers = getCitingPapers(paper, max_citations)
         for new_paper in new_papers:
             if new_paper.title in all_titles_ever_seen:
                 print('[Skipping] already seen paper', new_paper.title)
                 all_titles_ever_seen[new_paper.title] += 1
                 continue
 
-            semanticscholarmetadata.getMetadata(new_paper)
+            # citations come with their metadata already
             new_paper.extra_data['done_semanticscholar'] = True
             paperstore.updatePapers([new_paper])
 
@@ -75,11 +84,16 @@ def snowballCitations(paperstore, all_papers):
 
 
 def main(conf):
+    useLocalData(not conf.no_response_cache)
+
+    if conf.offline:
+        setOfflineMode(True)
+
     paperstore, papers_to_add, papers_existing, all_papers = loadEntriesAndSetUp(conf.input, conf.cache)
 
     # successful, unsuccessful = enrichAndUpdateMetadata(papers_to_add, paperstore, conf.email)
 
-    snowballed_papers, df = snowballCitations(paperstore, all_papers)
+    snowballed_papers, df = snowballCitations(paperstore, all_papers, conf.max_citations)
     print('Number of snowballed papers:', len(snowballed_papers))
     printReport(df)
 
@@ -104,7 +118,25 @@ if __name__ == '__main__':
                         help='Use local cache for results')
     parser.add_argument('-em', '--email', type=str,
                         help='Email to serve as identity to API endpoints')
+    parser.add_argument('-mc', '--max-citations', type=int, default=1000,
+                        help='Max number of citing papers to retrieve for each paper')
+    parser.add_argument('-off', '--offline', action='store_true',
+                        help='Only use responses already in the local HTTP response cache, never go to the network')
+    parser.add_argument('-nrc', '--no-response-cache', action='store_true',
+                        help='Don\'t keep HTTP responses in the local response cache')
+    parser.add_argument('-mo', '--metrics-output', type=str, default='metrics.json',
+                        help='JSON file the request metrics of every source are written to at the end')
+    parser.add_argument('-mst', '--metrics-stream', type=str,
+                        help='JSON lines file to append the request metrics to while running')
+    parser.add_argument('-msi', '--metrics-interval', type=float, default=30,
+                        help='Seconds between the metrics appended to --metrics-stream')
 
     conf = parser.parse_args()
 
-    main(conf)
+    stream = startMetricsStream(conf.metrics_stream, conf.metrics_interval) if conf.metrics_stream else None
+    try:
+        main(conf)
+    finally:
+        if stream:
+            stream.stop()
+        dumpMetrics(conf.metrics_output)